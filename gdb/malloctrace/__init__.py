@@ -1 +1,8 @@
-from malloctrace.malloctrace import *
\ No newline at end of file
+try:
+    import gdb
+except ImportError:
+    # Imported outside of gdb, e.g. by the offline analyzer.
+    gdb = None
+
+if gdb is not None:
+    from malloctrace.malloctrace import *
\ No newline at end of file
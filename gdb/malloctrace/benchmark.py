@@ -0,0 +1,237 @@
+"""Throughput benchmark for the analysis side of malloctrace, without gdb.
+
+usage: python -m malloctrace.benchmark [--entries N ...] [--frames N] [--repeat N] [--output FILE]
+       python -m malloctrace.benchmark --startup [--gdb PATH] [--repeat N] [--output FILE]
+
+Builds synthetic heap maps and times the steps every command goes through once the
+heap maps were read from the inferior: decoding the merged regions into a snapshot,
+sorting it by address, range queries, filtered queries like 'malloctrace show --min-size
+--frame', grouping by allocation site and formatting
+allocations the way 'malloctrace show' prints them. The results are written as JSON,
+so they can be compared between releases.
+
+With --startup it instead times how much loading the plugin adds to the start of gdb:
+gdb -batch with and without sourcing gdbinit.py, and the import itself as timed inside gdb.
+
+Run it from the gdb/ directory of the repository, or put that directory on PYTHONPATH.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from malloctrace import offline
+from malloctrace.dumpfile import DumpFile, write_dump
+from malloctrace.snapshot import EntryFilter, HeapSnapshot
+from malloctrace.symbols import Module, Symbolization
+
+
+DEFAULT_ENTRY_COUNTS = [10_000, 100_000, 1_000_000]
+DEFAULT_FRAME_COUNT = 16
+# Chunks printed per formatting run, printing all of a big map only measures the terminal.
+FORMAT_COUNT = 10_000
+RANGE_QUERY_COUNT = 1_000
+# Real programs allocate from far fewer sites than they have chunks.
+STACK_COUNT = 1_000
+PC_COUNT = 5_000
+
+GDBINIT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gdbinit.py")
+
+HEAP_BASE = 0x5555_0000_0000
+TEXT_BASE = 0x7f00_0000_0000
+
+
+def build_heap_map(entry_count: int, frame_count: int, seed: int = 0) -> Tuple[List[bytes], bytes]:
+    """Returns the used regions of synthetic per-thread heap maps and their stack table, as malloctrace.heap_map reads them from the inferior.
+
+    Chunks are spread over the heap in allocation order per thread, so the merged map
+    is not sorted by address, just like the real one.
+    """
+    rng = random.Random(seed)
+    pcs = [TEXT_BASE + rng.randrange(0x100000) for _ in range(PC_COUNT)]
+    # Stack id 0 is the empty backtrace.
+    stacks = [bytes(frame_count * 8)] + [struct.pack(f"={frame_count}Q", *rng.sample(pcs, frame_count)) for _ in range(STACK_COUNT)]
+    header = struct.Struct("=QQQQiI")
+    address = HEAP_BASE
+    addresses = list()
+    for _ in range(entry_count):
+        address += 0x10 * rng.randrange(1, 0x100)
+        addresses.append(address)
+    rng.shuffle(addresses)
+    # Allocations a few microseconds apart on average, numbered across all threads.
+    timestamps = list(itertools.accumulate(rng.randrange(0x4000) for _ in range(entry_count)))
+    thread_count = 4
+    regions = list()
+    for thread in range(thread_count):
+        region = bytearray()
+        for sequence in range(thread, entry_count, thread_count):
+            region += header.pack(addresses[sequence], int(rng.paretovariate(1.2) * 0x10), sequence + 1, timestamps[sequence], 1000 + thread,
+                rng.randrange(1, len(stacks)))
+        regions.append(bytes(region))
+    return regions, b"".join(stacks)
+
+
+def synthetic_symbols(snapshot: HeapSnapshot) -> Dict[int, Symbolization]:
+    return {pc: Symbolization(f"function_{pc & 0xfffff:x}", f"src/file_{pc % 97}.c", pc % 1000) for pc in snapshot.unique_frames()}
+
+
+def time_best(f: Callable[[], object], repeat: int) -> float:
+    """The best wall time of `repeat` runs of f in seconds, the least disturbed by other load."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(name: str, entry_count: int, seconds: float, items: int) -> dict:
+    return {
+        "name": name,
+        "entries": entry_count,
+        "seconds": round(seconds, 6),
+        "items": items,
+        "ns_per_item": round(seconds * 1e9 / items, 2) if items else 0.0,
+        "items_per_s": round(items / seconds) if seconds else 0,
+    }
+
+
+def run_entry_count(entry_count: int, frame_count: int, repeat: int, workdir: str) -> List[dict]:
+    results = list()
+    regions, stacks = build_heap_map(entry_count, frame_count)
+
+    def decode():
+        return HeapSnapshot(b"".join(regions), stacks, frame_count)
+    results.append(result("decode", entry_count, time_best(decode, repeat), entry_count))
+
+    def sort_by_address():
+        decode().address_order
+    results.append(result("address_order", entry_count, time_best(sort_by_address, repeat), entry_count))
+
+    snapshot = decode()
+    snapshot.address_order
+    rng = random.Random(1)
+    low, high = snapshot._sorted_addresses[0], snapshot._sorted_addresses[-1]
+    ranges = [sorted((rng.randrange(low, high), rng.randrange(low, high))) for _ in range(RANGE_QUERY_COUNT)]
+
+    def range_positions():
+        for start, end in ranges:
+            snapshot.range_positions(start, end)
+    results.append(result("range_positions", entry_count, time_best(range_positions, repeat), RANGE_QUERY_COUNT))
+
+    # A narrow range, like 'malloctrace show' around a single object.
+    narrow = [(start, start + 0x10000) for start, _ in ranges]
+    def indices_in_range():
+        for start, end in narrow:
+            snapshot.indices_in_range(start, end)
+    results.append(result("indices_in_range", entry_count, time_best(indices_in_range, repeat), RANGE_QUERY_COUNT))
+
+    # A size range and a set of call sites, once the indexes of the snapshot are built.
+    entry_filter = EntryFilter(min_size=0x40, max_size=0x100, frame_pcs=(frozenset(sorted(snapshot.unique_frames())[:PC_COUNT // 100]),))
+    snapshot.select(entry_filter)
+    results.append(result("select", entry_count, time_best(lambda: snapshot.select(entry_filter), repeat), entry_count))
+
+    results.append(result("stack_totals", entry_count, time_best(snapshot.stack_totals, repeat), entry_count))
+    results.append(result("size_histogram", entry_count, time_best(snapshot.size_histogram, repeat), entry_count))
+    results.append(result("age_histogram", entry_count, time_best(snapshot.age_histogram, repeat), entry_count))
+    results.append(result("thread_totals", entry_count, time_best(lambda: decode().thread_totals(), repeat), entry_count))
+    results.append(result("oldest", entry_count, time_best(lambda: snapshot.select(EntryFilter(), "age", 10), repeat), entry_count))
+
+    path = os.path.join(workdir, f"heap-{entry_count!s}.mtrdump")
+    modules = [Module(TEXT_BASE, TEXT_BASE + 0x100000, 0, "libsynthetic.so")]
+    write_dump(path, snapshot, synthetic_symbols(snapshot), modules)
+    with DumpFile(path) as dump:
+        format_count = min(FORMAT_COUNT, entry_count)
+        order = dump.snapshot.address_order[:format_count]
+        def print_allocations():
+            with contextlib.redirect_stdout(io.StringIO()):
+                for index in order:
+                    offline.print_allocation(dump, dump.snapshot[index])
+        results.append(result("print_allocation", entry_count, time_best(print_allocations, repeat), format_count))
+    os.unlink(path)
+    return results
+
+
+def run_gdb(gdb_path: str, *args: str) -> str:
+    completed = subprocess.run([gdb_path, "-nx", "-batch", *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=True)
+    return completed.stdout
+
+
+def run_startup(gdb_path: str, repeat: int) -> List[dict]:
+    """Times gdb -batch without and with the plugin, and the import of the plugin within gdb."""
+    results = list()
+    bare = time_best(lambda: run_gdb(gdb_path), repeat)
+    results.append(result("gdb", 0, bare, 1))
+    plugin = time_best(lambda: run_gdb(gdb_path, "-x", GDBINIT), repeat)
+    results.append(result("gdb_with_plugin", 0, plugin, 1))
+
+    import_times = list()
+    for _ in range(repeat):
+        output = run_gdb(gdb_path,
+            "-ex", "python import time; _malloctrace_start = time.perf_counter()",
+            "-x", GDBINIT,
+            "-ex", "python print(f'import_seconds={time.perf_counter() - _malloctrace_start!r}')")
+        import_times.append(float(output.rsplit("import_seconds=", 1)[1].split()[0]))
+    results.append(result("plugin_import", 0, min(import_times), 1))
+    return results
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m malloctrace.benchmark", description="Time the heap map analysis on synthetic heap maps.")
+    parser.add_argument("--entries", type=int, nargs="+", default=DEFAULT_ENTRY_COUNTS, help="The heap map sizes to benchmark, e.g. 10000 10000000")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAME_COUNT, help="The backtrace depth of the synthetic heap maps")
+    parser.add_argument("--repeat", type=int, default=3, help="Take the best of N runs of every step")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--startup", action="store_true", help="Time the startup cost of the plugin in gdb instead of the analysis")
+    parser.add_argument("--gdb", default="gdb", help="The gdb to time with --startup")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.startup:
+        try:
+            results = run_startup(args.gdb, args.repeat)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"[-]: {e!s}", file=sys.stderr)
+            return 1
+        document = {
+            "benchmark": "plugin_startup",
+            "python": platform.python_version(),
+            "repeat": args.repeat,
+            "results": results,
+        }
+    else:
+        results = list()
+        with tempfile.TemporaryDirectory() as workdir:
+            for entry_count in args.entries:
+                results += run_entry_count(entry_count, args.frames, args.repeat, workdir)
+        document = {
+            "benchmark": "analysis_throughput",
+            "python": platform.python_version(),
+            "frames": args.frames,
+            "repeat": args.repeat,
+            "results": results,
+        }
+    if args.output is None:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(document, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
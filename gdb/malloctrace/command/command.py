@@ -1,5 +1,4 @@
 import gdb
-import io
 
 from .argparser import GDBArgumentParser
 
@@ -31,13 +30,23 @@ class _Command(_FunctionalCommand):
         else:
             self.parser.prog = command_name
 
-        file = io.StringIO()
-        self.parser.print_help(file)
-        file.seek(0)
-        self.__doc__ = file.read()
+        # gdb reads the doc when the command is registered, formatting the whole
+        # argparse help for every command there shows in the startup time.
+        # The full help is rendered on demand by '<command> --help'.
+        if "--help" not in self.parser._option_string_actions:
+            self.parser.add_argument("--help", action="help", help="Show this help message")
+        self.__doc__ = self._short_doc()
 
         super().__init__(function, command_name, command_class=command_class, prefix=prefix)
     
+    def _short_doc(self) -> str:
+        summary = (self.parser.short_description or "").removesuffix("\nusage: ") or self.parser.description or ""
+        lines = [summary]
+        if self.parser.description and self.parser.description != summary:
+            lines.append(self.parser.description)
+        lines.append(f"Run '{self.parser.prog!s} --help' for its usage and arguments.")
+        return "\n".join(lines)
+
     def parse_argument(self, argument: str):
         argv = gdb.string_to_argv(argument)
         return self.parser.parse_args(argv)
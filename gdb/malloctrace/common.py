@@ -1,14 +1,16 @@
-from typing import Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional
+import collections
+import os
 import gdb
+from malloctrace.constants import SYMBOL_CACHE_SIZE
 from malloctrace.logging import _address, _function, _filename, malloctrace_warning
-from malloctrace.params import MALLOCTRACE_OBJFILE_NAME_PARAM
+from malloctrace.session import current_session
+from malloctrace.symbolizer import symbolize_batch
+from malloctrace.symbols import UNKNOWN_SYMBOL, Module, Symbolization, format_bt_line
 
 
 def get_malloctrace_objfile() -> Optional[gdb.Objfile]:
-    try:
-        return gdb.lookup_objfile(MALLOCTRACE_OBJFILE_NAME_PARAM.value)
-    except ValueError:
-        return None
+    return current_session().objfile
 
 def has_malloctrace_objfile_loaded() -> bool:
     return get_malloctrace_objfile() is not None
@@ -17,8 +19,25 @@ def warn_no_malloctrace_objfile_loaded_and_defered_change():
     malloctrace_warning("No Malloctrace objfile present. The change will take place only after you restart your program.")
 
 def has_process():
+    """Whether the inferior has memory to read, either as a running process or as a core file."""
     inferior = gdb.selected_inferior()
-    return inferior is not None and inferior.is_valid() and len(inferior.threads()) > 0
+    # pid is 0 as long as the inferior has no process, which is cheaper to check than its threads.
+    return inferior is not None and inferior.is_valid() and inferior.pid != 0
+
+def is_core_file() -> bool:
+    return has_process() and current_session().is_core_file
+
+def has_live_process():
+    return has_process() and not current_session().is_core_file
+
+def warn_core_file_is_read_only():
+    malloctrace_warning("The inferior is a core file, which can't be changed. The change will take place only after you run your program.")
+
+def read_thread_names() -> Dict[int, Optional[str]]:
+    """The name of every thread of the inferior by its tid (LWP), None for threads without one."""
+    if not has_process():
+        return dict()
+    return {thread.ptid[1]: thread.name for thread in gdb.selected_inferior().threads()}
 
 def assert_malloctrace_loaded():
     if not has_process():
@@ -26,23 +45,151 @@ def assert_malloctrace_loaded():
     if get_malloctrace_objfile() is None:
         raise ValueError("No Malloctrace objfile present")
 
+def assert_inferior_writable():
+    assert_malloctrace_loaded()
+    if current_session().is_core_file:
+        raise ValueError("The inferior is a core file, which is read-only")
+
 def get_symbol_for_address(address):
     symbol = gdb.execute(f"info symbol {hex(address)}", to_string=True)
     if symbol.startswith("No symbol"):
-      return "<Unknwon>"
+      return UNKNOWN_SYMBOL
     symbol = symbol.split(" ", 3)
     offset = '+' + hex(int(symbol[2])) if symbol[1] == '+' else ""
     return f"{symbol[0]}{offset}"
 
-def bt_line_for_address(address):
+class SymbolCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _SymbolCache:
+    """An LRU of symbolizations by pc, which prefetch_symbols fills in batches."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "collections.OrderedDict[int, Symbolization]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, pc: int) -> bool:
+        return pc in self._entries
+
+    def get(self, pc: int) -> Optional[Symbolization]:
+        symbolization = self._entries.get(pc)
+        if symbolization is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(pc)
+        return symbolization
+
+    def put(self, pc: int, symbolization: Symbolization):
+        self._entries[pc] = symbolization
+        self._entries.move_to_end(pc)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def info(self) -> SymbolCacheInfo:
+        return SymbolCacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+# Most allocations share a small set of call sites, so cache the symbolization per pc.
+_symbol_cache = _SymbolCache(SYMBOL_CACHE_SIZE)
+
+def prefetch_symbols(pcs: Iterable[int]):
+    """Symbolizes the pcs about to be printed in one batch from the ELF files, the ones it can't resolve are left to gdb."""
+    missing = {pc for pc in pcs if pc != 0 and pc not in _symbol_cache}
+    if not missing:
+        return
+    for pc, symbolization in symbolize_batch(missing, read_module_map()).items():
+        _symbol_cache.put(pc, symbolization)
+
+def symbolize_address(address) -> Symbolization:
+    symbolization = _symbol_cache.get(address)
+    if symbolization is not None:
+        return symbolization
     sal = gdb.current_progspace().find_pc_line(address)
-    symbol = _function(get_symbol_for_address(address))
-    address = _address(hex(address))
+    symbol = get_symbol_for_address(address)
     if sal.symtab is None:
-        return f"{address} in {symbol} ()"
-    source_line = sal.line
-    source_file = sal.symtab.filename
-    return f"{address} in {symbol} () at {_filename(source_file)}:{source_line}"
+        symbolization = Symbolization(symbol, None, 0)
+    else:
+        symbolization = Symbolization(symbol, sal.symtab.filename, sal.line)
+    _symbol_cache.put(address, symbolization)
+    return symbolization
+
+def bt_line_for_address(address):
+    return format_bt_line(address, symbolize_address(address), address_style=_address, function_style=_function, filename_style=_filename)
+
+def symbol_cache_info() -> SymbolCacheInfo:
+    return _symbol_cache.info()
+
+def invalidate_symbol_cache(*_):
+    # Any change of the loaded objfiles may move or change the symbols behind a pc.
+    _symbol_cache.clear()
+
+gdb.events.new_objfile.connect(invalidate_symbol_cache)
+gdb.events.clear_objfiles.connect(invalidate_symbol_cache)
+gdb.events.exited.connect(invalidate_symbol_cache)
+
+def _read_target_module_map() -> List[Module]:
+    # The mappings as gdb gets them from the target, the NT_FILE note of a core file or /proc of a remote process:
+    #   Start Addr  End Addr  Size  Offset  [Perms]  objfile
+    modules = list()
+    for mapping in gdb.execute("info proc mappings", to_string=True).splitlines():
+        parts = mapping.split()
+        if len(parts) < 5 or not parts[0].startswith("0x") or not parts[-1].startswith("/"):
+            continue
+        modules.append(Module(int(parts[0], 16), int(parts[1], 16), int(parts[3], 16), parts[-1]))
+    return modules
+
+def _local_objfile_names() -> Dict[str, str]:
+    """Maps the target path of every objfile gdb read from a local file to that file."""
+    sysroot = gdb.parameter("sysroot") or ""
+    sysroot = "" if sysroot.startswith("target:") else sysroot.rstrip("/")
+    names = dict()
+    for objfile in gdb.objfiles():
+        name = objfile.filename
+        # Files gdb fetched from the target ("target:" sysroot) only live on the target.
+        if not name or not name.startswith("/"):
+            continue
+        target_name = name[len(sysroot):] if sysroot and name.startswith(sysroot + "/") else name
+        names[target_name] = name
+    return names
+
+def _localize_module_map(modules: List[Module]) -> List[Module]:
+    # The program itself is usually loaded from another path than the target runs it from, so fall back to unique basenames.
+    names = _local_objfile_names()
+    basenames = collections.Counter(map(os.path.basename, names))
+    by_basename = {os.path.basename(target_name): name for target_name, name in names.items() if basenames[os.path.basename(target_name)] == 1}
+    localized = list()
+    for module in modules:
+        name = names.get(module.name) or by_basename.get(os.path.basename(module.name))
+        if name is not None:
+            localized.append(module._replace(name=name))
+    return localized
+
+def read_module_map() -> List[Module]:
+    """Returns the file-backed mappings of the inferior, named after the local files gdb read their symbols from."""
+    if not current_session().is_native:
+        return _localize_module_map(_read_target_module_map())
+    modules = list()
+    try:
+        with open(f"/proc/{gdb.selected_inferior().pid}/maps") as maps:
+            for mapping in maps:
+                parts = mapping.split(maxsplit=5)
+                if len(parts) < 6 or not parts[5].startswith("/"):
+                    continue
+                start, end = parts[0].split("-")
+                modules.append(Module(int(start, 16), int(end, 16), int(parts[2], 16), parts[5].strip()))
+    except OSError:
+        pass
+    return modules
 
 def parse_number(number: str) -> int:
     if not isinstance(number, str):
@@ -1,11 +1,23 @@
 
 
-# TODO: let the user change this
-MAX_BACKTRACE_FRAMES = 0x4
+# The inferior picks its backtrace depth at startup (MALLOCTRACE_BT_DEPTH) and
+# every heap map records it, so these are only used to configure new processes.
+DEFAULT_BACKTRACE_DEPTH = 0x10
+MAX_BACKTRACE_DEPTH = 0x40
 
+# Distinct backtraces the stack table holds, see MALLOCTRACE_STACK_TABLE_SIZE
+DEFAULT_STACK_TABLE_SIZE = 0x10000
+
+# 0 records every allocation, see MALLOCTRACE_SAMPLE_BYTES
+DEFAULT_SAMPLE_BYTES = 0
+
+# Every per-thread heap map starts at DEFAULT_MAP_SIZE bytes and grows up to DEFAULT_MAP_MAX_SIZE.
 DEFAULT_MAP_SIZE = 0x4000
+DEFAULT_MAP_MAX_SIZE = 0x10000000
 DEFAULT_LOG_LEVEL = "error"
 
+SYMBOL_CACHE_SIZE = 0x1000
+
 LOG_LEVELS = {
     0: "debug",
     1: "info",
@@ -1,6 +1,5 @@
 from malloctrace.cvar import *
 from malloctrace.common import get_malloctrace_objfile
-from malloctrace.constants import MAX_BACKTRACE_FRAMES
 
 
 # typedef struct {
@@ -14,29 +13,73 @@ ChunkCStruct = CStructVar.bind_with_fields([
 
 # typedef struct {
 #   Chunk chunk;
-#   bt backtrace;
+#   uint64_t sequence;
+#   uint64_t timestamp;
+#   pid_t tid;
+#   uint32_t stack_id;
 # } AllocationDesc;
-# typedef struct {
-#   void* frames[MAX_BACKTRACE_FRAMES];
-# } bt;
 AllocationDescCStruct = CStructVar.bind_with_fields([
     CStructField(name="chunk", cvar_type=ChunkCStruct),
-    CStructField(name="backtrace", cvar_type=CUInt64Array.bind_with_size(MAX_BACKTRACE_FRAMES)),
+    CStructField(name="sequence", cvar_type=CUInt64),
+    CStructField(name="timestamp", cvar_type=CUInt64),
+    CStructField(name="tid", cvar_type=CInt32),
+    CStructField(name="stack_id", cvar_type=CUInt32),
 ])
 
 # typedef struct {
 #   void* base;
 #   size_t size;
 #   AllocationDesc* head;
+#   uint32_t* index;
+#   size_t index_capacity;
+#   struct HeapMap* next;
+#   int32_t lock;
+#   pid_t owner;
+#   uint32_t backtrace_depth;
+#   uint32_t entry_size;
+#   uint64_t sample_bytes;
+#   size_t max_size;
+#   uint64_t dropped;
 # } HeapMap;
 HeapMapCStruct = CStructVar.bind_with_fields([
     CStructField(name="base", cvar_type=CVoidPointer),
     CStructField(name="size", cvar_type=CUInt64),
-    CStructField(name="head", cvar_type=CVoidPointer)
+    CStructField(name="head", cvar_type=CVoidPointer),
+    CStructField(name="index", cvar_type=CVoidPointer),
+    CStructField(name="index_capacity", cvar_type=CUInt64),
+    CStructField(name="next", cvar_type=CVoidPointer),
+    CStructField(name="lock", cvar_type=CInt32),
+    CStructField(name="owner", cvar_type=CInt32),
+    CStructField(name="backtrace_depth", cvar_type=CUInt32),
+    CStructField(name="entry_size", cvar_type=CUInt32),
+    CStructField(name="sample_bytes", cvar_type=CUInt64),
+    CStructField(name="max_size", cvar_type=CUInt64),
+    CStructField(name="dropped", cvar_type=CUInt64),
 ])
 
 
 MALLOCTRACE_ACTIVE = CUInt8Symbol("MALLOCTRACE_ACTIVE", objfile_getter=get_malloctrace_objfile)
 MALLOCTRACE_ERR_CODE = CInt8Symbol("MALLOCTRACE_ERR_CODE", objfile_getter=get_malloctrace_objfile)
 MALLOCTRACE_LOG_LEVEL = CUInt8Symbol("MALLOCTRACE_LOG_LEVEL", objfile_getter=get_malloctrace_objfile)
-MALLOCTRACE_HEAP_MAP = CPointerSymbolVar("MALLOCTRACE_HEAP_MAP", wrapped_cvar_type=HeapMapCStruct, objfile_getter=get_malloctrace_objfile)
\ No newline at end of file
+# typedef struct {
+#   uint32_t depth;
+#   uint32_t capacity;
+#   uint32_t count;
+#   uint32_t slot_capacity;
+#   uint64_t dropped;
+#   uint32_t* slots;
+#   void** frames;
+# } StackTable;
+StackTableCStruct = CStructVar.bind_with_fields([
+    CStructField(name="depth", cvar_type=CUInt32),
+    CStructField(name="capacity", cvar_type=CUInt32),
+    CStructField(name="count", cvar_type=CUInt32),
+    CStructField(name="slot_capacity", cvar_type=CUInt32),
+    CStructField(name="dropped", cvar_type=CUInt64),
+    CStructField(name="slots", cvar_type=CVoidPointer),
+    CStructField(name="frames", cvar_type=CVoidPointer),
+])
+
+
+MALLOCTRACE_HEAP_MAP = CPointerSymbolVar("MALLOCTRACE_HEAP_MAP", wrapped_cvar_type=HeapMapCStruct, objfile_getter=get_malloctrace_objfile)
+MALLOCTRACE_STACK_TABLE = CPointerSymbolVar("MALLOCTRACE_STACK_TABLE", wrapped_cvar_type=StackTableCStruct, objfile_getter=get_malloctrace_objfile)
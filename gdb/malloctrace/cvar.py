@@ -1,7 +1,10 @@
 import gdb
+import collections
 import functools
 import dataclasses
-from typing import List, Optional, Type
+import struct
+from typing import Callable, List, Optional, Tuple, Type
+from malloctrace.session import current_session
 
 
 def partialclass(cls, *args, **kwargs):
@@ -11,10 +14,12 @@ def partialclass(cls, *args, **kwargs):
 
 
 class TypeConverter:
-    def __init__(self, value_size_in_bytes ,convert_to_bytes_func, convert_from_bytes_func):
+    def __init__(self, value_size_in_bytes ,convert_to_bytes_func, convert_from_bytes_func, struct_format: Optional[str]=None):
         self.value_size_in_bytes = value_size_in_bytes
         self._convert_to_bytes_func = convert_to_bytes_func
         self._convert_from_bytes_func = convert_from_bytes_func
+        # The struct module format character of this type, used to compile codecs for structs and arrays.
+        self.struct_format = struct_format
 
     def convert_to_bytes(self, value) -> bytes:
         return self._convert_to_bytes_func(value)
@@ -27,26 +32,43 @@ UInt8TypeConverter = TypeConverter(
     value_size_in_bytes=1,
     convert_to_bytes_func=lambda v:int.to_bytes(v, 1, "little", signed=False),
     convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=False),
+    struct_format="B",
 )
 Int8TypeConverter = TypeConverter(
     value_size_in_bytes=1,
     convert_to_bytes_func=lambda v:int.to_bytes(v, 1, "little", signed=True),
     convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=True),
+    struct_format="b",
+)
+UInt32TypeConverter = TypeConverter(
+    value_size_in_bytes=4,
+    convert_to_bytes_func=lambda v:int.to_bytes(v, 4, "little", signed=False),
+    convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=False),
+    struct_format="I",
+)
+Int32TypeConverter = TypeConverter(
+    value_size_in_bytes=4,
+    convert_to_bytes_func=lambda v:int.to_bytes(v, 4, "little", signed=True),
+    convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=True),
+    struct_format="i",
 )
 UInt64TypeConverter = TypeConverter(
     value_size_in_bytes=8,
     convert_to_bytes_func=lambda v:int.to_bytes(v, 8, "little", signed=False),
     convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=False),
+    struct_format="Q",
 )
 Int64TypeConverter = TypeConverter(
     value_size_in_bytes=8,
     convert_to_bytes_func=lambda v:int.to_bytes(v, 8, "little", signed=True),
     convert_from_bytes_func=lambda b:int.from_bytes(b, "little", signed=True),
+    struct_format="q",
 )
 VoidPointerTypeConverter = TypeConverter(
     value_size_in_bytes=8,
     convert_to_bytes_func=lambda v:int.to_bytes(v, 8, "little"),
     convert_from_bytes_func=lambda b:int.from_bytes(b, "little"),
+    struct_format="Q",
 )
 def _raise(e):
     raise e
@@ -58,6 +80,87 @@ VoidTypeConverter = TypeConverter(
 
 
 
+class CCodec:
+    """A precompiled little-endian struct layout for one CVar type.
+
+    A value of the type is read with one read_memory and unpacked with one struct call.
+    `decode` builds the value from the flat tuple of unpacked items starting at a position,
+    `encode` turns a value back into its flat list of items.
+    """
+
+    def __init__(self, format: str, item_count: int, decode: Callable, encode: Callable):
+        self.format = format
+        self.struct = struct.Struct("<" + format)
+        self.size = self.struct.size
+        self.item_count = item_count
+        self.decode = decode
+        self.encode = encode
+
+    def unpack(self, buffer):
+        return self.decode(self.struct.unpack(buffer), 0)
+
+    def pack(self, value) -> bytes:
+        return self.struct.pack(*self.encode(value))
+
+    def unpack_many(self, buffer) -> list:
+        decode = self.decode
+        return [decode(items, 0) for items in self.struct.iter_unpack(buffer)]
+
+
+# Layout keys describe a CVar type independently of its instances:
+#   ("scalar", struct_format)
+#   ("struct", ((name, offset, field_layout_key), ...), size)
+#   ("array", element_layout_key, size)
+@functools.lru_cache(maxsize=None)
+def compile_codec(layout_key: Tuple) -> CCodec:
+    kind = layout_key[0]
+    if kind == "scalar":
+        return CCodec(layout_key[1], 1, lambda items, position: items[position], lambda value: [value])
+    if kind == "array":
+        element, size = compile_codec(layout_key[1]), layout_key[2]
+        if element.item_count == 1 and layout_key[1][0] == "scalar":
+            decode = lambda items, position: list(items[position:position + size])
+            encode = list
+        else:
+            step = element.item_count
+            decode = lambda items, position: [element.decode(items, position + i * step) for i in range(size)]
+            encode = lambda value: [item for element_value in value for item in element.encode(element_value)]
+        return CCodec(element.format * size, element.item_count * size, decode, encode)
+    if kind == "struct":
+        fields, size = layout_key[1], layout_key[2]
+        names = [name for name, _, _ in fields]
+        record = collections.namedtuple("CStruct", names, rename=True)
+        format_parts = list()
+        field_codecs = list()
+        next_offset = 0
+        for _, offset, field_key in fields:
+            field_codec = compile_codec(field_key)
+            if offset < next_offset:
+                raise ValueError("struct fields must not overlap")
+            if offset > next_offset:
+                format_parts.append(f"{offset - next_offset!s}x")
+            format_parts.append(field_codec.format)
+            field_codecs.append(field_codec)
+            next_offset = offset + field_codec.size
+        if size > next_offset:
+            format_parts.append(f"{size - next_offset!s}x")
+        item_count = sum(field_codec.item_count for field_codec in field_codecs)
+        if all(field_key[0] == "scalar" for _, _, field_key in fields):
+            decode = lambda items, position: record._make(items[position:position + item_count])
+        else:
+            def decode(items, position):
+                values = list()
+                for field_codec in field_codecs:
+                    values.append(field_codec.decode(items, position))
+                    position += field_codec.item_count
+                return record._make(values)
+        def encode(value):
+            if hasattr(value, "_asdict"):
+                value = value._asdict()
+            return [item for name, field_codec in zip(names, field_codecs) for item in field_codec.encode(value[name])]
+        return CCodec("".join(format_parts), item_count, decode, encode)
+    raise ValueError(f"Unknown layout kind {kind!s}")
+
 
 class CVar:
     @classmethod
@@ -105,6 +208,24 @@ class CVar:
     def get(self):
         return self.type_converter.convert_from_bytes(self.get_tobytes())
 
+    @property
+    def layout_key(self) -> Tuple:
+        if self.type_converter.struct_format is None:
+            raise ValueError("This CVar has no struct layout")
+        return ("scalar", self.type_converter.struct_format)
+
+    @property
+    def codec(self) -> CCodec:
+        return compile_codec(self.layout_key)
+
+    def get_many(self, address: int, count: int) -> list:
+        """Reads `count` consecutive values of this type starting at `address` with a single read_memory."""
+        codec = self.codec
+        if count == 0:
+            return list()
+        buffer = gdb.selected_inferior().read_memory(address, codec.size * count)
+        return codec.unpack_many(buffer)
+
 
 class CPointerVar(CVar):
     @classmethod
@@ -144,7 +265,15 @@ class CStructVar(CVar):
         assert len(set(map(lambda f:f.name, fields))) == len(fields), "struct field names must be unique"
         # Copy fields cvar instances over, so they don't get modified by two CVars using the same CStruct blueprint
         self.fields = list(map(lambda f:self._CStructField(f.name, f.cvar_type(), f.offset), fields))
-        self._total_size = None
+        self._fields_by_name = {field.name: field for field in self.fields}
+        self._field_offsets = dict()
+        next_offset = 0
+        for field in self.fields:
+            offset = field.offset if field.offset is not None else next_offset
+            self._field_offsets[field.name] = offset
+            next_offset = offset + field.cvar.value_size_in_bytes
+        self._total_size = next_offset
+        self._layout_key = ("struct", tuple((field.name, self._field_offsets[field.name], field.cvar.layout_key) for field in self.fields), self._total_size)
         super().__init__(VoidTypeConverter, address=address)
         if address is not None:
             self._update_field_addresses()
@@ -156,45 +285,47 @@ class CStructVar(CVar):
             self._update_field_addresses()
     
     def _update_field_addresses(self):
-        next_address = self.address
         for field in self.fields:
-            if field.offset is not None:
-                field.cvar.address = self.address + field.offset
-            else:
-                field.cvar.address = next_address
-            next_address = field.cvar.address + field.cvar.value_size_in_bytes
-        self._total_size = next_address - self.address
-    
+            field.cvar.address = self.address + self._field_offsets[field.name]
+
     @property
     def value_size_in_bytes(self):
-        self._assert_has_address()
         return self._total_size
 
+    @property
+    def layout_key(self) -> Tuple:
+        return self._layout_key
+
+    def _get_field(self, field_name):
+        field = self._fields_by_name.get(field_name)
+        if field is None:
+            raise ValueError(f"Unknown struct field {field_name!s}")
+        return field
+
     def set_field(self, field_name, value):
         self._assert_has_address()
-        for field in self.fields:
-            if field.name == field_name:
-                field.cvar.set(value)
-                return
+        self._get_field(field_name).cvar.set(value)
     
     def get_field(self, field_name):
         self._assert_has_address()
-        for field in self.fields:
-            if field.name == field_name:
-                return field.cvar.get()
+        return self._get_field(field_name).cvar.get()
     
     def set(self, value):
+        """Sets all fields given in `value` (a mapping or a record returned by get)."""
         self._assert_has_address()
+        if hasattr(value, "_asdict"):
+            value = value._asdict()
+        if value.keys() == self._fields_by_name.keys():
+            # The whole struct is given, so it can be written at once.
+            self.set_frombytes(self.codec.pack(value))
+            return
         for field_name, field_value in value.items():
             self.set_field(field_name, field_value)
 
     def get(self):
+        """Reads the whole struct at once and returns it as a record with one attribute per field."""
         self._assert_has_address()
-        # TODO: maybe don't use dict, but namedtuple or some other dataclass where i can use .value instead of ['value']
-        value = dict()
-        for field in self.fields:
-            value[field.name] = field.cvar.get()
-        return value
+        return self.codec.unpack(self.get_tobytes())
 
 
 class CArrayVar(CVar):
@@ -217,6 +348,10 @@ class CArrayVar(CVar):
     def value_size_in_bytes(self):
         return self.contained_cvar.value_size_in_bytes * self.size
 
+    @property
+    def layout_key(self) -> Tuple:
+        return ("array", self.contained_cvar.layout_key, self.size)
+
     def set_index(self, index: int, value):
         self._assert_has_address()
         element_address = self.address + (self.contained_cvar.value_size_in_bytes * index)
@@ -231,14 +366,12 @@ class CArrayVar(CVar):
 
     def set(self, value: list):
         assert len(value) == self.size, "Please use an array that has the same size as specified"
-        for index, element in value:
-            self.set_index(index, element)
+        self._assert_has_address()
+        self.set_frombytes(self.codec.pack(value))
 
     def get(self) -> list:
-        value = list()
-        for index in range(self.size):
-            value.append(self.get_index(index))
-        return value
+        self._assert_has_address()
+        return self.codec.unpack(self.get_tobytes())
     
 
 class CSymbolVar(CVar):
@@ -246,7 +379,8 @@ class CSymbolVar(CVar):
         self.name = name
         self.objfile_getter = objfile_getter
         CVar.__init__(self, type_converter)
-        self.symbol = self._load_symbol()
+        # Looked up on first access, the plugin creates these at import time.
+        self.symbol = None
     
     def _load_symbol(self):
         if self.objfile_getter is not None:
@@ -265,10 +399,14 @@ class CSymbolVar(CVar):
     def _get_value(self) -> gdb.Value:
         return self.symbol.value()
     
-    def _get_value_address(self) -> int:
+    def _resolve_value_address(self) -> int:
         self._load_symbol_if_needed()
         return int(self._get_value().address)
 
+    def _get_value_address(self) -> int:
+        # Symbols only move when objfiles change, so the session keeps their addresses.
+        return current_session().symbol_address(self.name, self._resolve_value_address)
+
 
 class CPointerSymbolVar(CSymbolVar, CPointerVar):
     def __init__(self, name: str, wrapped_cvar_type: Type[CVar]=None, objfile_getter=None):
@@ -288,6 +426,8 @@ class CArraySymbolVar(CSymbolVar, CArrayVar):
 
 CUInt8 = CVar.bind_with_type_converter(UInt8TypeConverter)
 CInt8 = CVar.bind_with_type_converter(Int8TypeConverter)
+CUInt32 = CVar.bind_with_type_converter(UInt32TypeConverter)
+CInt32 = CVar.bind_with_type_converter(Int32TypeConverter)
 CUInt64 = CVar.bind_with_type_converter(UInt64TypeConverter)
 CInt64 = CVar.bind_with_type_converter(Int64TypeConverter)
 CVoid = CVar.bind_with_type_converter(VoidTypeConverter)
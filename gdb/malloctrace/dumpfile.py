@@ -0,0 +1,164 @@
+"""Binary heap map dump format, 8 byte aligned sections so the entries can be used straight from an mmap.
+
+    Header     DUMP_HEADER
+    Entries    entry_count AllocationDesc structs of entry_size bytes (native byte order)
+    Stacks     stack_count stacks of frame_count words, indexed by stack id
+    Sites      site_count SITE_RECORD (exit-time reports only, which have no entries)
+    Symbols    symbol_count SYMBOL_RECORD, sorted by pc
+    Modules    module_count MODULE_RECORD
+    Strings    referenced by the symbol and module records
+"""
+import bisect
+import mmap
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from malloctrace.snapshot import HeapSnapshot, SnapshotLayoutError, StackTotals
+from malloctrace.symbols import Module, Symbolization
+
+
+DUMP_MAGIC = b"MTRDUMP\0"
+DUMP_VERSION = 7
+
+# magic, version, frame_count, entry_size, entry_count, entries_offset, stack_count, stacks_offset, site_count, sites_offset, symbol_count, symbols_offset,
+# module_count, modules_offset, strings_size, strings_offset, sample_bytes (0 if every allocation was recorded)
+DUMP_HEADER = struct.Struct("<8sIII4xQQQQQQQQQQQQQ")
+# stack_id, count, bytes (estimates if sample_bytes != 0)
+SITE_RECORD = struct.Struct("<I4xQQ")
+# pc, line, symbol_offset, symbol_size, filename_offset, filename_size (filename_size == 0 means no source line)
+SYMBOL_RECORD = struct.Struct("<QIIIII4x")
+# start, end, file_offset, name_offset, name_size
+MODULE_RECORD = struct.Struct("<QQQII")
+
+ALIGNMENT = 8
+
+
+class DumpFormatError(ValueError):
+    pass
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) & ~(ALIGNMENT - 1)
+
+
+class _StringTable:
+    def __init__(self):
+        self.data = bytearray()
+        self._offsets: Dict[str, int] = dict()
+
+    def add(self, string: Optional[str]):
+        if not string:
+            return 0, 0
+        encoded = string.encode()
+        if string not in self._offsets:
+            self._offsets[string] = len(self.data)
+            self.data += encoded
+        return self._offsets[string], len(encoded)
+
+
+def write_dump(path: str, snapshot: HeapSnapshot, symbols: Dict[int, Symbolization], modules: Iterable[Module]):
+    strings = _StringTable()
+    symbol_records = bytearray()
+    for pc in sorted(symbols):
+        symbolization = symbols[pc]
+        symbol_offset, symbol_size = strings.add(symbolization.symbol)
+        filename_offset, filename_size = strings.add(symbolization.filename)
+        symbol_records += SYMBOL_RECORD.pack(pc, symbolization.line, symbol_offset, symbol_size, filename_offset, filename_size)
+    module_records = bytearray()
+    modules = list(modules)
+    for module in modules:
+        name_offset, name_size = strings.add(module.name)
+        module_records += MODULE_RECORD.pack(module.start, module.end, module.offset, name_offset, name_size)
+
+    entries = snapshot.buffer
+    stacks = snapshot.stacks_buffer
+    entries_offset = _align(DUMP_HEADER.size)
+    stacks_offset = _align(entries_offset + len(entries))
+    sites_offset = _align(stacks_offset + len(stacks))
+    symbols_offset = sites_offset
+    modules_offset = _align(symbols_offset + len(symbol_records))
+    strings_offset = _align(modules_offset + len(module_records))
+    header = DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, snapshot.frame_count, snapshot.entry_size, len(snapshot), entries_offset, len(snapshot.stacks), stacks_offset, 0,
+        sites_offset, len(symbols), symbols_offset, len(modules), modules_offset, len(strings.data), strings_offset, snapshot.sample_bytes)
+
+    with open(path, "wb") as file:
+        for offset, section in ((0, header), (entries_offset, entries), (stacks_offset, stacks), (symbols_offset, symbol_records), (modules_offset, module_records), (strings_offset, strings.data)):
+            file.write(bytes(offset - file.tell()))
+            file.write(section)
+
+
+class DumpFile:
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._view) < DUMP_HEADER.size:
+            raise DumpFormatError(f"{path!s} is too small to be a malloctrace dump")
+        (magic, self.version, self.frame_count, entry_size, entry_count, entries_offset, stack_count, stacks_offset, site_count, sites_offset, self._symbol_count,
+            self._symbols_offset, self._module_count, self._modules_offset, strings_size, strings_offset, self.sample_bytes) = DUMP_HEADER.unpack_from(self._view)
+        if magic != DUMP_MAGIC:
+            raise DumpFormatError(f"{path!s} is not a malloctrace dump")
+        if self.version != DUMP_VERSION:
+            raise DumpFormatError(f"Unsupported dump version {self.version!s}, expected {DUMP_VERSION!s}")
+        entries_size = entry_count * entry_size
+        stacks_size = stack_count * self.frame_count * HeapSnapshot.WORD_SIZE
+        try:
+            self.snapshot = HeapSnapshot(self._view[entries_offset:entries_offset + entries_size], self._view[stacks_offset:stacks_offset + stacks_size],
+                self.frame_count, self.sample_bytes, entry_size)
+        except SnapshotLayoutError as e:
+            raise DumpFormatError(f"{path!s}: {e!s}") from e
+        # (stack id, bytes, count)
+        self.sites: List[Tuple[int, int, int]] = list()
+        for index in range(site_count):
+            stack_id, count, size = SITE_RECORD.unpack_from(self._view, sites_offset + index * SITE_RECORD.size)
+            self.sites.append((stack_id, size, count))
+        self._strings = self._view[strings_offset:strings_offset + strings_size]
+        self._symbol_pcs = [SYMBOL_RECORD.unpack_from(self._view, self._symbols_offset + i * SYMBOL_RECORD.size)[0] for i in range(self._symbol_count)]
+        # Symbols resolved after the dump was written, see add_symbols.
+        self._added_symbols: Dict[int, Symbolization] = dict()
+
+    @property
+    def is_report(self) -> bool:
+        return bool(self.sites)
+
+    def stack_totals(self, depth: Optional[int] = None) -> List[StackTotals]:
+        if self.is_report:
+            return self.snapshot.stack_totals(depth, self.sites)
+        return self.snapshot.stack_totals(depth)
+
+    def _string(self, offset: int, size: int) -> Optional[str]:
+        if size == 0:
+            return None
+        return bytes(self._strings[offset:offset + size]).decode()
+
+    def add_symbols(self, symbols: Dict[int, Symbolization]):
+        self._added_symbols.update(symbols)
+
+    def symbolize(self, pc: int) -> Optional[Symbolization]:
+        index = bisect.bisect_left(self._symbol_pcs, pc)
+        if index == len(self._symbol_pcs) or self._symbol_pcs[index] != pc:
+            return self._added_symbols.get(pc)
+        _, line, symbol_offset, symbol_size, filename_offset, filename_size = SYMBOL_RECORD.unpack_from(self._view, self._symbols_offset + index * SYMBOL_RECORD.size)
+        return Symbolization(self._string(symbol_offset, symbol_size), self._string(filename_offset, filename_size), line)
+
+    @property
+    def modules(self) -> List[Module]:
+        modules = list()
+        for index in range(self._module_count):
+            start, end, offset, name_offset, name_size = MODULE_RECORD.unpack_from(self._view, self._modules_offset + index * MODULE_RECORD.size)
+            modules.append(Module(start, end, offset, self._string(name_offset, name_size)))
+        return modules
+
+    def close(self):
+        # Drop every view into the mapping first, otherwise it can't be closed.
+        self.snapshot = None
+        self._strings.release()
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import gdb
+import time
+from typing import Iterator, NamedTuple, Optional, Tuple
+from malloctrace.ctypedefs import MALLOCTRACE_HEAP_MAP, MALLOCTRACE_STACK_TABLE, HeapMapCStruct, StackTableCStruct
+from malloctrace.common import assert_malloctrace_loaded, assert_inferior_writable, has_live_process
+from malloctrace.session import current_session
+from malloctrace.snapshot import HeapSnapshot
+
+
+# The heap maps are walked here, on bulk reads of the inferior's memory, rather
+# than by calling into libmalloctrace.so. Loading the library into gdb would
+# interpose malloc and free on gdb itself, and it only works if gdb and the
+# inferior share an ABI. See src/heap_map.h and src/stack_table.h for the layouts.
+
+INDEX_SLOT_SIZE = 4
+
+# Unbound, only used to read values at the addresses they are given.
+HEAP_MAP = HeapMapCStruct()
+STACK_TABLE = StackTableCStruct()
+
+
+class CapacityDesc(NamedTuple):
+    free_bytes: int = 0
+    free_entries: int = 0
+    total_bytes: int = 0
+    total_entries: int = 0
+    max_bytes: int = 0
+    max_entries: int = 0
+    dropped: int = 0
+
+
+def read_heap_maps() -> Iterator[Tuple[int, Tuple]]:
+    """Yields (address, HeapMap) for every per-thread heap map of the inferior."""
+    address = current_session().heap_map_list(MALLOCTRACE_HEAP_MAP.get)
+    while address:
+        heap_map, = HEAP_MAP.get_many(address, 1)
+        yield address, heap_map
+        address = heap_map.next
+
+def read_stack_table_header():
+    """The StackTable of the inferior, None before it was created."""
+    address = MALLOCTRACE_STACK_TABLE.get()
+    if not address:
+        return None
+    stack_table, = STACK_TABLE.get_many(address, 1)
+    return stack_table
+
+def read_stack_table() -> Tuple[int, bytes]:
+    """Returns the backtrace depth and the frames of every stack of the inferior, read with a single read_memory."""
+    stack_table = read_stack_table_header()
+    if stack_table is None:
+        return 0, b""
+    # Ids past the capacity were claimed in vain, see src/stack_table.h
+    size = min(stack_table.count, stack_table.capacity) * stack_table.depth * HeapSnapshot.WORD_SIZE
+    if size == 0:
+        return stack_table.depth, b""
+    return stack_table.depth, gdb.selected_inferior().read_memory(stack_table.frames, size).tobytes()
+
+def _read_used_region(heap_map) -> bytes:
+    # Only [base, head) holds entries, so there is no need to read the whole map.
+    # The data mapping moves when it grows, so base always has to come from a fresh HeapMap.
+    if heap_map.head <= heap_map.base:
+        return b""
+    return gdb.selected_inferior().read_memory(heap_map.base, heap_map.head - heap_map.base).tobytes()
+
+
+# The heap map can only change while the inferior runs, so the last snapshot
+# stays valid until it is resumed, exits, or its memory gets written.
+_cached_snapshot = None
+
+def invalidate_heap_snapshot(*_):
+    global _cached_snapshot
+    _cached_snapshot = None
+
+gdb.events.cont.connect(invalidate_heap_snapshot)
+gdb.events.exited.connect(invalidate_heap_snapshot)
+gdb.events.inferior_call.connect(invalidate_heap_snapshot)
+gdb.events.memory_changed.connect(invalidate_heap_snapshot)
+# Loading another core file swaps the memory without the inferior ever running.
+gdb.events.new_objfile.connect(invalidate_heap_snapshot)
+gdb.events.clear_objfiles.connect(invalidate_heap_snapshot)
+
+def read_heap_snapshot() -> HeapSnapshot:
+    global _cached_snapshot
+    assert_malloctrace_loaded()
+    if _cached_snapshot is not None:
+        return _cached_snapshot
+    # Merge the used regions of all thread heap maps into one view.
+    regions = list()
+    sample_bytes = 0
+    entry_size = HeapSnapshot.ENTRY_SIZE
+    for _, heap_map in read_heap_maps():
+        sample_bytes = heap_map.sample_bytes
+        entry_size = heap_map.entry_size
+        regions.append(_read_used_region(heap_map))
+    # The entries only refer to their backtraces, which are decoded once per snapshot.
+    backtrace_depth, stacks = read_stack_table()
+    _cached_snapshot = HeapSnapshot(b"".join(regions), stacks, backtrace_depth, sample_bytes, entry_size)
+    return _cached_snapshot
+
+def heap_map_now() -> Optional[int]:
+    """The current time of the clock the entries are timestamped with, None if it can't be read (e.g. a core file or a remote target).
+
+    CLOCK_MONOTONIC_COARSE only lags CLOCK_MONOTONIC by a tick, both count from the same
+    point, and gdb shares it with the inferior as long as they run on the same host.
+    Without it ages are measured from the newest entry instead.
+    """
+    if not has_live_process() or not current_session().is_native:
+        return None
+    return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+
+def heap_map_capacity() -> CapacityDesc:
+    """Sums up the capacity of all heap maps, like heap_map_capacity in src/heap_map.c does for one."""
+    assert_malloctrace_loaded()
+    result = CapacityDesc()
+    for _, heap_map in read_heap_maps():
+        data_size = heap_map.index + heap_map.index_capacity * INDEX_SLOT_SIZE - heap_map.base
+        # Entries take the same share of the data mapping at any size.
+        max_entries = int(heap_map.max_size / data_size * heap_map.size) // heap_map.entry_size if data_size else 0
+        free_bytes = heap_map.size - (heap_map.head - heap_map.base)
+        capacity_desc = CapacityDesc(
+            free_bytes=free_bytes,
+            free_entries=free_bytes // heap_map.entry_size,
+            total_bytes=heap_map.size,
+            total_entries=heap_map.size // heap_map.entry_size,
+            max_bytes=max_entries * heap_map.entry_size,
+            max_entries=max_entries,
+            dropped=heap_map.dropped,
+        )
+        result = CapacityDesc(*map(sum, zip(result, capacity_desc)))
+    return result
+
+def heap_map_clear():
+    """Empties all heap maps: zeroes their index and moves their head back to base, like heap_map_clear in src/heap_map.c."""
+    assert_inferior_writable()
+    inferior = gdb.selected_inferior()
+    for address, heap_map in read_heap_maps():
+        index_size = heap_map.index_capacity * INDEX_SLOT_SIZE
+        inferior.write_memory(heap_map.index, bytes(index_size), index_size)
+        HeapMapCStruct(address=address).set_field("head", heap_map.base)
+    invalidate_heap_snapshot()
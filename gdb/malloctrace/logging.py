@@ -1,3 +1,4 @@
+import functools
 import gdb
 
 _reset = "\033[0m"
@@ -12,6 +13,7 @@ _color_names_to_ansi_codes = {
     "white": "\033[37m",
 }
 
+@functools.lru_cache(maxsize=None)
 def get_gdb_style_color_for_categroy(category: str):
     output = gdb.execute(f"show style {category} foreground", to_string=True)
     parts = output.split(":")
@@ -25,10 +27,17 @@ def _color_code_wrapper(color_code):
     return wrapper
 
 
-_highlight = _color_code_wrapper(get_gdb_style_color_for_categroy("highlight"))
-_address = _color_code_wrapper(get_gdb_style_color_for_categroy("address"))
-_function = _color_code_wrapper(get_gdb_style_color_for_categroy("function"))
-_filename = _color_code_wrapper(get_gdb_style_color_for_categroy("filename"))
+def _style_wrapper(category: str):
+    # The style is only looked up on first use, so importing the plugin does not have to ask gdb for it.
+    def wrapper(msg: str):
+        return _reset + get_gdb_style_color_for_categroy(category) + msg + _reset
+    return wrapper
+
+
+_highlight = _style_wrapper("highlight")
+_address = _style_wrapper("address")
+_function = _style_wrapper("function")
+_filename = _style_wrapper("filename")
 
 _black = _color_code_wrapper(_color_names_to_ansi_codes["black"])
 _red = _color_code_wrapper(_color_names_to_ansi_codes["red"])
@@ -1,12 +1,18 @@
+import dataclasses
+import heapq
+import operator
+from typing import List
 from malloctrace.command import command, argparser
 from malloctrace.exceptions import on_error_show_error_message
-from malloctrace.common import has_process, assert_malloctrace_loaded, bt_line_for_address, has_malloctrace_objfile_loaded, warn_no_malloctrace_objfile_loaded_and_defered_change, parse_number
+from malloctrace.common import has_process, has_live_process, is_core_file, warn_core_file_is_read_only, assert_malloctrace_loaded, bt_line_for_address, has_malloctrace_objfile_loaded, warn_no_malloctrace_objfile_loaded_and_defered_change, parse_number, symbol_cache_info, invalidate_symbol_cache, symbolize_address, prefetch_symbols, read_module_map, read_thread_names
 from malloctrace.constants import ERR_CODES, LOG_LEVELS, REVERSE_LOG_LEVELS, DEFAULT_LOG_LEVEL
 from malloctrace.environment import get_ld_preload, set_ld_preload, inferior_set_env, inferior_get_env
 from malloctrace.ctypedefs import *
 from malloctrace.logging import _address, _reset, _color_bool, _blue, malloctrace_warning, malloctrace_info, malloctrace_error
 from malloctrace.params import MALLOCTRACE_OBJFILE_NAME_PARAM
-from malloctrace.cbridge import c_heap_map_capacity, c_heap_map_clear, c_heap_map_for_each, c_heap_map_for_each_in_range
+from malloctrace.heap_map import heap_map_capacity, heap_map_clear, heap_map_now, read_heap_snapshot, read_heap_maps, read_stack_table_header
+from malloctrace.snapshot import MAX_ADDRESS, EntryFilter, HeapSnapshot, diff_snapshots, format_duration, is_symbol_frame, match_frames
+from malloctrace.dumpfile import write_dump
 
 
 @command.GDBPrefixCommand("malloctrace", "Trace Heap", aliases=["mtrace", "mtr"])
@@ -22,7 +28,9 @@ def malloctrace_on(_):
         ld_preload.add(MALLOCTRACE_OBJFILE_NAME_PARAM.value)
         set_ld_preload(ld_preload)
 
-    if has_process():
+    if is_core_file():
+        warn_core_file_is_read_only()
+    elif has_process():
         if has_malloctrace_objfile_loaded():
             MALLOCTRACE_ACTIVE.set(1)
             return
@@ -37,7 +45,9 @@ def malloctrace_off(_):
         ld_preload.remove(MALLOCTRACE_OBJFILE_NAME_PARAM.value)
         set_ld_preload(ld_preload)
 
-    if has_process():
+    if is_core_file():
+        warn_core_file_is_read_only()
+    elif has_process():
         if has_malloctrace_objfile_loaded():
             MALLOCTRACE_ACTIVE.set(0)
             return
@@ -66,20 +76,22 @@ def malloctrace_log_level(args):
         if args.log_level not in REVERSE_LOG_LEVELS.keys():
             malloctrace_error(f"Unknown log level: '{args.log_level!s}'")
             return
-        if has_process():
+        if has_live_process():
             if has_malloctrace_objfile_loaded():
                 log_level = REVERSE_LOG_LEVELS.get(args.log_level)
                 MALLOCTRACE_LOG_LEVEL.set(log_level)
                 return
             warn_no_malloctrace_objfile_loaded_and_defered_change()
         else:
+            if is_core_file():
+                warn_core_file_is_read_only()
             inferior_set_env("MALLOCTRACE_LOG_LEVEL", args.log_level)
 
 
 @command.GDBSubCommand("malloctrace clear", "clear the heap map", short_description="clear the heap map")
 @on_error_show_error_message(ValueError)
 def malloctrace_clear(_):
-    c_heap_map_clear()
+    heap_map_clear()
 
 
 @command.GDBSubCommand("malloctrace status", "show status", short_description="show status")
@@ -92,69 +104,379 @@ def malloctrace_status(_):
     print(f"Active: {str(is_active)}")
     print(f"Error code: {err_code!s}")
     print(f"Log Level: {log_level!s}")
+    sample_bytes = next((heap_map.sample_bytes for _, heap_map in read_heap_maps()), 0)
+    print(f"Sampling: {'off' if sample_bytes == 0 else f'about one allocation every {_blue(hex(sample_bytes))} bytes'}")
 
 
 @command.GDBSubCommand("malloctrace capacity", "Show current heap map capacity", short_description="show current heap map capacity")
 @on_error_show_error_message(Exception)
 def malloctrace_capacity(args):
-    capacity_desc = c_heap_map_capacity()
+    capacity_desc = heap_map_capacity()
     print(f"total capacity: {_blue(hex(capacity_desc.total_bytes))} bytes / {_blue(hex(capacity_desc.total_entries))} backtrace entries")
     print(f"free capacity: {_blue(hex(capacity_desc.free_bytes))} bytes / {_blue(hex(capacity_desc.free_entries))} backtrace entries")
+    print(f"maximum capacity: {_blue(hex(capacity_desc.max_bytes))} bytes / {_blue(hex(capacity_desc.max_entries))} backtrace entries")
+    if capacity_desc.dropped:
+        malloctrace_warning(f"{capacity_desc.dropped!s} allocations were dropped because a heap map could not grow any further")
+    stack_table = read_stack_table_header()
+    if stack_table is not None:
+        print(f"stack table: {_blue(hex(min(stack_table.count, stack_table.capacity)))} / {_blue(hex(stack_table.capacity))} backtraces")
+        if stack_table.dropped:
+            malloctrace_warning(f"{stack_table.dropped!s} allocations were recorded without a backtrace because the stack table is full")
 
 
-def print_allocation(allocation):
-    chunk = allocation.chunk
-    backtrace = allocation.backtrace
+def print_frames(frames):
+    for index, frame_pc in enumerate(frames):
+        # Backtraces shorter than the recorded depth are padded with zeros.
+        if frame_pc == 0:
+            break
+        print(f"{_reset}#{index!s}  {bt_line_for_address(frame_pc)}")
+
+def approximately(snapshot):
+    # Totals of a sampled heap map are estimates.
+    return "~" if snapshot.is_sampled else ""
+
+def print_sample_estimate(snapshot, indices=None):
+    if not snapshot.is_sampled:
+        return
+    recorded = len(snapshot) if indices is None else len(indices)
+    estimated_bytes, estimated_count = snapshot.estimated_totals(indices)
+    malloctrace_info(f"Sampled heap map (about one allocation every {hex(snapshot.sample_bytes)} bytes): "
+        f"{recorded!s} recorded chunks stand for ~{hex(estimated_bytes)} bytes in ~{estimated_count!s} chunks")
 
-    chunk_addr = chunk.address
-    chunk_size = chunk.size
+def print_allocation(allocation, now=None):
     print(f"{_reset}------------------")
-    print(f"{_reset}Chunk @ {_address(hex(chunk_addr))} - size: {hex(chunk_size)}")
-    for index, frame_pc in enumerate(backtrace.frames):
-        print(f"{_reset}#{index!s}  {bt_line_for_address(frame_pc)}")
+    age = "" if now is None else f" - age: {_blue(format_duration(max(now - allocation.timestamp, 0)))} (allocation #{allocation.sequence!s})"
+    print(f"{_reset}Chunk @ {_address(hex(allocation.address))} - size: {hex(allocation.size)} - thread: {allocation.tid!s}{age}")
+    print_frames(allocation.frames)
+
+
+@dataclasses.dataclass
+class ShowCursor:
+    """Remembers where the last 'malloctrace show' stopped, so the next page continues from there."""
+    snapshot: HeapSnapshot
+    query: tuple
+    count: int
+    indices: List[int]
+    position: int = 0
+
+    def is_valid(self):
+        return self.snapshot is read_heap_snapshot()
+
+    def is_exhausted(self):
+        return self.position >= len(self.indices)
+
+    def continues(self, args):
+        return (self.query, self.count) == (show_query(args), args.count) and self.is_valid() and not self.is_exhausted()
+
+    def print_page(self):
+        page_end = len(self.indices) if self.count == 0 else min(self.position + self.count, len(self.indices))
+        page = self.indices[self.position:page_end]
+        prefetch_symbols(frame_pc for index in page for frame_pc in self.snapshot.frames_at(index))
+        for index in page:
+            print_allocation(self.snapshot[index])
+        self.position = page_end
+        if self.is_exhausted():
+            malloctrace_info(f"No more entries")
+
+_show_cursor = None
 
+def show_query(args) -> tuple:
+    return (args.start_addr, args.end_addr, args.min_size, args.max_size, tuple(args.frame), tuple(args.thread), args.sort, args.limit)
 
+def frame_symbol(pc: int) -> str:
+    return symbolize_address(pc).symbol
 
-# TODO: maybe make extra c function for this and call it
-def heap_map_is_empty():
-    capacity_desc = c_heap_map_capacity()
-    return capacity_desc.free_bytes == capacity_desc.total_bytes
+def build_entry_filter(snapshot: HeapSnapshot, args) -> EntryFilter:
+    """Compiles the predicates of 'malloctrace show' into one filter, frames given by symbol are resolved against all frames of the snapshot."""
+    frame_pcs = tuple()
+    if args.frame:
+        unique_frames = snapshot.unique_frames()
+        if any(map(is_symbol_frame, args.frame)):
+            prefetch_symbols(unique_frames)
+        frame_pcs = tuple(match_frames(unique_frames, frame, frame_symbol) for frame in args.frame)
+    return EntryFilter(args.start_addr, args.end_addr, args.min_size, args.max_size, frame_pcs, frozenset(args.thread))
 
 parser = argparser.GDBArgumentParser(
     prog="malloctrace show",
-    description="This command shows the traced heap map", 
+    description="This command shows the traced heap map in address order, or the largest or oldest chunks first. The chunks can be filtered by address, size, the frames of their backtrace and the thread that allocated them. Repeating the command (e.g. by pressing Enter) shows the next chunks.", 
     short_description="show heap map",
     add_help=False
 )
-parser.add_argument("start_addr", type=parse_number, help="The address to begin with")
-parser.add_argument("end_addr", type=parse_number, help="The address to end with")
-parser.add_argument("count", type=parse_number, help="The number of chunks to print", nargs="?", default=10)
+parser.add_argument("start_addr", type=parse_number, help="The address to begin with", nargs="?", default=0)
+parser.add_argument("end_addr", type=parse_number, help="The address to end with", nargs="?", default=MAX_ADDRESS)
+parser.add_argument("count", type=parse_number, help="The number of chunks to print per page", nargs="?", default=10)
+parser.add_argument("--min-size", type=parse_number, default=0, help="Only show chunks of at least this many bytes")
+parser.add_argument("--max-size", type=parse_number, default=MAX_ADDRESS, help="Only show chunks of at most this many bytes")
+parser.add_argument("--frame", action="append", default=list(),
+    help="Only show chunks with a frame at this pc, within this pc range <start>-<end>, or in this function (wildcards allowed). Given more than once, every one has to match")
+parser.add_argument("--thread", action="append", type=parse_number, default=list(), help="Only show chunks allocated by the thread with this tid (LWP). Given more than once, any one may match")
+parser.add_argument("--sort", choices=["address", "size", "age"], default="address", help="Show the chunks in address order, the largest or the oldest first")
+parser.add_argument("--limit", type=parse_number, default=None, help="Show at most this many chunks in total")
 @command.GDBPrefixCommand("malloctrace show", parser)
 @on_error_show_error_message(Exception)
 def malloctrace_show(args):
-    # TODO: make this command not reapeating, and instead paginating
-    if heap_map_is_empty():
+    global _show_cursor
+    if _show_cursor is not None and _show_cursor.continues(args):
+        _show_cursor.print_page()
+        return
+
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
         malloctrace_info(f"No entries")
         return
 
-    def f(allocation):
-        print_allocation(allocation)
-        args.count -= 1
-        return args.count != 0
+    indices = snapshot.select(build_entry_filter(snapshot, args), args.sort, args.limit)
+    if len(indices) == 0:
+        malloctrace_info(f"No matching entries")
+        return
+    print_sample_estimate(snapshot, indices)
+    _show_cursor = ShowCursor(snapshot, show_query(args), args.count, indices)
+    _show_cursor.print_page()
+
 
-    c_heap_map_for_each_in_range(f, args.start_addr, args.end_addr)
+@command.GDBSubCommand("malloctrace show next", "Continue the last 'malloctrace show' where it stopped", short_description="show next chunks")
+@on_error_show_error_message(Exception)
+def malloctrace_show_next(_):
+    if _show_cursor is None or not _show_cursor.is_valid():
+        malloctrace_error("Nothing to continue. Run 'malloctrace show <start_addr> <end_addr>' first.")
+        return
+    if _show_cursor.is_exhausted():
+        malloctrace_info(f"No more entries")
+        return
+    _show_cursor.print_page()
 
 
 @command.GDBSubCommand("malloctrace show all", "showall", short_description="showall")
 @on_error_show_error_message(Exception)
 def malloctrace_showall(_):
-    if heap_map_is_empty():
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
         malloctrace_info(f"No entries")
         return
 
-    def f(allocation):
+    print_sample_estimate(snapshot)
+    prefetch_symbols(snapshot.unique_frames())
+    for allocation in snapshot:
         print_allocation(allocation)
-        return True
 
-    c_heap_map_for_each(f)
 
+
+def print_stack_totals(rank, stack_totals, approx=""):
+    print(f"{_reset}------------------")
+    print(f"{_reset}#{rank!s} {approx}{_blue(hex(stack_totals.bytes))} bytes in {approx}{_blue(str(stack_totals.count))} chunks")
+    print_frames(stack_totals.frames)
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace top",
+    description="This command shows the allocation sites holding the most live memory",
+    short_description="show top allocation sites",
+    add_help=False
+)
+parser.add_argument("--by", choices=["bytes", "count"], default="bytes", help="Rank allocation sites by live bytes or by live chunk count")
+parser.add_argument("--depth", type=parse_number, default=None, help="Group by the first N frames instead of the full backtrace")
+parser.add_argument("-n", dest="count", type=parse_number, default=10, help="The number of allocation sites to print")
+@command.GDBSubCommand("malloctrace top", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_top(args):
+    if args.depth is not None and args.depth < 1:
+        malloctrace_error("--depth must be at least 1")
+        return
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
+        malloctrace_info(f"No entries")
+        return
+
+    stack_totals = snapshot.stack_totals(args.depth)
+    # Only the winning stacks get symbolized.
+    winners = heapq.nlargest(args.count, stack_totals, key=operator.attrgetter(args.by))
+    prefetch_symbols(frame_pc for totals in winners for frame_pc in totals.frames)
+    print_sample_estimate(snapshot)
+    for rank, totals in enumerate(winners, start=1):
+        print_stack_totals(rank, totals, approximately(snapshot))
+
+def describe_thread(tid, thread_names):
+    if tid not in thread_names:
+        return f"Thread {tid!s} (exited)"
+    name = thread_names[tid]
+    return f"Thread {tid!s}" if name is None else f"Thread {tid!s} \"{name!s}\""
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace threads",
+    description="This command shows how much live memory every thread allocated, with the names of the threads that still run",
+    short_description="show live memory by thread",
+    add_help=False
+)
+parser.add_argument("--by", choices=["bytes", "count"], default="bytes", help="Rank threads by live bytes or by live chunk count")
+parser.add_argument("-n", dest="count", type=parse_number, default=None, help="The number of threads to print, all by default")
+@command.GDBSubCommand("malloctrace threads", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_threads(args):
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
+        malloctrace_info(f"No entries")
+        return
+
+    thread_totals = sorted(snapshot.thread_totals(), key=operator.attrgetter(args.by), reverse=True)[:args.count]
+    thread_names = read_thread_names()
+    print_sample_estimate(snapshot)
+    approx = approximately(snapshot)
+    for totals in thread_totals:
+        print(f"{_reset}{describe_thread(totals.tid, thread_names)}: {approx}{_blue(hex(totals.bytes))} bytes in {approx}{_blue(str(totals.count))} chunks")
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace oldest",
+    description="This command shows the longest-lived chunks, the likeliest leaks, with their age",
+    short_description="show oldest chunks",
+    add_help=False
+)
+parser.add_argument("-n", dest="count", type=parse_number, default=10, help="The number of chunks to print")
+@command.GDBSubCommand("malloctrace oldest", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_oldest(args):
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
+        malloctrace_info(f"No entries")
+        return
+
+    now = snapshot.reference_time(heap_map_now())
+    indices = snapshot.select(EntryFilter(), "age", args.count)
+    prefetch_symbols(frame_pc for index in indices for frame_pc in snapshot.frames_at(index))
+    for index in indices:
+        print_allocation(snapshot[index], now)
+
+
+@command.GDBSubCommand("malloctrace age", "Show how many chunks and bytes fall into each power of two age class", short_description="show age histogram")
+@on_error_show_error_message(Exception)
+def malloctrace_age(_):
+    snapshot = read_heap_snapshot()
+    if len(snapshot) == 0:
+        malloctrace_info(f"No entries")
+        return
+
+    if heap_map_now() is None:
+        malloctrace_info(f"Ages are relative to the newest allocation, the process is not running any more")
+    print_sample_estimate(snapshot)
+    approx = approximately(snapshot)
+    for bucket in snapshot.age_histogram(heap_map_now()):
+        print(f"{_reset}{format_duration(bucket.min_age):>8} - {format_duration(bucket.max_age + 1):<8} "
+            f"{approx}{_blue(str(bucket.count))} chunks, {approx}{_blue(hex(bucket.bytes))} bytes")
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace dump",
+    description="This command writes the heap map, the symbols of all its frames and the module map to a file, which can be analyzed without gdb by 'python -m malloctrace.offline'",
+    short_description="dump heap map to a file",
+    add_help=False
+)
+parser.add_argument("file", type=str, help="The file to write the dump to")
+@command.GDBSubCommand("malloctrace dump", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_dump(args):
+    snapshot = read_heap_snapshot()
+    prefetch_symbols(snapshot.unique_frames())
+    symbols = {pc: symbolize_address(pc) for pc in snapshot.unique_frames()}
+    write_dump(args.file, snapshot, symbols, read_module_map())
+    malloctrace_info(f"Dumped {len(snapshot)!s} entries and {len(symbols)!s} symbols to {args.file!s}")
+
+# Saved snapshots keep the packed entry buffer they were decoded from, nothing more.
+_saved_snapshots = dict()
+
+@command.GDBPrefixCommand("malloctrace snapshot", "Save and manage heap map snapshots", short_description="save and manage heap map snapshots")
+def malloctrace_snapshot(_):
+    return
+
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace snapshot save",
+    description="This command keeps a copy of the current heap map under the given name, to be compared later with 'malloctrace diff'",
+    short_description="save heap map snapshot",
+    add_help=False
+)
+parser.add_argument("name", type=str, help="The name of the snapshot")
+@command.GDBSubCommand("malloctrace snapshot save", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_snapshot_save(args):
+    snapshot = read_heap_snapshot()
+    _saved_snapshots[args.name] = snapshot
+    malloctrace_info(f"Saved {len(snapshot)!s} entries as '{args.name!s}'")
+
+
+@command.GDBSubCommand("malloctrace snapshot list", "List saved heap map snapshots", short_description="list saved heap map snapshots")
+@on_error_show_error_message(Exception)
+def malloctrace_snapshot_list(_):
+    if len(_saved_snapshots) == 0:
+        malloctrace_info(f"No snapshots")
+        return
+    for name, snapshot in _saved_snapshots.items():
+        estimated_bytes, _ = snapshot.estimated_totals()
+        print(f"{_reset}{name!s}: {len(snapshot)!s} entries, {approximately(snapshot)}{_blue(hex(estimated_bytes))} bytes")
+
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace snapshot delete",
+    description="This command deletes a saved heap map snapshot",
+    short_description="delete heap map snapshot",
+    add_help=False
+)
+parser.add_argument("name", type=str, help="The name of the snapshot")
+@command.GDBSubCommand("malloctrace snapshot delete", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_snapshot_delete(args):
+    if _saved_snapshots.pop(args.name, None) is None:
+        malloctrace_error(f"Unknown snapshot: '{args.name!s}'")
+
+
+def print_stack_diff(stack_diff, approx=""):
+    growth = f"+{hex(stack_diff.byte_growth)}" if stack_diff.byte_growth >= 0 else f"-{hex(-stack_diff.byte_growth)}"
+    print(f"{_reset}------------------")
+    print(f"{_reset}{approx}{_blue(growth)} bytes ({stack_diff.new_count!s} new, {stack_diff.freed_count!s} freed, {stack_diff.resized_count!s} resized)")
+    print_frames(stack_diff.frames)
+
+parser = argparser.GDBArgumentParser(
+    prog="malloctrace diff",
+    description="This command compares two snapshots and shows the allocation sites whose live memory grew the most",
+    short_description="compare heap map snapshots",
+    add_help=False
+)
+parser.add_argument("old", type=str, help="The name of the older snapshot")
+parser.add_argument("new", type=str, nargs="?", default=None, help="The name of the newer snapshot. Defaults to the current heap map")
+parser.add_argument("--depth", type=parse_number, default=None, help="Group by the first N frames instead of the full backtrace")
+parser.add_argument("-n", dest="count", type=parse_number, default=10, help="The number of allocation sites to print")
+@command.GDBSubCommand("malloctrace diff", parser)
+@on_error_show_error_message(Exception)
+def malloctrace_diff(args):
+    for name in (args.old, args.new):
+        if name is not None and name not in _saved_snapshots:
+            malloctrace_error(f"Unknown snapshot: '{name!s}'")
+            return
+    old = _saved_snapshots[args.old]
+    new = _saved_snapshots[args.new] if args.new is not None else read_heap_snapshot()
+    stack_diffs = [stack_diff for stack_diff in diff_snapshots(old, new, args.depth) if stack_diff.byte_growth or stack_diff.new_count or stack_diff.freed_count]
+    if len(stack_diffs) == 0:
+        malloctrace_info(f"No differences")
+        return
+    approx = "~" if old.is_sampled or new.is_sampled else ""
+    prefetch_symbols(frame_pc for stack_diff in stack_diffs[:args.count] for frame_pc in stack_diff.frames)
+    for stack_diff in stack_diffs[:args.count]:
+        print_stack_diff(stack_diff, approx)
+
+@command.GDBPrefixCommand("malloctrace cache", "Symbolization cache", short_description="symbolization cache")
+def malloctrace_cache(_):
+    return
+
+
+@command.GDBSubCommand("malloctrace cache stats", "Show symbolization cache statistics", short_description="show symbolization cache statistics")
+@on_error_show_error_message(Exception)
+def malloctrace_cache_stats(_):
+    cache_info = symbol_cache_info()
+    lookups = cache_info.hits + cache_info.misses
+    hit_rate = (cache_info.hits / lookups * 100) if lookups else 0.0
+    print(f"{_reset}entries: {_blue(str(cache_info.currsize))} / {cache_info.maxsize!s}")
+    print(f"{_reset}hits: {_blue(str(cache_info.hits))}")
+    print(f"{_reset}misses: {_blue(str(cache_info.misses))}")
+    print(f"{_reset}hit rate: {hit_rate:.1f}%")
+
+
+@command.GDBSubCommand("malloctrace cache clear", "Clear the symbolization cache", short_description="clear the symbolization cache")
+@on_error_show_error_message(Exception)
+def malloctrace_cache_clear(_):
+    invalidate_symbol_cache()
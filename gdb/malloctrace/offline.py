@@ -0,0 +1,202 @@
+"""Analyze malloctrace dumps without gdb.
+
+usage: python -m malloctrace.offline [--jobs N] <dump-file> {show,top,threads,oldest,histogram,age} ...
+
+Frames the dump has no symbols for, like those of an exit-time report
+(MALLOCTRACE_REPORT), are symbolized from the ELF files in its module map.
+A report only holds allocation sites, so 'top' is the one command it supports.
+
+Run it from the gdb/ directory of the repository, or put that directory on PYTHONPATH.
+"""
+import argparse
+import functools
+import heapq
+import operator
+import sys
+
+from malloctrace.dumpfile import DumpFile, DumpFormatError
+from malloctrace.snapshot import MAX_ADDRESS, EntryFilter, format_duration, is_symbol_frame, match_frames
+from malloctrace.symbolizer import symbolize_batch
+from malloctrace.symbols import UNKNOWN_SYMBOL, Symbolization, format_bt_line
+
+
+def parse_number(number: str) -> int:
+    return int(number, 0)
+
+
+UNKNOWN = Symbolization(UNKNOWN_SYMBOL, None, 0)
+
+
+def bt_line_for_address(dump: DumpFile, address: int) -> str:
+    return format_bt_line(address, dump.symbolize(address) or UNKNOWN)
+
+
+def symbolize_missing(dump: DumpFile, pcs, jobs=1):
+    """Resolves the pcs the dump has no symbols for from the ELF files in its module map, all in one batch."""
+    missing = {pc for pc in pcs if pc != 0 and dump.symbolize(pc) is None}
+    if missing:
+        dump.add_symbols(symbolize_batch(missing, dump.modules, jobs))
+
+
+def print_frames(dump: DumpFile, frames):
+    for index, frame_pc in enumerate(frames):
+        # Backtraces shorter than the recorded depth are padded with zeros.
+        if frame_pc == 0:
+            break
+        print(f"#{index!s}  {bt_line_for_address(dump, frame_pc)}")
+
+
+def print_allocation(dump: DumpFile, allocation, now=None):
+    print("------------------")
+    age = "" if now is None else f" - age: {format_duration(max(now - allocation.timestamp, 0))} (allocation #{allocation.sequence!s})"
+    print(f"Chunk @ {hex(allocation.address)} - size: {hex(allocation.size)} - thread: {allocation.tid!s}{age}")
+    print_frames(dump, allocation.frames)
+
+
+def approximately(dump: DumpFile) -> str:
+    # Totals of a sampled heap map are estimates.
+    return "~" if dump.snapshot.is_sampled else ""
+
+
+def print_sample_estimate(dump: DumpFile, indices=None):
+    snapshot = dump.snapshot
+    if not snapshot.is_sampled:
+        return
+    if dump.is_report:
+        print(f"Sampled report (about one allocation every {hex(snapshot.sample_bytes)} bytes): all totals are estimates")
+        return
+    recorded = len(snapshot) if indices is None else len(indices)
+    estimated_bytes, estimated_count = snapshot.estimated_totals(indices)
+    print(f"Sampled heap map (about one allocation every {hex(snapshot.sample_bytes)} bytes): "
+        f"{recorded!s} recorded chunks stand for ~{hex(estimated_bytes)} bytes in ~{estimated_count!s} chunks")
+
+
+def frame_symbol(dump: DumpFile, pc: int) -> str:
+    return (dump.symbolize(pc) or UNKNOWN).symbol
+
+
+def build_entry_filter(dump: DumpFile, args) -> EntryFilter:
+    frame_pcs = tuple()
+    if args.frame:
+        unique_frames = dump.snapshot.unique_frames()
+        if any(map(is_symbol_frame, args.frame)):
+            symbolize_missing(dump, unique_frames, args.jobs)
+        frame_pcs = tuple(match_frames(unique_frames, frame, functools.partial(frame_symbol, dump)) for frame in args.frame)
+    return EntryFilter(args.start_addr, args.end_addr, args.min_size, args.max_size, frame_pcs, frozenset(args.thread))
+
+
+def show(dump: DumpFile, args):
+    snapshot = dump.snapshot
+    indices = snapshot.select(build_entry_filter(dump, args), args.sort, args.count or None)
+    print_sample_estimate(dump, indices)
+    symbolize_missing(dump, (frame_pc for index in indices for frame_pc in snapshot.frames_at(index)), args.jobs)
+    for index in indices:
+        print_allocation(dump, snapshot[index])
+
+
+def top(dump: DumpFile, args):
+    stack_totals = dump.stack_totals(args.depth)
+    winners = heapq.nlargest(args.count, stack_totals, key=operator.attrgetter(args.by))
+    symbolize_missing(dump, (frame_pc for totals in winners for frame_pc in totals.frames), args.jobs)
+    print_sample_estimate(dump)
+    approx = approximately(dump)
+    for rank, totals in enumerate(winners, start=1):
+        print("------------------")
+        print(f"#{rank!s} {approx}{hex(totals.bytes)} bytes in {approx}{totals.count!s} chunks")
+        print_frames(dump, totals.frames)
+
+
+def threads(dump: DumpFile, args):
+    # The threads are gone with the process, so there are no names to show.
+    thread_totals = sorted(dump.snapshot.thread_totals(), key=operator.attrgetter(args.by), reverse=True)[:args.count]
+    print_sample_estimate(dump)
+    approx = approximately(dump)
+    for totals in thread_totals:
+        print(f"Thread {totals.tid!s}: {approx}{hex(totals.bytes)} bytes in {approx}{totals.count!s} chunks")
+
+
+def oldest(dump: DumpFile, args):
+    # The process is gone, so the ages are relative to its newest allocation.
+    snapshot = dump.snapshot
+    now = snapshot.reference_time()
+    indices = snapshot.select(EntryFilter(), "age", args.count)
+    symbolize_missing(dump, (frame_pc for index in indices for frame_pc in snapshot.frames_at(index)), args.jobs)
+    for index in indices:
+        print_allocation(dump, snapshot[index], now)
+
+
+def histogram(dump: DumpFile, args):
+    print_sample_estimate(dump)
+    buckets = dump.snapshot.size_histogram()
+    total_count = sum(bucket.count for bucket in buckets) or 1
+    for bucket in buckets:
+        bar = "#" * round(bucket.count / total_count * 50)
+        print(f"{hex(bucket.min_size):>12} - {hex(bucket.max_size):<12} {bucket.count:>10} chunks {hex(bucket.bytes):>14} bytes  {bar}")
+
+
+def age(dump: DumpFile, args):
+    print_sample_estimate(dump)
+    buckets = dump.snapshot.age_histogram()
+    total_count = sum(bucket.count for bucket in buckets) or 1
+    for bucket in buckets:
+        bar = "#" * round(bucket.count / total_count * 50)
+        print(f"{format_duration(bucket.min_age):>8} - {format_duration(bucket.max_age + 1):<8} {bucket.count:>10} chunks {hex(bucket.bytes):>14} bytes  {bar}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m malloctrace.offline", description="Analyze a heap map dump written by 'malloctrace dump'.")
+    parser.add_argument("dump", help="The dump file to analyze")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes to symbolize frames the dump has no symbols for with, 1 symbolizes in-process")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    show_parser = commands.add_parser("show", help="show the chunks of the heap map in address order")
+    show_parser.add_argument("start_addr", type=parse_number, nargs="?", default=0, help="The address to begin with")
+    show_parser.add_argument("end_addr", type=parse_number, nargs="?", default=MAX_ADDRESS, help="The address to end with")
+    show_parser.add_argument("-n", dest="count", type=parse_number, default=0, help="The number of chunks to print, 0 for all")
+    show_parser.add_argument("--min-size", type=parse_number, default=0, help="Only show chunks of at least this many bytes")
+    show_parser.add_argument("--max-size", type=parse_number, default=MAX_ADDRESS, help="Only show chunks of at most this many bytes")
+    show_parser.add_argument("--frame", action="append", default=list(),
+        help="Only show chunks with a frame at this pc, within this pc range <start>-<end>, or in this function (wildcards allowed). Given more than once, every one has to match")
+    show_parser.add_argument("--thread", action="append", type=parse_number, default=list(), help="Only show chunks allocated by the thread with this tid. Given more than once, any one may match")
+    show_parser.add_argument("--sort", choices=["address", "size", "age"], default="address", help="Show the chunks in address order, the largest or the oldest first")
+    show_parser.set_defaults(handler=show)
+
+    top_parser = commands.add_parser("top", help="show the allocation sites holding the most live memory")
+    top_parser.add_argument("--by", choices=["bytes", "count"], default="bytes", help="Rank allocation sites by live bytes or by live chunk count")
+    top_parser.add_argument("--depth", type=parse_number, default=None, help="Group by the first N frames instead of the full backtrace")
+    top_parser.add_argument("-n", dest="count", type=parse_number, default=10, help="The number of allocation sites to print")
+    top_parser.set_defaults(handler=top)
+
+    threads_parser = commands.add_parser("threads", help="show how much live memory every thread allocated")
+    threads_parser.add_argument("--by", choices=["bytes", "count"], default="bytes", help="Rank threads by live bytes or by live chunk count")
+    threads_parser.add_argument("-n", dest="count", type=parse_number, default=None, help="The number of threads to print, all by default")
+    threads_parser.set_defaults(handler=threads)
+
+    oldest_parser = commands.add_parser("oldest", help="show the longest-lived chunks with their age relative to the newest allocation")
+    oldest_parser.add_argument("-n", dest="count", type=parse_number, default=10, help="The number of chunks to print")
+    oldest_parser.set_defaults(handler=oldest)
+
+    histogram_parser = commands.add_parser("histogram", help="show how many chunks and bytes fall into each power of two size class")
+    histogram_parser.set_defaults(handler=histogram)
+
+    age_parser = commands.add_parser("age", help="show how many chunks and bytes fall into each power of two age class")
+    age_parser.set_defaults(handler=age)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        dump = DumpFile(args.dump)
+    except (OSError, DumpFormatError) as e:
+        print(f"[-]: {e!s}", file=sys.stderr)
+        return 1
+    if dump.is_report and args.handler is not top:
+        print(f"[-]: {args.dump!s} is an exit-time report, which only holds allocation sites, use 'top'", file=sys.stderr)
+        return 1
+    args.handler(dump, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -1,27 +1,152 @@
 import gdb
-from malloctrace.environment import inferior_get_env, inferior_set_env, get_ld_preload, set_ld_preload
+from malloctrace.environment import inferior_get_env, inferior_set_env, inferior_unset_env, get_ld_preload, set_ld_preload
 from malloctrace.logging import _blue
-from malloctrace.constants import DEFAULT_MAP_SIZE, DEFAULT_LOG_LEVEL
+from malloctrace.constants import DEFAULT_MAP_SIZE, DEFAULT_MAP_MAX_SIZE, DEFAULT_LOG_LEVEL, DEFAULT_BACKTRACE_DEPTH, MAX_BACKTRACE_DEPTH, DEFAULT_STACK_TABLE_SIZE, DEFAULT_SAMPLE_BYTES
 
 
 class HeapMapSizeParam(gdb.Parameter):
-    """The Heap Map size of malloctrace in bytes.\nNote that for the changes to take place you have to restart your program."""
+    """The initial size of every per-thread Heap Map of malloctrace in bytes.\nThe maps grow on demand up to malloctrace-heap-max-size.\nNote that for the changes to take place you have to restart your program."""
 
     def __init__(self):
         super().__init__("malloctrace-heap-size", gdb.COMMAND_DATA, gdb.PARAM_UINTEGER)
         # TODO: maybe persist these settings across gdb starts
-        self.value = int(inferior_get_env("MALLOCTRACE_MAP_SIZE") or DEFAULT_MAP_SIZE)
+        # The environment is read when the value is shown, reading it costs a gdb.execute at startup.
+        self.value = DEFAULT_MAP_SIZE
 
     def get_set_string(self):
         inferior_set_env("MALLOCTRACE_MAP_SIZE", str(self.value))
         return ""
     
     def get_show_string(self, svalue):
-        return f"total capacity: {_blue(hex(self.value))} bytes"
+        self.value = int(inferior_get_env("MALLOCTRACE_MAP_SIZE") or DEFAULT_MAP_SIZE)
+        return f"initial capacity: {_blue(hex(self.value))} bytes"
 
 MALLOCTRACE_HEAP_SIZE_PARAM = HeapMapSizeParam()
 
 
+class HeapMapMaxSizeParam(gdb.Parameter):
+    """The size in bytes up to which every per-thread Heap Map of malloctrace may grow.\nAllocations beyond that are dropped and counted.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-heap-max-size", gdb.COMMAND_DATA, gdb.PARAM_UINTEGER)
+        self.value = DEFAULT_MAP_MAX_SIZE
+
+    def get_set_string(self):
+        inferior_set_env("MALLOCTRACE_MAP_MAX_SIZE", str(self.value))
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = int(inferior_get_env("MALLOCTRACE_MAP_MAX_SIZE") or DEFAULT_MAP_MAX_SIZE)
+        return f"maximum capacity: {_blue(hex(self.value))} bytes"
+
+MALLOCTRACE_HEAP_MAX_SIZE_PARAM = HeapMapMaxSizeParam()
+
+
+class BacktraceDepthParam(gdb.Parameter):
+    """The number of frames malloctrace records per allocation.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-bt-depth", gdb.COMMAND_DATA, gdb.PARAM_UINTEGER)
+        self.value = DEFAULT_BACKTRACE_DEPTH
+
+    def get_set_string(self):
+        # 0 and unlimited come back as None, both mean as deep as malloctrace can record.
+        if self.value is None or self.value > MAX_BACKTRACE_DEPTH:
+            self.value = MAX_BACKTRACE_DEPTH
+        inferior_set_env("MALLOCTRACE_BT_DEPTH", str(self.value))
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = int(inferior_get_env("MALLOCTRACE_BT_DEPTH") or DEFAULT_BACKTRACE_DEPTH)
+        return f"backtrace depth: {_blue(str(self.value))} frames"
+
+MALLOCTRACE_BT_DEPTH_PARAM = BacktraceDepthParam()
+
+
+class StackTableSizeParam(gdb.Parameter):
+    """The number of distinct backtraces malloctrace keeps, all allocations from the same backtrace share one entry.\nAllocations with a backtrace beyond that are recorded without one.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-stack-table-size", gdb.COMMAND_DATA, gdb.PARAM_UINTEGER)
+        self.value = DEFAULT_STACK_TABLE_SIZE
+
+    def get_set_string(self):
+        inferior_set_env("MALLOCTRACE_STACK_TABLE_SIZE", str(self.value))
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = int(inferior_get_env("MALLOCTRACE_STACK_TABLE_SIZE") or DEFAULT_STACK_TABLE_SIZE)
+        return f"stack table size: {_blue(hex(self.value))} backtraces"
+
+MALLOCTRACE_STACK_TABLE_SIZE_PARAM = StackTableSizeParam()
+
+
+class SampleBytesParam(gdb.Parameter):
+    """Record only about one allocation per this many allocated bytes, 0 records every allocation.\nTotals shown for a sampled heap map are estimates.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-sample-bytes", gdb.COMMAND_DATA, gdb.PARAM_ZUINTEGER)
+        self.value = DEFAULT_SAMPLE_BYTES
+
+    def get_set_string(self):
+        inferior_set_env("MALLOCTRACE_SAMPLE_BYTES", str(self.value))
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = int(inferior_get_env("MALLOCTRACE_SAMPLE_BYTES") or DEFAULT_SAMPLE_BYTES)
+        if self.value == 0:
+            return "sampling: off, every allocation is recorded"
+        return f"sampling: about one allocation every {_blue(hex(self.value))} bytes"
+
+MALLOCTRACE_SAMPLE_BYTES_PARAM = SampleBytesParam()
+
+
+class EventStreamParam(gdb.Parameter):
+    """Stream every allocation and free to the shared memory ring /dev/shm/<name>, empty disables streaming.\nTail it with 'python -m malloctrace.stream <name>'.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-stream", gdb.COMMAND_DATA, gdb.PARAM_STRING)
+        self.value = ""
+
+    def get_set_string(self):
+        if self.value:
+            inferior_set_env("MALLOCTRACE_STREAM", self.value)
+        elif inferior_get_env("MALLOCTRACE_STREAM") is not None:
+            inferior_unset_env("MALLOCTRACE_STREAM")
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = inferior_get_env("MALLOCTRACE_STREAM") or ""
+        if not self.value:
+            return "event stream: off"
+        return f"event stream: {_blue('/dev/shm/' + self.value.lstrip('/'))}"
+
+MALLOCTRACE_STREAM_PARAM = EventStreamParam()
+
+
+class ReportParam(gdb.Parameter):
+    """Write the allocation sites of the chunks still live at exit to this file, in the format of 'malloctrace dump', empty disables the report.\nA %p in the path is replaced by the pid of the process.\nAnalyze it with 'python -m malloctrace.offline <path>'.\nNote that for the changes to take place you have to restart your program."""
+
+    def __init__(self):
+        super().__init__("malloctrace-report", gdb.COMMAND_DATA, gdb.PARAM_STRING)
+        self.value = ""
+
+    def get_set_string(self):
+        if self.value:
+            inferior_set_env("MALLOCTRACE_REPORT", self.value)
+        elif inferior_get_env("MALLOCTRACE_REPORT") is not None:
+            inferior_unset_env("MALLOCTRACE_REPORT")
+        return ""
+
+    def get_show_string(self, svalue):
+        self.value = inferior_get_env("MALLOCTRACE_REPORT") or ""
+        if not self.value:
+            return "exit-time report: off"
+        return f"exit-time report: {_blue(self.value)}"
+
+MALLOCTRACE_REPORT_PARAM = ReportParam()
+
+
 class LibraryPathParam(gdb.Parameter):
     """This is the library path to libmalloctrace.so.\nIt is used to inject libmalloctrace.so in a new process using LD_PRELOAD."""
 
@@ -0,0 +1,104 @@
+import gdb
+from typing import Callable, Dict, Optional
+from malloctrace.params import MALLOCTRACE_OBJFILE_NAME_PARAM
+
+
+_UNRESOLVED = object()
+
+
+class Session:
+    """State of one inferior that only changes when objfiles come and go, or the inferior exits."""
+
+    def __init__(self, inferior: gdb.Inferior):
+        self.inferior = inferior
+        self._objfile = _UNRESOLVED
+        self._objfile_name = None
+        self._symbol_addresses: Dict[str, int] = dict()
+        self._heap_map_list = None
+        self._target_type = None
+
+    @property
+    def target_type(self) -> str:
+        if self._target_type is None:
+            connection = getattr(self.inferior, "connection", None)
+            if connection is not None:
+                self._target_type = connection.type
+            else:
+                # gdb before 13 does not tell us the target of an inferior.
+                target = gdb.execute("info target", to_string=True)
+                self._target_type = "core" if "core dump file" in target else "native" if "Native process" in target else "remote"
+        return self._target_type
+
+    @property
+    def is_core_file(self) -> bool:
+        return self.target_type == "core"
+
+    @property
+    def is_native(self) -> bool:
+        return self.target_type == "native"
+
+    @property
+    def objfile(self) -> Optional[gdb.Objfile]:
+        name = MALLOCTRACE_OBJFILE_NAME_PARAM.value
+        if self._objfile is _UNRESOLVED or self._objfile_name != name or (self._objfile is not None and not self._objfile.is_valid()):
+            self._objfile_name = name
+            self._symbol_addresses.clear()
+            try:
+                self._objfile = gdb.lookup_objfile(name)
+            except ValueError:
+                self._objfile = None
+        return self._objfile
+
+    def symbol_address(self, name: str, resolve: Callable[[], int]) -> int:
+        address = self._symbol_addresses.get(name)
+        if address is None:
+            address = self._symbol_addresses[name] = resolve()
+        return address
+
+    def heap_map_list(self, read: Callable[[], int]) -> int:
+        # Inferior memory, so it is only kept until the inferior runs again.
+        if self._heap_map_list is None:
+            self._heap_map_list = read()
+        return self._heap_map_list
+
+    def forget_inferior_memory(self):
+        self._heap_map_list = None
+
+
+_sessions: Dict[int, Session] = dict()
+
+def current_session() -> Session:
+    inferior = gdb.selected_inferior()
+    session = _sessions.get(inferior.num)
+    if session is None or session.inferior is not inferior:
+        session = _sessions[inferior.num] = Session(inferior)
+    return session
+
+def invalidate_sessions(*_):
+    _sessions.clear()
+
+def invalidate_exited_session(event):
+    inferior = getattr(event, "inferior", None)
+    if inferior is None:
+        invalidate_sessions()
+        return
+    _sessions.pop(inferior.num, None)
+
+def invalidate_after_inferior_call(event):
+    # The called function may have loaded or unloaded libraries.
+    if isinstance(event, gdb.InferiorCallPostEvent):
+        invalidate_sessions()
+
+def forget_inferior_memory(*_):
+    for session in _sessions.values():
+        session.forget_inferior_memory()
+
+gdb.events.new_objfile.connect(invalidate_sessions)
+if hasattr(gdb.events, "free_objfile"):
+    # Only gdb 13 and newer tell us about single objfiles going away.
+    gdb.events.free_objfile.connect(invalidate_sessions)
+gdb.events.clear_objfiles.connect(invalidate_sessions)
+gdb.events.exited.connect(invalidate_exited_session)
+gdb.events.inferior_call.connect(invalidate_after_inferior_call)
+gdb.events.cont.connect(forget_inferior_memory)
+gdb.events.memory_changed.connect(forget_inferior_memory)
@@ -0,0 +1,441 @@
+import bisect
+import collections
+import fnmatch
+import heapq
+import itertools
+import math
+import operator
+import struct
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+MAX_ADDRESS = (1 << 64) - 1
+
+
+class SnapshotEntry(NamedTuple):
+    address: int
+    size: int
+    sequence: int
+    timestamp: int
+    tid: int
+    stack_id: int
+    frames: Tuple[int, ...]
+
+
+class StackTotals(NamedTuple):
+    frames: Tuple[int, ...]
+    bytes: int
+    count: int
+
+
+class ThreadTotals(NamedTuple):
+    tid: int
+    bytes: int
+    count: int
+
+
+class SizeBucket(NamedTuple):
+    min_size: int
+    max_size: int
+    bytes: int
+    count: int
+
+
+class AgeBucket(NamedTuple):
+    min_age: int
+    max_age: int
+    bytes: int
+    count: int
+
+
+class StackDiff(NamedTuple):
+    frames: Tuple[int, ...]
+    byte_growth: int
+    new_count: int
+    freed_count: int
+    resized_count: int
+
+
+class EntryFilter(NamedTuple):
+    start_address: int = 0
+    end_address: int = MAX_ADDRESS
+    min_size: int = 0
+    max_size: int = MAX_ADDRESS
+    # An entry has to have a frame in each of these sets of pcs, see match_frames.
+    frame_pcs: Tuple[FrozenSet[int], ...] = ()
+    # An entry has to be allocated by one of these threads, any thread if empty.
+    tids: FrozenSet[int] = frozenset()
+
+    @property
+    def filters_addresses(self) -> bool:
+        return self.start_address != 0 or self.end_address != MAX_ADDRESS
+
+    @property
+    def filters_sizes(self) -> bool:
+        return self.min_size != 0 or self.max_size != MAX_ADDRESS
+
+
+def _parse_pc(pc: str) -> Optional[int]:
+    try:
+        return int(pc, 0)
+    except ValueError:
+        return None
+
+def _frame_bounds(frame: str) -> Optional[Tuple[int, int]]:
+    bounds = list(map(_parse_pc, frame.split("-")))
+    if len(bounds) > 2 or None in bounds:
+        return None
+    return bounds[0], bounds[-1]
+
+def is_symbol_frame(frame: str) -> bool:
+    """Whether match_frames takes `frame` for a symbol name rather than a pc or a pc range."""
+    return _frame_bounds(frame) is None
+
+def match_frames(pcs: Iterable[int], frame: str, symbolize: Callable[[int], str]) -> FrozenSet[int]:
+    """Returns the pcs that `frame` matches: a pc, a pc range <start>-<end>, or a symbol name that may contain wildcards."""
+    bounds = _frame_bounds(frame)
+    if bounds is not None:
+        start, end = bounds
+        return frozenset(pc for pc in pcs if start <= pc <= end)
+    # The symbol of a pc carries its offset, like main+0x1a.
+    return frozenset(pc for pc in pcs if pc != 0 and fnmatch.fnmatchcase(symbolize(pc).split("+", 1)[0], frame))
+
+
+NS_PER_MS = 1_000_000
+
+def format_duration(nanoseconds: int) -> str:
+    for unit, unit_ns in (("h", 3600 * 10**9), ("min", 60 * 10**9), ("s", 10**9), ("ms", NS_PER_MS)):
+        if nanoseconds >= unit_ns:
+            return f"{nanoseconds / unit_ns:.1f}{unit}"
+    return "0ms"
+
+
+def sample_weight(size: int, sample_bytes: int) -> float:
+    """The inverse of the probability 1 - exp(-size / sample_bytes) that the inferior recorded a chunk of `size` bytes."""
+    if sample_bytes == 0 or size == 0:
+        return 1.0
+    return -1.0 / math.expm1(-size / sample_bytes)
+
+
+class SnapshotLayoutError(ValueError):
+    pass
+
+
+class HeapSnapshot:
+    """A columnar view of the heap map entries, every column strides over the raw AllocationDesc buffer."""
+
+    WORD_FORMAT = "Q"
+    WORD_SIZE = 8
+    # address, size, sequence, timestamp, and the tid and stack id sharing the last word
+    ENTRY_WORDS = 5
+    ENTRY_SIZE = ENTRY_WORDS * WORD_SIZE
+    TID_FORMAT = "i"
+    STACK_ID_FORMAT = "I"
+    TID_HALF_WORD = 8
+
+    def __init__(self, buffer: bytes, stacks: bytes, frame_count: int, sample_bytes: int = 0, entry_size: int = ENTRY_SIZE):
+        if entry_size < self.ENTRY_SIZE or entry_size % self.WORD_SIZE != 0:
+            raise SnapshotLayoutError(f"Unsupported entry size {entry_size!s}, expected a multiple of {self.WORD_SIZE!s} of at least {self.ENTRY_SIZE!s} bytes")
+        if len(buffer) % entry_size != 0:
+            raise SnapshotLayoutError(f"{len(buffer)!s} bytes do not hold a whole number of {entry_size!s} byte entries")
+        self._buffer = buffer
+        self._stacks_buffer = stacks
+        words = memoryview(buffer).cast(self.WORD_FORMAT)
+        stride = entry_size // self.WORD_SIZE
+        self.entry_size = entry_size
+        self.frame_count = frame_count
+        self.sample_bytes = sample_bytes
+        self.addresses = words[0::stride]
+        self.sizes = words[1::stride]
+        self.sequences = words[2::stride]
+        self.timestamps = words[3::stride]
+        self.tids = memoryview(buffer).cast(self.TID_FORMAT)[self.TID_HALF_WORD::2 * stride]
+        self.stack_ids = memoryview(buffer).cast(self.STACK_ID_FORMAT)[self.TID_HALF_WORD + 1::2 * stride]
+        # Stack id n is the n-th stack of the table, id 0 is the empty backtrace.
+        self.stacks: List[Tuple[int, ...]] = list(struct.iter_unpack(f"{frame_count}{self.WORD_FORMAT}", stacks)) if frame_count else []
+        self._empty_stack = (0,) * frame_count
+        self._address_order: Optional[List[int]] = None
+        self._sorted_addresses: Optional[List[int]] = None
+        self._size_order: Optional[List[int]] = None
+        self._sorted_sizes: Optional[List[int]] = None
+        self._stack_groups: Optional[Dict[int, List[int]]] = None
+        self._thread_groups: Optional[Dict[int, List[int]]] = None
+        self._weights: Dict[int, float] = dict()
+
+    @classmethod
+    def empty(cls, frame_count: int, sample_bytes: int = 0):
+        return cls(b"", b"", frame_count, sample_bytes)
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    @property
+    def stacks_buffer(self):
+        return self._stacks_buffer
+
+    @property
+    def is_sampled(self) -> bool:
+        return self.sample_bytes != 0
+
+    def weight(self, size: int) -> float:
+        weight = self._weights.get(size)
+        if weight is None:
+            weight = self._weights[size] = sample_weight(size, self.sample_bytes)
+        return weight
+
+    def estimated_totals(self, indices: Optional[Iterable[int]] = None) -> Tuple[int, int]:
+        sizes = self.sizes if indices is None else [self.sizes[index] for index in indices]
+        if not self.is_sampled:
+            return sum(sizes), len(sizes)
+        weights = list(map(self.weight, sizes))
+        return round(sum(map(operator.mul, sizes, weights))), round(sum(weights))
+
+    def stack(self, stack_id: int) -> Tuple[int, ...]:
+        stacks = self.stacks
+        return stacks[stack_id] if stack_id < len(stacks) else self._empty_stack
+
+    def unique_frames(self) -> set:
+        return set().union(*map(self.stack, set(self.stack_ids)))
+
+    def frames_at(self, index: int) -> Tuple[int, ...]:
+        return self.stack(self.stack_ids[index])
+
+    def __getitem__(self, index: int) -> SnapshotEntry:
+        stack_id = self.stack_ids[index]
+        return SnapshotEntry(self.addresses[index], self.sizes[index], self.sequences[index], self.timestamps[index], self.tids[index], stack_id, self.stack(stack_id))
+
+    def __iter__(self) -> Iterator[SnapshotEntry]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def address_order(self) -> List[int]:
+        if self._address_order is None:
+            self._address_order = sorted(range(len(self)), key=self.addresses.__getitem__)
+            self._sorted_addresses = list(map(self.addresses.__getitem__, self._address_order))
+        return self._address_order
+
+    def range_positions(self, start_address: int, end_address: int) -> Tuple[int, int]:
+        """The [begin, end) positions in `address_order` of the chunks within [start_address, end_address]."""
+        self.address_order
+        return bisect.bisect_left(self._sorted_addresses, start_address), bisect.bisect_right(self._sorted_addresses, end_address)
+
+    def indices_in_range(self, start_address: int, end_address: int) -> List[int]:
+        begin, end = self.range_positions(start_address, end_address)
+        return self.address_order[begin:end]
+
+    @property
+    def size_order(self) -> List[int]:
+        if self._size_order is None:
+            self._size_order = sorted(range(len(self)), key=self.sizes.__getitem__)
+            self._sorted_sizes = list(map(self.sizes.__getitem__, self._size_order))
+        return self._size_order
+
+    @property
+    def stack_groups(self) -> Dict[int, List[int]]:
+        if self._stack_groups is None:
+            groups: Dict[int, List[int]] = collections.defaultdict(list)
+            for index, stack_id in enumerate(self.stack_ids):
+                groups[stack_id].append(index)
+            self._stack_groups = dict(groups)
+        return self._stack_groups
+
+    @property
+    def thread_groups(self) -> Dict[int, List[int]]:
+        if self._thread_groups is None:
+            groups: Dict[int, List[int]] = collections.defaultdict(list)
+            for index, tid in enumerate(self.tids):
+                groups[tid].append(index)
+            self._thread_groups = dict(groups)
+        return self._thread_groups
+
+    def thread_totals(self) -> List[ThreadTotals]:
+        return [ThreadTotals(tid, *self.estimated_totals(indices)) for tid, indices in self.thread_groups.items()]
+
+    def select(self, entry_filter: EntryFilter, order: str = "address", limit: Optional[int] = None) -> List[int]:
+        """The indices of the matching entries. The predicate with the fewest matches picks the candidates from its index."""
+        begin, end = self.range_positions(entry_filter.start_address, entry_filter.end_address)
+        drivers = [(end - begin, "address")]
+        if entry_filter.filters_sizes:
+            self.size_order
+            size_begin = bisect.bisect_left(self._sorted_sizes, entry_filter.min_size)
+            size_end = bisect.bisect_right(self._sorted_sizes, entry_filter.max_size)
+            drivers.append((size_end - size_begin, "size"))
+        if entry_filter.frame_pcs:
+            stacks = [indices for stack_id, indices in self.stack_groups.items()
+                if all(not pcs.isdisjoint(self.stack(stack_id)) for pcs in entry_filter.frame_pcs)]
+            drivers.append((sum(map(len, stacks)), "frames"))
+        if entry_filter.tids:
+            threads = [self.thread_groups.get(tid, []) for tid in entry_filter.tids]
+            drivers.append((sum(map(len, threads)), "threads"))
+        _, driver = min(drivers)
+
+        if driver == "address":
+            candidates = self.address_order[begin:end]
+        elif driver == "size":
+            candidates = self._size_order[size_begin:size_end]
+        elif driver == "frames":
+            candidates = list(itertools.chain.from_iterable(stacks))
+        else:
+            candidates = list(itertools.chain.from_iterable(threads))
+        if driver != "address" and entry_filter.filters_addresses:
+            addresses = self.addresses
+            candidates = [index for index in candidates if entry_filter.start_address <= addresses[index] <= entry_filter.end_address]
+        if driver != "size" and entry_filter.filters_sizes:
+            sizes = self.sizes
+            candidates = [index for index in candidates if entry_filter.min_size <= sizes[index] <= entry_filter.max_size]
+        if driver != "frames" and entry_filter.frame_pcs:
+            matching = set(itertools.chain.from_iterable(stacks))
+            candidates = list(filter(matching.__contains__, candidates))
+        if driver != "threads" and entry_filter.tids:
+            tids = self.tids
+            candidates = [index for index in candidates if tids[index] in entry_filter.tids]
+
+        if order == "age":
+            if limit is not None:
+                return heapq.nsmallest(limit, candidates, key=self.sequences.__getitem__)
+            return sorted(candidates, key=self.sequences.__getitem__)
+        if order == "size":
+            if driver == "size":
+                candidates.reverse()
+                return candidates[:limit]
+            if limit is not None:
+                return heapq.nlargest(limit, candidates, key=self.sizes.__getitem__)
+            return sorted(candidates, key=self.sizes.__getitem__, reverse=True)
+        if driver != "address":
+            if limit is not None:
+                return heapq.nsmallest(limit, candidates, key=self.addresses.__getitem__)
+            candidates.sort(key=self.addresses.__getitem__)
+        return candidates[:limit]
+
+    def stack_totals(self, depth: Optional[int] = None, stack_id_totals: Optional[Iterable[Tuple[int, float, float]]] = None) -> List[StackTotals]:
+        """Totals by the first `depth` frames, of the entries or of the given (stack id, bytes, count) totals of a report."""
+        depth = self.frame_count if depth is None else min(depth, self.frame_count)
+        # stack prefix -> [(estimated) bytes, (estimated) count]
+        totals: Dict[Tuple[int, ...], List[float]] = collections.defaultdict(lambda: [0, 0])
+        for stack_id, size, count in self._stack_id_totals() if stack_id_totals is None else stack_id_totals:
+            total = totals[self.stack(stack_id)[:depth]]
+            total[0] += size
+            total[1] += count
+        return [StackTotals(frames, round(total[0]), round(total[1])) for frames, total in totals.items()]
+
+    def _stack_id_totals(self) -> Iterator[Tuple[int, float, float]]:
+        if not self.is_sampled:
+            counts = collections.Counter(self.stack_ids)
+            sizes: Dict[int, int] = dict.fromkeys(counts, 0)
+            for stack_id, size in zip(self.stack_ids, self.sizes):
+                sizes[stack_id] += size
+            return ((stack_id, sizes[stack_id], count) for stack_id, count in counts.items())
+        # stack id -> [estimated bytes, estimated count]
+        totals: Dict[int, List[float]] = collections.defaultdict(lambda: [0.0, 0.0])
+        weight = self.weight
+        for stack_id, size in zip(self.stack_ids, self.sizes):
+            size_weight = weight(size)
+            total = totals[stack_id]
+            total[0] += size * size_weight
+            total[1] += size_weight
+        return ((stack_id, total[0], total[1]) for stack_id, total in totals.items())
+
+    def size_histogram(self) -> List[SizeBucket]:
+        if not self.is_sampled:
+            exact_counts = collections.Counter(size.bit_length() for size in self.sizes)
+            exact_sizes: Dict[int, int] = dict.fromkeys(exact_counts, 0)
+            for size in self.sizes:
+                exact_sizes[size.bit_length()] += size
+            return [SizeBucket(1 << (bucket - 1) if bucket else 0, (1 << bucket) - 1, exact_sizes[bucket], exact_counts[bucket]) for bucket in sorted(exact_counts)]
+        counts: Dict[int, float] = collections.defaultdict(float)
+        sizes: Dict[int, float] = collections.defaultdict(float)
+        weight = self.weight
+        for size in self.sizes:
+            bucket = size.bit_length()
+            size_weight = weight(size)
+            counts[bucket] += size_weight
+            sizes[bucket] += size * size_weight
+        return [SizeBucket(1 << (bucket - 1) if bucket else 0, (1 << bucket) - 1, round(sizes[bucket]), round(counts[bucket])) for bucket in sorted(counts)]
+
+    def reference_time(self, now: Optional[int] = None) -> int:
+        # A `now` older than the newest allocation comes from another clock, e.g. gdb on another host.
+        newest = max(self.timestamps, default=0)
+        return newest if now is None or now < newest else now
+
+    def age_histogram(self, now: Optional[int] = None) -> List[AgeBucket]:
+        now = self.reference_time(now)
+        ages = map(operator.sub, itertools.repeat(now), self.timestamps)
+        buckets = list(map(int.bit_length, map(operator.floordiv, ages, itertools.repeat(NS_PER_MS))))
+        counts: Dict[int, float] = collections.defaultdict(float)
+        sizes: Dict[int, float] = collections.defaultdict(float)
+        if not self.is_sampled:
+            counts.update(collections.Counter(buckets))
+            for bucket, size in zip(buckets, self.sizes):
+                sizes[bucket] += size
+        else:
+            weight = self.weight
+            for bucket, size in zip(buckets, self.sizes):
+                size_weight = weight(size)
+                counts[bucket] += size_weight
+                sizes[bucket] += size * size_weight
+        return [AgeBucket((1 << (bucket - 1)) * NS_PER_MS if bucket else 0, ((1 << bucket) * NS_PER_MS) - 1, round(sizes[bucket]), round(counts[bucket]))
+            for bucket in sorted(counts)]
+
+
+def diff_snapshots(old: HeapSnapshot, new: HeapSnapshot, depth: Optional[int] = None) -> List[StackDiff]:
+    """Groups new, freed and resized chunks by allocation site, a reused address with a new sequence counts as both."""
+    depth = min(old.frame_count, new.frame_count) if depth is None else depth
+    old_order, new_order = old.address_order, new.address_order
+    old_addresses, new_addresses = old._sorted_addresses, new._sorted_addresses
+    # stack -> [byte_growth, new_count, freed_count, resized_count]
+    totals: Dict[Tuple[int, ...], List[float]] = collections.defaultdict(lambda: [0, 0, 0, 0])
+
+    def allocated(index):
+        total = totals[tuple(new.frames_at(index)[:depth])]
+        size = new.sizes[index]
+        weight = new.weight(size)
+        total[0] += size * weight
+        total[1] += weight
+
+    def freed(index):
+        total = totals[tuple(old.frames_at(index)[:depth])]
+        size = old.sizes[index]
+        weight = old.weight(size)
+        total[0] -= size * weight
+        total[2] += weight
+
+    old_buffer, new_buffer = memoryview(old.buffer), memoryview(new.buffer)
+    old_entry_size, new_entry_size = old.entry_size, new.entry_size
+
+    old_position, new_position = 0, 0
+    old_count, new_count = len(old_order), len(new_order)
+    while old_position < old_count and new_position < new_count:
+        old_address, new_address = old_addresses[old_position], new_addresses[new_position]
+        if old_address < new_address:
+            freed(old_order[old_position])
+            old_position += 1
+        elif old_address > new_address:
+            allocated(new_order[new_position])
+            new_position += 1
+        else:
+            old_index, new_index = old_order[old_position], new_order[new_position]
+            old_position += 1
+            new_position += 1
+            # Stack ids are never reused, so equal raw entries are unchanged chunks.
+            if old_buffer[old_index * old_entry_size:(old_index + 1) * old_entry_size] == new_buffer[new_index * new_entry_size:(new_index + 1) * new_entry_size]:
+                continue
+            old_stack, new_stack = tuple(old.frames_at(old_index)[:depth]), tuple(new.frames_at(new_index)[:depth])
+            if old_stack != new_stack or old.sequences[old_index] != new.sequences[new_index]:
+                freed(old_index)
+                allocated(new_index)
+            elif old.sizes[old_index] != new.sizes[new_index]:
+                old_size, new_size = old.sizes[old_index], new.sizes[new_index]
+                total = totals[new_stack]
+                total[0] += new_size * new.weight(new_size) - old_size * old.weight(old_size)
+                total[3] += new.weight(new_size)
+    for position in range(old_position, old_count):
+        freed(old_order[position])
+    for position in range(new_position, new_count):
+        allocated(new_order[position])
+
+    return sorted((StackDiff(stack, *map(round, total)) for stack, total in totals.items()), key=operator.attrgetter("byte_growth"), reverse=True)
@@ -0,0 +1,278 @@
+"""Tail the event stream of a process running with MALLOCTRACE_STREAM=<name> and write rolled-up JSON stats per interval."""
+import argparse
+import asyncio
+import collections
+import json
+import mmap
+import os
+import signal
+import struct
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+EVENT_STREAM_MAGIC = b"MTRSTRM\0"
+EVENT_STREAM_VERSION = 1
+SHM_DIRECTORY = "/dev/shm"
+
+# magic, version, record_size, capacity, monotonic_start, realtime_start, pid, see EventStreamHeader in src/event_stream.h
+EVENT_STREAM_HEADER = struct.Struct("=8sIIQQQi20x")
+HEAD_OFFSET = 64
+EVENTS_OFFSET = 128
+HEAD = struct.Struct("=Q")
+# sequence, timestamp, address, size, old_address, stack_id, op
+EVENT_RECORD = struct.Struct("=QQQQQIB3x")
+
+EVENT_MALLOC = 1
+EVENT_CALLOC = 2
+EVENT_REALLOC = 3
+EVENT_FREE = 4
+OP_NAMES = {EVENT_MALLOC: "malloc", EVENT_CALLOC: "calloc", EVENT_REALLOC: "realloc", EVENT_FREE: "free"}
+
+# Records read per batch, so the report task gets to run while the producer is busy.
+BATCH_SIZE = 0x4000
+
+
+class StreamFormatError(ValueError):
+    pass
+
+
+class Event(NamedTuple):
+    sequence: int
+    timestamp: int
+    address: int
+    size: int
+    old_address: int
+    stack_id: int
+    op: int
+
+
+def stream_path(name: str) -> str:
+    return os.path.join(SHM_DIRECTORY, name.lstrip("/"))
+
+
+class EventRing:
+
+    def __init__(self, name: str):
+        with open(stream_path(name), "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < EVENTS_OFFSET:
+            raise StreamFormatError(f"{name!s} is too small to be a malloctrace event stream")
+        magic, self.version, record_size, self.capacity, self.monotonic_start, self.realtime_start, self.pid = EVENT_STREAM_HEADER.unpack_from(self._mmap)
+        if magic != EVENT_STREAM_MAGIC:
+            raise StreamFormatError(f"{name!s} is not a malloctrace event stream")
+        if self.version != EVENT_STREAM_VERSION or record_size != EVENT_RECORD.size:
+            raise StreamFormatError(f"Unsupported event stream version {self.version!s}, expected {EVENT_STREAM_VERSION!s}")
+        self._mask = self.capacity - 1
+
+    @property
+    def head(self) -> int:
+        return HEAD.unpack_from(self._mmap, HEAD_OFFSET)[0]
+
+    def wall_time(self, timestamp: int) -> float:
+        return (timestamp - self.monotonic_start + self.realtime_start) / 1e9
+
+    def _copy(self, begin: int, end: int) -> bytes:
+        # The ring may wrap around within [begin, end).
+        first = begin & self._mask
+        last = first + (end - begin)
+        if last <= self.capacity:
+            return self._mmap[EVENTS_OFFSET + first * EVENT_RECORD.size:EVENTS_OFFSET + last * EVENT_RECORD.size]
+        return (self._mmap[EVENTS_OFFSET + first * EVENT_RECORD.size:]
+            + self._mmap[EVENTS_OFFSET:EVENTS_OFFSET + (last - self.capacity) * EVENT_RECORD.size])
+
+    def read(self, position: int, limit: int = BATCH_SIZE) -> Tuple[List[Event], int, int]:
+        """Returns the published events from `position` on, the position to continue at and the number of lost events."""
+        head = self.head
+        if head < position:
+            raise EOFError("The event stream was restarted")
+        lost = 0
+        if head - position > self.capacity:
+            lost = head - self.capacity - position
+            position = head - self.capacity
+        end = min(head, position + limit)
+        records = self._copy(position, end)
+        # Slots below this may have been reused by a writer while we copied them.
+        overwritten_before = self.head - self.capacity
+        events = list()
+        for sequence, record in enumerate(EVENT_RECORD.iter_unpack(records), start=position):
+            if record[0] != sequence + 1:
+                if record[0] < sequence + 1:
+                    # Not published yet, continue there next time.
+                    return events, sequence, lost
+                lost += 1
+            elif sequence < overwritten_before:
+                lost += 1
+            else:
+                events.append(Event._make(record))
+        return events, end, lost
+
+    def close(self):
+        self._mmap.close()
+
+
+class LiveSet:
+
+    def __init__(self):
+        self.chunks: Dict[int, int] = dict() # address -> size
+        self.live_bytes = 0
+        self.event_counts = collections.Counter()
+        self.allocated_bytes = 0
+        self.freed_bytes = 0
+        self.lost_events = 0
+        # Frees of chunks we never saw the allocation of, e.g. because they were lost.
+        self.unknown_frees = 0
+        self.restarts = 0
+
+    def clear(self):
+        self.chunks.clear()
+        self.live_bytes = 0
+
+    def _forget(self, address: int) -> Optional[int]:
+        size = self.chunks.pop(address, None)
+        if size is not None:
+            self.live_bytes -= size
+        return size
+
+    def apply(self, events: List[Event]):
+        for event in events:
+            self.event_counts[event.op] += 1
+            if event.op == EVENT_FREE:
+                size = self._forget(event.address)
+                if size is None:
+                    self.unknown_frees += 1
+                else:
+                    self.freed_bytes += size
+                continue
+            # Only happens if we lost the free of the chunk that was here before.
+            self._forget(event.address)
+            self.chunks[event.address] = event.size
+            self.live_bytes += event.size
+            self.allocated_bytes += event.size
+
+
+class Reporter:
+
+    def __init__(self, live_set: LiveSet, pid: int):
+        self.live_set = live_set
+        self.pid = pid
+        self._last_time = time.monotonic()
+        self._last_counts = collections.Counter()
+        self._last_allocated = 0
+        self._last_freed = 0
+
+    def report(self) -> dict:
+        live_set = self.live_set
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        counts = live_set.event_counts - self._last_counts
+        stats = {
+            "time": time.time(),
+            "pid": self.pid,
+            "interval": round(elapsed, 3),
+            "events": {OP_NAMES.get(op, str(op)): count for op, count in sorted(counts.items())},
+            "events_per_s": round(sum(counts.values()) / elapsed),
+            "allocated_bytes_per_s": round((live_set.allocated_bytes - self._last_allocated) / elapsed),
+            "freed_bytes_per_s": round((live_set.freed_bytes - self._last_freed) / elapsed),
+            "live_bytes": live_set.live_bytes,
+            "live_chunks": len(live_set.chunks),
+            "lost_events": live_set.lost_events,
+            "unknown_frees": live_set.unknown_frees,
+            "restarts": live_set.restarts,
+        }
+        self._last_time = now
+        self._last_counts = collections.Counter(live_set.event_counts)
+        self._last_allocated = live_set.allocated_bytes
+        self._last_freed = live_set.freed_bytes
+        return stats
+
+
+async def open_ring(name: str, poll_interval: float) -> EventRing:
+    while True:
+        try:
+            return EventRing(name)
+        except (FileNotFoundError, StreamFormatError):
+            await asyncio.sleep(poll_interval)
+
+
+async def tail(name: str, ring: EventRing, live_set: LiveSet, reporter: Reporter, stop: asyncio.Event, poll_interval: float):
+    # Start with the oldest event that is still in the ring.
+    position = max(0, ring.head - ring.capacity)
+    try:
+        while not stop.is_set():
+            try:
+                events, position, lost = ring.read(position)
+            except EOFError:
+                # The new process may have resized the ring, so map it again.
+                ring.close()
+                ring = await open_ring(name, poll_interval)
+                reporter.pid = ring.pid
+                live_set.clear()
+                live_set.restarts += 1
+                position = 0
+                continue
+            live_set.lost_events += lost
+            live_set.apply(events)
+            if len(events) + lost == 0:
+                await asyncio.sleep(poll_interval)
+            else:
+                # Let the reporter run between batches.
+                await asyncio.sleep(0)
+    finally:
+        ring.close()
+
+
+
+async def report(reporter: Reporter, output, stop: asyncio.Event, interval: float):
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        output.write(json.dumps(reporter.report()) + "\n")
+        output.flush()
+        if stop.is_set():
+            return
+
+
+async def consume(args, output):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    if args.duration is not None:
+        loop.call_later(args.duration, stop.set)
+
+    ring = await open_ring(args.name, args.poll)
+    live_set = LiveSet()
+    reporter = Reporter(live_set, ring.pid)
+    await asyncio.gather(tail(args.name, ring, live_set, reporter, stop, args.poll), report(reporter, output, stop, args.interval))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m malloctrace.stream", description="Tail the allocation event stream of a process started with MALLOCTRACE_STREAM=<name>.")
+    parser.add_argument("name", help="The name of the stream, as given in MALLOCTRACE_STREAM")
+    parser.add_argument("--interval", type=float, default=1.0, help="Write rolled-up stats every this many seconds")
+    parser.add_argument("--output", help="Append the stats to this file instead of writing them to stdout")
+    parser.add_argument("--duration", type=float, default=None, help="Stop after this many seconds instead of at SIGINT/SIGTERM")
+    parser.add_argument("--poll", type=float, default=0.01, help="Seconds to wait for new events once the consumer caught up")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.output is None:
+        asyncio.run(consume(args, sys.stdout))
+        return 0
+    try:
+        with open(args.output, "a") as output:
+            asyncio.run(consume(args, output))
+    except OSError as e:
+        print(f"[-]: {e!s}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,564 @@
+"""Batch symbolization of frame pcs from the ELF files and DWARF line tables of their modules, without gdb."""
+import bisect
+import collections
+import concurrent.futures
+import mmap
+import multiprocessing
+import os
+import struct
+import subprocess
+import zlib
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from malloctrace.symbols import Module, Symbolization
+
+
+DEBUG_FILE_DIRECTORY = "/usr/lib/debug"
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHF_COMPRESSED = 0x800
+ELFCOMPRESS_ZLIB = 1
+SHN_UNDEF = 0
+STT_NOTYPE = 0
+STT_FUNC = 2
+STT_GNU_IFUNC = 10
+STB_LOCAL = 0
+STB_GLOBAL = 1
+NT_GNU_BUILD_ID = 3
+
+# Lower is preferred if several symbols share an address, like gdb prefers global symbols.
+BINDING_RANK = {STB_GLOBAL: 0, 2: 1, STB_LOCAL: 2}
+
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+
+
+class ElfFormatError(ValueError):
+    pass
+
+
+class _Section(NamedTuple):
+    name: str
+    type: int
+    flags: int
+    address: int
+    offset: int
+    size: int
+    link: int
+    entry_size: int
+
+
+class _Segment(NamedTuple):
+    offset: int
+    address: int
+    file_size: int
+
+
+class _LineRange(NamedTuple):
+    start: int
+    end: int
+    filename: str
+    line: int
+
+
+class ElfFile:
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:4] != ELF_MAGIC:
+            self.close()
+            raise ElfFormatError(f"{path!s} is not an ELF file")
+        self.is_64bit = self._mmap[4] == ELFCLASS64
+        self.endian = "<" if self._mmap[5] == ELFDATA2LSB else ">"
+        self.address_size = 8 if self.is_64bit else 4
+        if self.is_64bit:
+            (_, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum, shstrndx) = struct.unpack_from(self.endian + "HHIQQQIHHHHHH", self._mmap, 16)
+        else:
+            (_, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum, shstrndx) = struct.unpack_from(self.endian + "HHIIIIIHHHHHH", self._mmap, 16)
+        self.segments = self._read_segments(phoff, phentsize, phnum)
+        self._section_table = self._read_sections(shoff, shentsize, shnum, shstrndx)
+        self.sections: Dict[str, _Section] = dict()
+        for section in self._section_table:
+            self.sections.setdefault(section.name, section)
+
+    def _read_segments(self, phoff: int, phentsize: int, phnum: int) -> List[_Segment]:
+        segments = list()
+        for index in range(phnum):
+            if self.is_64bit:
+                p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = struct.unpack_from(self.endian + "IIQQQQQQ", self._mmap, phoff + index * phentsize)
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = struct.unpack_from(self.endian + "IIIIIIII", self._mmap, phoff + index * phentsize)
+            if p_type == PT_LOAD:
+                segments.append(_Segment(p_offset, p_vaddr, p_filesz))
+        return segments
+
+    def _read_sections(self, shoff: int, shentsize: int, shnum: int, shstrndx: int) -> List[_Section]:
+        headers = list()
+        for index in range(shnum):
+            if self.is_64bit:
+                header = struct.unpack_from(self.endian + "IIQQQQIIQQ", self._mmap, shoff + index * shentsize)
+            else:
+                header = struct.unpack_from(self.endian + "IIIIIIIIII", self._mmap, shoff + index * shentsize)
+            name, sh_type, flags, address, offset, size, link, _, _, entry_size = header
+            headers.append((name, sh_type, flags, address, offset, size, link, entry_size))
+        if not headers or shstrndx >= len(headers):
+            return list()
+        names_offset = headers[shstrndx][4]
+        return [_Section(self._string(names_offset + name), *rest) for name, *rest in headers]
+
+    def _string(self, offset: int) -> str:
+        end = self._mmap.find(b"\0", offset)
+        return self._mmap[offset:end].decode(errors="replace")
+
+    def section_data(self, name: str) -> Optional[bytes]:
+        section = self.sections.get(name)
+        if section is None or section.type == SHT_NOBITS:
+            return None
+        data = self._mmap[section.offset:section.offset + section.size]
+        if section.flags & SHF_COMPRESSED:
+            # Elf_Chdr: ch_type, (ch_reserved,) ch_size, ch_addralign
+            header = struct.Struct(self.endian + ("IIQQ" if self.is_64bit else "III"))
+            if struct.unpack_from(self.endian + "I", data)[0] != ELFCOMPRESS_ZLIB:
+                return None
+            return zlib.decompress(data[header.size:])
+        return data
+
+    def load_bias(self, start: int, file_offset: int) -> Optional[int]:
+        """The difference between run-time and link-time addresses, for a mapping of file_offset at start."""
+        # A mapping starts at the page its segment starts in, or somewhere within the segment if it got split up.
+        candidates = [segment for segment in self.segments
+            if segment.offset - segment.offset % mmap.PAGESIZE <= file_offset < segment.offset + max(segment.file_size, 1)]
+        exact = [segment for segment in candidates if segment.offset - segment.offset % mmap.PAGESIZE == file_offset]
+        segment = (exact or candidates or [None])[0]
+        if segment is None:
+            return None
+        return start - (segment.address + file_offset - segment.offset)
+
+    def build_id(self) -> Optional[bytes]:
+        data = self.section_data(".note.gnu.build-id")
+        if data is None or len(data) < 12:
+            return None
+        name_size, desc_size, note_type = struct.unpack_from(self.endian + "III", data)
+        if note_type != NT_GNU_BUILD_ID:
+            return None
+        desc_offset = 12 + ((name_size + 3) & ~3)
+        return data[desc_offset:desc_offset + desc_size]
+
+    def debug_link(self) -> Optional[str]:
+        data = self.section_data(".gnu_debuglink")
+        if data is None:
+            return None
+        return data.split(b"\0", 1)[0].decode(errors="replace")
+
+    def symbols(self) -> Tuple[List[int], List[int], List[str]]:
+        """The addresses, sizes (0 if unknown) and names of the code symbols, sorted by address."""
+        section = self.sections.get(".symtab") or self.sections.get(".dynsym")
+        if section is None or section.type not in (SHT_SYMTAB, SHT_DYNSYM):
+            return list(), list(), list()
+        data = self.section_data(section.name)
+        strings = self._section_table[section.link] if section.link < len(self._section_table) else None
+        if data is None or strings is None:
+            return list(), list(), list()
+        symbol = struct.Struct(self.endian + ("IBBHQQ" if self.is_64bit else "IIIBBH"))
+        candidates = list()
+        for fields in symbol.iter_unpack(data[:len(data) - len(data) % symbol.size]):
+            if self.is_64bit:
+                name, info, _, shndx, value, size = fields
+            else:
+                name, value, size, info, _, shndx = fields
+            symbol_type, binding = info & 0xf, info >> 4
+            if shndx == SHN_UNDEF or name == 0 or symbol_type not in (STT_FUNC, STT_GNU_IFUNC, STT_NOTYPE):
+                continue
+            symbol_name = self._string(strings.offset + name)
+            # Mapping symbols like $x or $d on arm and aarch64 do not name any code.
+            if symbol_name.startswith("$"):
+                continue
+            candidates.append((value, BINDING_RANK.get(binding, 3), symbol_name, size))
+        candidates.sort()
+        addresses, sizes, names = list(), list(), list()
+        for value, _, symbol_name, size in candidates:
+            if addresses and addresses[-1] == value:
+                continue
+            addresses.append(value)
+            sizes.append(size)
+            names.append(symbol_name)
+        return addresses, sizes, names
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def find_debug_file(elf: ElfFile) -> Optional[str]:
+    """See 'Separate Debug Files' in the gdb manual."""
+    build_id = elf.build_id()
+    if build_id is not None and len(build_id) > 1:
+        path = os.path.join(DEBUG_FILE_DIRECTORY, ".build-id", build_id[:1].hex(), build_id[1:].hex() + ".debug")
+        if os.path.isfile(path):
+            return path
+    debug_link = elf.debug_link()
+    if debug_link:
+        directory = os.path.dirname(os.path.realpath(elf.path))
+        for path in (os.path.join(directory, debug_link), os.path.join(directory, ".debug", debug_link),
+                os.path.join(DEBUG_FILE_DIRECTORY, directory.lstrip("/"), debug_link)):
+            if os.path.isfile(path) and os.path.realpath(path) != os.path.realpath(elf.path):
+                return path
+    return None
+
+
+class _Reader:
+
+    def __init__(self, data: bytes, endian: str, offset: int = 0):
+        self.data = data
+        self.endian = endian
+        self.offset = offset
+
+    def unpack(self, fmt: str):
+        values = struct.unpack_from(self.endian + fmt, self.data, self.offset)
+        self.offset += struct.calcsize(self.endian + fmt)
+        return values[0] if len(values) == 1 else values
+
+    def uleb128(self) -> int:
+        result = shift = 0
+        while True:
+            byte = self.data[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return result
+
+    def sleb128(self) -> int:
+        result = shift = 0
+        while True:
+            byte = self.data[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return result - (1 << shift) if byte & 0x40 else result
+
+    def cstring(self) -> str:
+        end = self.data.index(b"\0", self.offset)
+        string = self.data[self.offset:end].decode(errors="replace")
+        self.offset = end + 1
+        return string
+
+
+def _section_string(data: Optional[bytes], offset: int) -> str:
+    if data is None:
+        return ""
+    end = data.find(b"\0", offset)
+    return data[offset:end].decode(errors="replace")
+
+
+# DW_FORM_* of the directory and file name entries of DWARF 5 line tables
+DW_FORM_block = 0x09
+DW_FORM_data1 = 0x0b
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_data16 = 0x1e
+DW_FORM_string = 0x08
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_line_strp = 0x1f
+
+
+def _read_form(reader: _Reader, form: int, offset_size: int, debug_str: Optional[bytes], debug_line_str: Optional[bytes]):
+    if form == DW_FORM_string:
+        return reader.cstring()
+    if form in (DW_FORM_strp, DW_FORM_line_strp):
+        offset = reader.unpack("I" if offset_size == 4 else "Q")
+        return _section_string(debug_str if form == DW_FORM_strp else debug_line_str, offset)
+    if form == DW_FORM_udata:
+        return reader.uleb128()
+    if form in (DW_FORM_data1, DW_FORM_data2, DW_FORM_data4, DW_FORM_data8):
+        return reader.unpack({DW_FORM_data1: "B", DW_FORM_data2: "H", DW_FORM_data4: "I", DW_FORM_data8: "Q"}[form])
+    if form == DW_FORM_data16:
+        reader.offset += 16
+        return None
+    if form == DW_FORM_block:
+        reader.offset += reader.uleb128()
+        return None
+    raise ElfFormatError(f"Unsupported form {form:#x} in a line table header")
+
+
+def _read_entries(reader: _Reader, offset_size: int, debug_str: Optional[bytes], debug_line_str: Optional[bytes]) -> List[Tuple[str, int]]:
+    """Reads the DWARF 5 directory or file name table as (path, directory index) pairs."""
+    formats = [(reader.uleb128(), reader.uleb128()) for _ in range(reader.unpack("B"))]
+    entries = list()
+    for _ in range(reader.uleb128()):
+        path, directory = "", 0
+        for content_type, form in formats:
+            value = _read_form(reader, form, offset_size, debug_str, debug_line_str)
+            if content_type == DW_LNCT_path:
+                path = value
+            elif content_type == DW_LNCT_directory_index:
+                directory = value
+        entries.append((path, directory))
+    return entries
+
+
+def read_line_ranges(debug_line: bytes, endian: str, debug_str: Optional[bytes] = None, debug_line_str: Optional[bytes] = None) -> List[_LineRange]:
+    """Runs the line number programs of all units, and returns the address ranges of their rows sorted by start."""
+    ranges = list()
+    unit_offset = 0
+    while unit_offset + 4 <= len(debug_line):
+        reader = _Reader(debug_line, endian, unit_offset)
+        unit_length, offset_size = reader.unpack("I"), 4
+        if unit_length == 0xffffffff:
+            unit_length, offset_size = reader.unpack("Q"), 8
+        unit_end = reader.offset + unit_length
+        unit_offset = unit_end
+        version = reader.unpack("H")
+        if version < 2 or version > 5:
+            continue
+        address_size = None
+        if version >= 5:
+            address_size, _ = reader.unpack("BB")
+        header_length = reader.unpack("I" if offset_size == 4 else "Q")
+        program_offset = reader.offset + header_length
+        minimum_instruction_length = reader.unpack("B")
+        if version >= 4:
+            reader.unpack("B") # maximum_operations_per_instruction, only VLIW machines use it
+        default_is_stmt, line_base, line_range, opcode_base = reader.unpack("BbBB")
+        standard_opcode_lengths = [0] + [reader.unpack("B") for _ in range(opcode_base - 1)]
+        try:
+            if version >= 5:
+                directories = [path for path, _ in _read_entries(reader, offset_size, debug_str, debug_line_str)]
+                files = _read_entries(reader, offset_size, debug_str, debug_line_str)
+            else:
+                # Directory 0 is the compilation directory, which only .debug_info knows.
+                directories = [""]
+                while (directory := reader.cstring()):
+                    directories.append(directory)
+                files = [("", 0)]
+                while (name := reader.cstring()):
+                    files.append((name, reader.uleb128()))
+                    reader.uleb128()
+                    reader.uleb128()
+        except (ElfFormatError, IndexError, ValueError, struct.error):
+            continue
+        filenames = [os.path.join(directories[directory], name) if directory < len(directories) else name for name, directory in files]
+
+        reader.offset = program_offset
+        address, file, line = 0, 1, 1
+        previous = None
+        def emit(end_sequence: bool):
+            nonlocal previous
+            if previous is not None and previous[0] < address:
+                previous_file = previous[1]
+                ranges.append(_LineRange(previous[0], address, filenames[previous_file] if previous_file < len(filenames) else "", previous[2]))
+            previous = None if end_sequence else (address, file, line)
+        try:
+            while reader.offset < unit_end:
+                opcode = reader.unpack("B")
+                if opcode >= opcode_base:
+                    adjusted = opcode - opcode_base
+                    address += (adjusted // line_range) * minimum_instruction_length
+                    line += line_base + adjusted % line_range
+                    emit(False)
+                elif opcode == 0:
+                    length = reader.uleb128()
+                    extended_end = reader.offset + length
+                    sub_opcode = reader.unpack("B") if length else 0
+                    if sub_opcode == DW_LNE_end_sequence:
+                        emit(True)
+                        address, file, line = 0, 1, 1
+                    elif sub_opcode == DW_LNE_set_address:
+                        address = int.from_bytes(debug_line[reader.offset:extended_end], "little" if endian == "<" else "big")
+                    elif sub_opcode == DW_LNE_define_file:
+                        name = reader.cstring()
+                        filenames.append(os.path.join(directories[reader.uleb128()], name))
+                    reader.offset = extended_end
+                elif opcode == DW_LNS_copy:
+                    emit(False)
+                elif opcode == DW_LNS_advance_pc:
+                    address += reader.uleb128() * minimum_instruction_length
+                elif opcode == DW_LNS_advance_line:
+                    line += reader.sleb128()
+                elif opcode == DW_LNS_set_file:
+                    file = reader.uleb128()
+                elif opcode == DW_LNS_const_add_pc:
+                    address += ((255 - opcode_base) // line_range) * minimum_instruction_length
+                elif opcode == DW_LNS_fixed_advance_pc:
+                    address += reader.unpack("H")
+                else:
+                    # Opcodes that only change registers we don't need, like the column.
+                    for _ in range(standard_opcode_lengths[opcode]):
+                        reader.uleb128()
+        except (IndexError, struct.error):
+            # A truncated unit still gave us its rows up to there.
+            pass
+    ranges.sort()
+    return ranges
+
+
+class ModuleSymbolizer:
+
+    def __init__(self, path: str):
+        self.elf = ElfFile(path)
+        debug_path = find_debug_file(self.elf)
+        self.debug_elf = ElfFile(debug_path) if debug_path is not None else None
+        self._symbol_addresses, self._symbol_sizes, self._symbol_names = self.elf.symbols()
+        if self.debug_elf is not None and ".symtab" not in self.elf.sections:
+            # Stripped files only have .dynsym, the debug file has the full symbol table.
+            self._symbol_addresses, self._symbol_sizes, self._symbol_names = self.debug_elf.symbols()
+        self._line_ranges = self._read_line_ranges()
+
+    def _read_line_ranges(self) -> List[_LineRange]:
+        for elf in (self.elf, self.debug_elf):
+            if elf is None:
+                continue
+            debug_line = elf.section_data(".debug_line")
+            if debug_line is not None:
+                return read_line_ranges(debug_line, elf.endian, elf.section_data(".debug_str"), elf.section_data(".debug_line_str"))
+        return list()
+
+    def load_bias(self, start: int, file_offset: int) -> Optional[int]:
+        return self.elf.load_bias(start, file_offset)
+
+    def symbolize(self, addresses: List[int]) -> List[Optional[Symbolization]]:
+        """Symbolizes the sorted link-time addresses in one sweep over the symbols and the line ranges."""
+        results = list()
+        symbol_index = -1
+        range_index = 0
+        line_ranges = self._line_ranges
+        for address in addresses:
+            while symbol_index + 1 < len(self._symbol_addresses) and self._symbol_addresses[symbol_index + 1] <= address:
+                symbol_index += 1
+            # Ranges are sorted by start, so skip those that end before the address.
+            while range_index < len(line_ranges) and line_ranges[range_index].end <= address:
+                range_index += 1
+            if symbol_index < 0:
+                results.append(None)
+                continue
+            offset = address - self._symbol_addresses[symbol_index]
+            # Past the end of the closest symbol, e.g. in code only .symtab of a stripped file would name.
+            if 0 < self._symbol_sizes[symbol_index] <= offset:
+                results.append(None)
+                continue
+            symbol = self._symbol_names[symbol_index] + (f"+{hex(offset)}" if offset else "")
+            line_range = self._find_line_range(range_index, address)
+            if line_range is None:
+                results.append(Symbolization(symbol, None, 0))
+            else:
+                results.append(Symbolization(symbol, line_range.filename, line_range.line))
+        return results
+
+    def _find_line_range(self, range_index: int, address: int) -> Optional[_LineRange]:
+        # Ranges of discarded functions may overlap, the first one to contain the address wins.
+        line_ranges = self._line_ranges
+        while range_index < len(line_ranges) and line_ranges[range_index].start <= address:
+            if address < line_ranges[range_index].end:
+                return line_ranges[range_index]
+            range_index += 1
+        return None
+
+    def close(self):
+        self.elf.close()
+        if self.debug_elf is not None:
+            self.debug_elf.close()
+
+
+def symbolize_module(path: str, pcs: List[Tuple[int, int, int]]) -> Dict[int, Symbolization]:
+    """Symbolizes (pc, mapping start, mapping file offset) triples of the module at path."""
+    try:
+        symbolizer = ModuleSymbolizer(path)
+    except (OSError, ValueError, struct.error):
+        return dict()
+    try:
+        addresses = list()
+        biases = dict()
+        for pc, start, file_offset in pcs:
+            if (start, file_offset) not in biases:
+                biases[start, file_offset] = symbolizer.load_bias(start, file_offset)
+            bias = biases[start, file_offset]
+            if bias is not None:
+                addresses.append((pc - bias, pc))
+        addresses.sort()
+        results = symbolizer.symbolize([address for address, _ in addresses])
+        return {pc: symbolization for (_, pc), symbolization in zip(addresses, results) if symbolization is not None}
+    finally:
+        symbolizer.close()
+
+
+def group_by_module(pcs: Iterable[int], modules: Iterable[Module]) -> Dict[str, List[Tuple[int, int, int]]]:
+    modules = sorted(modules)
+    starts = [module.start for module in modules]
+    groups = collections.defaultdict(list)
+    for pc in pcs:
+        index = bisect.bisect_right(starts, pc) - 1
+        if index < 0 or pc >= modules[index].end:
+            continue
+        module = modules[index]
+        groups[module.name].append((pc, module.start, module.offset))
+    return groups
+
+
+def symbolize_batch(pcs: Iterable[int], modules: Iterable[Module], jobs: int = 1) -> Dict[int, Symbolization]:
+    """Symbolizes the pcs in-process, or in up to jobs processes spawned from sys.executable, which gdb is not."""
+    groups = group_by_module(pcs, modules)
+    jobs = min(jobs, len(groups))
+    symbols = dict()
+    if jobs > 1:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                for result in pool.map(symbolize_module, groups.keys(), groups.values()):
+                    symbols.update(result)
+            return demangle_symbols(symbols)
+        except (OSError, concurrent.futures.process.BrokenProcessPool):
+            symbols.clear()
+    for path, module_pcs in groups.items():
+        symbols.update(symbolize_module(path, module_pcs))
+    return demangle_symbols(symbols)
+
+
+def demangle(names: Iterable[str]) -> Dict[str, str]:
+    """Demangles the C++ names with a single c++filt run, an empty result if there is no c++filt."""
+    mangled = sorted({name for name in names if name.startswith("_Z")})
+    if not mangled:
+        return dict()
+    try:
+        result = subprocess.run(["c++filt"], input="\n".join(mangled), capture_output=True, text=True, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return dict()
+    demangled = result.stdout.splitlines()
+    if len(demangled) != len(mangled):
+        return dict()
+    return dict(zip(mangled, demangled))
+
+
+def demangle_symbols(symbols: Dict[int, Symbolization]) -> Dict[int, Symbolization]:
+    # Mangled names have no "+", so it only ever separates the offset.
+    demangled = demangle(symbolization.symbol.partition("+")[0] for symbolization in symbols.values())
+    if not demangled:
+        return symbols
+    for pc, symbolization in symbols.items():
+        name, separator, offset = symbolization.symbol.partition("+")
+        if name in demangled:
+            symbols[pc] = symbolization._replace(symbol=demangled[name] + separator + offset)
+    return symbols
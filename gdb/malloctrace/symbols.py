@@ -0,0 +1,25 @@
+from typing import Callable, NamedTuple, Optional
+
+
+UNKNOWN_SYMBOL = "<Unknwon>"
+
+
+class Symbolization(NamedTuple):
+    symbol: str
+    filename: Optional[str]
+    line: int
+
+
+class Module(NamedTuple):
+    start: int
+    end: int
+    offset: int
+    name: str
+
+
+def format_bt_line(address: int, symbolization: Symbolization, address_style: Callable[[str], str]=str, function_style: Callable[[str], str]=str, filename_style: Callable[[str], str]=str) -> str:
+    symbol = function_style(symbolization.symbol)
+    address = address_style(hex(address))
+    if symbolization.filename is None:
+        return f"{address} in {symbol} ()"
+    return f"{address} in {symbol} () at {filename_style(symbolization.filename)}:{symbolization.line}"
\ No newline at end of file
@@ -0,0 +1,71 @@
+#define _GNU_SOURCE
+
+#include "backtrace.h"
+
+#include <pthread.h>
+#include <stdint.h>
+
+uint8_t MALLOCTRACE_UNWINDER = UNWINDER_GLIBC;
+
+#define STACK_BOUNDS_UNKNOWN      0
+#define STACK_BOUNDS_INITIALIZING 1
+#define STACK_BOUNDS_KNOWN        2
+#define STACK_BOUNDS_UNAVAILABLE  3
+
+static THREAD_LOCAL uintptr_t STACK_LOW;
+static THREAD_LOCAL uintptr_t STACK_HIGH;
+// volatile, otherwise the compiler may drop the INITIALIZING store as dead.
+static THREAD_LOCAL volatile uint8_t STACK_BOUNDS_STATE = STACK_BOUNDS_UNKNOWN;
+
+static void load_stack_bounds() {
+    // pthread_getattr_np allocates while it holds the thread's lock, so it must not recurse into here.
+    STACK_BOUNDS_STATE = STACK_BOUNDS_INITIALIZING;
+    pthread_attr_t attr;
+    if (pthread_getattr_np(pthread_self(), &attr) != 0) {
+        STACK_BOUNDS_STATE = STACK_BOUNDS_UNAVAILABLE;
+        return;
+    }
+    void* stack_addr;
+    size_t stack_size;
+    int ret = pthread_attr_getstack(&attr, &stack_addr, &stack_size);
+    pthread_attr_destroy(&attr);
+    if (ret != 0) {
+        STACK_BOUNDS_STATE = STACK_BOUNDS_UNAVAILABLE;
+        return;
+    }
+    STACK_LOW = (uintptr_t)stack_addr;
+    STACK_HIGH = (uintptr_t)stack_addr + stack_size;
+    STACK_BOUNDS_STATE = STACK_BOUNDS_KNOWN;
+}
+
+// Walks the frame pointer chain, which only works for code built with
+// -fno-omit-frame-pointer. Every frame record is checked against the bounds of
+// the thread stack, so a broken chain ends the backtrace instead of faulting.
+// Like backtrace(3), the first frame is the return address into our caller.
+__attribute__((noinline)) int fp_backtrace(void** frames, uint32_t depth) {
+#if defined(__x86_64__) || defined(__aarch64__)
+    if (STACK_BOUNDS_STATE == STACK_BOUNDS_UNKNOWN)
+        load_stack_bounds();
+    if (STACK_BOUNDS_STATE != STACK_BOUNDS_KNOWN)
+        return 0;
+
+    // A frame record is {previous frame pointer, return address}.
+    uintptr_t fp = (uintptr_t)__builtin_frame_address(0);
+    uint32_t nptrs = 0;
+    while (nptrs < depth) {
+        if (fp < STACK_LOW || fp + 2 * sizeof(void*) > STACK_HIGH || fp % sizeof(void*) != 0)
+            break;
+        void** record = (void**)fp;
+        if (record[1] == NULL)
+            break;
+        frames[nptrs++] = record[1];
+        // The stack grows down, so the caller's record has to be above ours.
+        if ((uintptr_t)record[0] <= fp)
+            break;
+        fp = (uintptr_t)record[0];
+    }
+    return nptrs;
+#else
+    return backtrace(frames, depth);
+#endif
+}
\ No newline at end of file
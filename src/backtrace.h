@@ -1,17 +1,31 @@
 #pragma once
 #include <execinfo.h>
 #include <stdint.h>
+#include <string.h>
 
 #include "common.h"
 
-#define MAX_BACKTRACE_FRAMES 0x4
+// The backtrace depth is chosen at startup (MALLOCTRACE_BT_DEPTH), this is only its upper bound.
+#define DEFAULT_BACKTRACE_FRAMES 0x10
+#define MAX_BACKTRACE_FRAMES     0x40
 
-typedef struct {
-    void* frames[MAX_BACKTRACE_FRAMES];
-} bt;
+// Unwinding engines, chosen at startup (MALLOCTRACE_UNWINDER=glibc|fp)
+#define UNWINDER_GLIBC 0
+#define UNWINDER_FP    1
 
-ALWAYS_INLINE bt get_backtrace() {
-    bt bt;
-    int nptrs = backtrace(bt.frames, MAX_BACKTRACE_FRAMES);
-    return bt;
+extern uint8_t MALLOCTRACE_UNWINDER;
+
+int fp_backtrace(void** frames, uint32_t depth);
+
+// The hook itself (malloc, calloc or realloc), all of our code below it is inlined into it.
+#define HOOK_FRAMES 1
+
+// Fills frames with the return addresses of the caller of the hook and up.
+ALWAYS_INLINE void get_backtrace(void** frames, uint32_t depth) {
+    void* raw[MAX_BACKTRACE_FRAMES + HOOK_FRAMES];
+    int nptrs = MALLOCTRACE_UNWINDER == UNWINDER_FP ? fp_backtrace(raw, depth + HOOK_FRAMES) : backtrace(raw, depth + HOOK_FRAMES);
+    nptrs = nptrs > HOOK_FRAMES ? nptrs - HOOK_FRAMES : 0;
+    memcpy(frames, raw + HOOK_FRAMES, nptrs * sizeof(void*));
+    // Unused frames are zeroed, so they don't show up as garbage in the heap map.
+    memset(frames + nptrs, 0x0, (depth - nptrs) * sizeof(void*));
 }
\ No newline at end of file
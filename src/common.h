@@ -1,3 +1,13 @@
 #pragma once
 
-#define ALWAYS_INLINE __attribute__((always_inline)) inline
\ No newline at end of file
+#define ALWAYS_INLINE __attribute__((always_inline)) inline
+
+// Thread-local variables of a preloaded allocator must not go through __tls_get_addr,
+// as that may call malloc itself.
+#define THREAD_LOCAL __thread __attribute__((tls_model("initial-exec")))
+
+#if defined(__x86_64__) || defined(__i386__)
+#define CPU_RELAX() __builtin_ia32_pause()
+#else
+#define CPU_RELAX()
+#endif
\ No newline at end of file
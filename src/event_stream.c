@@ -0,0 +1,74 @@
+#define _GNU_SOURCE
+
+#include "event_stream.h"
+
+#include <fcntl.h>
+#include <limits.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+#include "logging.h"
+
+#define SHM_DIRECTORY "/dev/shm/"
+
+_Static_assert(sizeof(EventRecord) == 48, "EventRecord layout is read by the stream consumer");
+_Static_assert(sizeof(EventStreamHeader) == 128, "EventStreamHeader layout is read by the stream consumer");
+
+EventStreamHeader* MALLOCTRACE_EVENT_STREAM = NULL;
+
+static uint64_t clock_ns(clockid_t clock) {
+    struct timespec ts;
+    clock_gettime(clock, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+// Creates (or replaces) /dev/shm/<name> and maps it. Like shm_open, but
+// without anything that might allocate, as this runs from inside malloc.
+int event_stream_open(const char* name, uint64_t capacity) {
+    if (capacity == 0x0 || (capacity & (capacity - 1)) != 0x0) {
+        malloctrace_error("MALLOCTRACE_STREAM_SIZE has to be a power of two!\n");
+        return -1;
+    }
+    while (*name == '/')
+        ++name;
+    size_t name_length = strlen(name);
+    char path[PATH_MAX];
+    if (name_length == 0x0 || strchr(name, '/') != NULL || sizeof(SHM_DIRECTORY) + name_length > sizeof(path)) {
+        malloctrace_error("MALLOCTRACE_STREAM has to be a plain file name!\n");
+        return -1;
+    }
+    memcpy(path, SHM_DIRECTORY, sizeof(SHM_DIRECTORY) - 1);
+    memcpy(path + sizeof(SHM_DIRECTORY) - 1, name, name_length + 1);
+
+    size_t size = sizeof(EventStreamHeader) + capacity * sizeof(EventRecord);
+    int fd = open(path, O_RDWR | O_CREAT | O_TRUNC | O_CLOEXEC, 0600);
+    if (fd == -1)
+        return -1;
+    if (ftruncate(fd, size) == -1) {
+        close(fd);
+        return -1;
+    }
+    EventStreamHeader* stream = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (stream == MAP_FAILED)
+        return -1;
+
+    stream->version = EVENT_STREAM_VERSION;
+    stream->record_size = sizeof(EventRecord);
+    stream->capacity = capacity;
+    stream->monotonic_start = clock_ns(CLOCK_MONOTONIC);
+    stream->realtime_start = clock_ns(CLOCK_REALTIME);
+    stream->pid = getpid();
+    stream->head = 0;
+    // Readers check the magic last, so they never see a half initialized header.
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+    memcpy(stream->magic, EVENT_STREAM_MAGIC, sizeof(EVENT_STREAM_MAGIC));
+    __atomic_store_n(&MALLOCTRACE_EVENT_STREAM, stream, __ATOMIC_RELEASE);
+    return 0;
+}
+
+// Stops streaming. The mapping is kept, another thread may still be writing into it.
+void event_stream_close() {
+    __atomic_store_n(&MALLOCTRACE_EVENT_STREAM, NULL, __ATOMIC_RELEASE);
+}
@@ -0,0 +1,88 @@
+#pragma once
+#include <stddef.h>
+#include <stdint.h>
+#include <time.h>
+
+#include "common.h"
+
+// Optional stream of allocation events (MALLOCTRACE_STREAM=<name>).
+//
+// Every malloc, calloc, realloc and free appends one fixed-size EventRecord to a
+// ring in the shared memory file /dev/shm/<name>, laid out as
+//   [EventStreamHeader][EventRecord events[capacity]]
+// Writers reserve a sequence number with a single atomic add on `head`, fill
+// the slot it maps to and publish it by storing sequence + 1 into the record
+// last. Readers keep their own position, never write to the ring and never
+// block the writers: a record whose `sequence` is not the one they expect was
+// either not published yet, or already overwritten because they fell more than
+// `capacity` records behind. Readers copy a record and check `sequence` again
+// afterwards, to detect that it was overwritten while they copied it.
+//
+// A realloc is streamed as the free of the old chunk, followed by the
+// allocation of the new one, so replaying the events in sequence order always
+// gives the right live set, even if another thread got the old address handed
+// out in between.
+
+#define EVENT_STREAM_MAGIC   "MTRSTRM"
+#define EVENT_STREAM_VERSION 1
+// Records, must be a power of two (MALLOCTRACE_STREAM_SIZE)
+#define DEFAULT_EVENT_STREAM_CAPACITY 0x10000
+
+#define EVENT_MALLOC  1
+#define EVENT_CALLOC  2
+#define EVENT_REALLOC 3
+#define EVENT_FREE    4
+
+typedef struct {
+    uint64_t sequence; // sequence number + 1 once the record is published, 0 while it is written
+    uint64_t timestamp; // CLOCK_MONOTONIC in ns
+    uint64_t address;
+    uint64_t size;        // 0 for frees, readers take the size from their live set
+    uint64_t old_address; // the chunk a realloc replaced, 0 otherwise
+    uint32_t stack_id;    // id of the recorded backtrace in the stack table, 0 if the allocation was not sampled
+    uint8_t op;
+    uint8_t reserved[3];
+} EventRecord;
+
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t record_size;
+    uint64_t capacity;
+    uint64_t monotonic_start; // CLOCK_MONOTONIC and CLOCK_REALTIME in ns when the stream was created,
+    uint64_t realtime_start;  // so readers can turn record timestamps into wall-clock time
+    int32_t pid;
+    uint8_t reserved[20];
+    // Written by every thread, so it gets a cache line of its own.
+    _Alignas(64) uint64_t head;
+    _Alignas(64) EventRecord events[];
+} EventStreamHeader;
+
+extern EventStreamHeader* MALLOCTRACE_EVENT_STREAM;
+
+int event_stream_open(const char* name, uint64_t capacity);
+void event_stream_close();
+
+ALWAYS_INLINE uint64_t event_stream_now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+ALWAYS_INLINE void event_stream_append(uint8_t op, void* address, size_t size, void* old_address, uint32_t stack_id) {
+    EventStreamHeader* stream = MALLOCTRACE_EVENT_STREAM;
+    if (stream == NULL)
+        return;
+    uint64_t sequence = __atomic_fetch_add(&stream->head, 1, __ATOMIC_RELAXED);
+    EventRecord* record = &stream->events[sequence & (stream->capacity - 1)];
+    // Unpublish the slot first, so nobody takes the old record for the new one while it is half written.
+    __atomic_store_n(&record->sequence, 0, __ATOMIC_RELAXED);
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+    record->timestamp = event_stream_now();
+    record->address = (uintptr_t)address;
+    record->size = size;
+    record->old_address = (uintptr_t)old_address;
+    record->stack_id = stack_id;
+    record->op = op;
+    __atomic_store_n(&record->sequence, sequence + 1, __ATOMIC_RELEASE);
+}
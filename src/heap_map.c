@@ -1,107 +1,214 @@
+#define _GNU_SOURCE
+
 #include "heap_map.h"
 
 #include <assert.h>
 #include <string.h>
 #include <sys/mman.h>
+#include <unistd.h>
 
+#include "common.h"
 #include "logging.h"
 
-HeapMap* heap_map_new(size_t size) {
+// We keep the load factor of the index at or below 1/2, so every entry costs
+// its descriptor plus at least two index slots.
+#define INDEX_SLOTS_PER_ENTRY 2
+#define EMPTY_SLOT            0x0
+
+static size_t round_up_to_pages(size_t size) {
+    size_t page_size = sysconf(_SC_PAGESIZE);
+    return (size + page_size - 1) & ~(page_size - 1);
+}
+
+// Splits the data mapping into the entries and the index behind them.
+static int heap_map_layout(HeapMap* map, void* data, size_t data_size) {
+    size_t entries = data_size / (map->entry_size + INDEX_SLOTS_PER_ENTRY * sizeof(uint32_t));
+    if (entries == 0x0)
+        return -1;
+    if (entries > UINT32_MAX / INDEX_SLOTS_PER_ENTRY)
+        entries = UINT32_MAX / INDEX_SLOTS_PER_ENTRY;
+    map->base = data;
+    map->size = entries * map->entry_size;
+    // The index takes all the remaining bytes.
+    map->index = (uint32_t*)(map->base + map->size);
+    map->index_capacity = (data_size - map->size) / sizeof(uint32_t);
+    return 0;
+}
+
+static size_t heap_map_data_size(HeapMap* map) {
+    return (void*)(map->index + map->index_capacity) - map->base;
+}
+
+HeapMap* heap_map_new(size_t size, size_t max_size, uint32_t backtrace_depth) {
     assert(size != 0x0);
-    if (size <= sizeof(HeapMap))
+    assert(backtrace_depth <= MAX_BACKTRACE_FRAMES);
+    // The data mapping grows with mremap, so both sizes are kept in whole pages.
+    size = round_up_to_pages(size);
+    max_size = round_up_to_pages(max_size);
+    if (max_size < size)
+        max_size = size;
+    // The header lives in a mapping of its own, so it stays put when the data mapping moves.
+    HeapMap* map = mmap(NULL, sizeof(HeapMap), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (map == MAP_FAILED)
         return NULL;
-    void* map_page = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
-    if (map_page == MAP_FAILED) {
+    void* data = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (data == MAP_FAILED) {
+        munmap(map, sizeof(HeapMap));
         return NULL;
     }
 
-    HeapMap* map = (HeapMap*)map_page;
-    map->base = map_page + sizeof(HeapMap);
-    map->size = size - sizeof(HeapMap);
+    map->backtrace_depth = backtrace_depth;
+    map->entry_size = sizeof(AllocationDesc);
+    map->max_size = max_size;
+    if (heap_map_layout(map, data, size) == -1) {
+        munmap(data, size);
+        munmap(map, sizeof(HeapMap));
+        return NULL;
+    }
     map->head = map->base;
     return map;
 }
 
 int heap_map_destroy(HeapMap* map) {
-    int ret = munmap(map->base - sizeof(HeapMap), map->size + sizeof(HeapMap));
-    if (ret == -1) {
+    if (munmap(map->base, heap_map_data_size(map)) == -1)
+        return -1;
+    if (munmap(map, sizeof(HeapMap)) == -1) {
         return -1;
     }
     map = NULL;
     return 0;
 }
 
-// TODO: Refactor and improve this algorithm/design. Right now i just want it to
-// work.
-int heap_map_insert(HeapMap* map, AllocationDesc* allocation) {
-    // Just insert it at head.
-    if ((void*)(map->head + 1) > (void*)(map->base + map->size)) {
-        // We don't have enough memory left...
+//
+// Index
+//
+ALWAYS_INLINE static size_t index_home_slot(HeapMap* map, void* address) {
+    // Fibonacci hashing, then map the upper 32 bits onto [0, index_capacity).
+    uint64_t hash = (uint64_t)(uintptr_t)address * 0x9E3779B97F4A7C15ull;
+    return (size_t)(((hash >> 32) * (uint64_t)map->index_capacity) >> 32);
+}
+
+ALWAYS_INLINE static size_t index_next_slot(HeapMap* map, size_t slot) {
+    slot += 1;
+    return slot == map->index_capacity ? 0x0 : slot;
+}
+
+ALWAYS_INLINE static AllocationDesc* heap_map_entry(HeapMap* map, size_t position) {
+    return (AllocationDesc*)(map->base + position * map->entry_size);
+}
+
+ALWAYS_INLINE static AllocationDesc* index_entry(HeapMap* map, size_t slot) {
+    return heap_map_entry(map, map->index[slot] - 1);
+}
+
+// Returns the slot holding `address`, or the empty slot where it would be inserted.
+static size_t index_find_slot(HeapMap* map, void* address) {
+    size_t slot = index_home_slot(map, address);
+    while (map->index[slot] != EMPTY_SLOT && index_entry(map, slot)->chunk.address != address) {
+        slot = index_next_slot(map, slot);
+    }
+    return slot;
+}
+
+// Backward-shift deletion: pull every following entry of the probe sequence
+// one step closer to its home slot, so no tombstones are needed.
+static void index_delete_slot(HeapMap* map, size_t slot) {
+    size_t hole = slot;
+    size_t next = index_next_slot(map, hole);
+    while (map->index[next] != EMPTY_SLOT) {
+        size_t home = index_home_slot(map, index_entry(map, next)->chunk.address);
+        // Move `next` into the hole, unless its home lies cyclically in (hole, next].
+        int home_in_between = (hole <= next) ? (hole < home && home <= next) : (hole < home || home <= next);
+        if (!home_in_between) {
+            map->index[hole] = map->index[next];
+            hole = next;
+        }
+        next = index_next_slot(map, next);
+    }
+    map->index[hole] = EMPTY_SLOT;
+}
+
+// Doubles the data mapping, up to max_size. mremap may move it, so base, head
+// and index are all reassigned, and the index is rebuilt for its new capacity.
+static int heap_map_grow(HeapMap* map) {
+    size_t data_size = heap_map_data_size(map);
+    if (data_size >= map->max_size)
+        return -1;
+    size_t new_data_size = data_size > map->max_size / 2 ? map->max_size : 2 * data_size;
+    void* data = mremap(map->base, data_size, new_data_size, MREMAP_MAYMOVE);
+    if (data == MAP_FAILED)
         return -1;
+    size_t used = (void*)map->head - map->base;
+    heap_map_layout(map, data, new_data_size);
+    map->head = map->base + used;
+    memset(map->index, 0x0, map->index_capacity * sizeof(uint32_t));
+    size_t position = 0;
+    for (AllocationDesc* entry = map->base; entry < map->head; entry = heap_map_next_entry(map, entry)) {
+        // Addresses are unique, so this always ends at an empty slot.
+        map->index[index_find_slot(map, entry->chunk.address)] = ++position;
+    }
+    return 0;
+}
+
+int heap_map_insert(HeapMap* map, AllocationDesc* allocation) {
+    size_t slot = index_find_slot(map, allocation->chunk.address);
+    if (map->index[slot] != EMPTY_SLOT) {
+        // We missed the free of this chunk, so just replace the stale entry.
+        memcpy(index_entry(map, slot), allocation, map->entry_size);
+        return 0;
+    }
+    if ((void*)heap_map_next_entry(map, map->head) > (void*)(map->base + map->size)) {
+        if (heap_map_grow(map) == -1) {
+            // We hit the ceiling (or ran out of memory), so this allocation goes unrecorded.
+            map->dropped++;
+            return -1;
+        }
+        slot = index_find_slot(map, allocation->chunk.address);
     }
-    *map->head = *allocation;
-    map->head += 1;
+    memcpy(map->head, allocation, map->entry_size);
+    map->index[slot] = (uint32_t)(((void*)map->head - map->base) / map->entry_size) + 1;
+    map->head = heap_map_next_entry(map, map->head);
     return 0;
 }
 
-int heap_map_remove(HeapMap* map, DeallocationDesc* deallocation) {
-    AllocationDesc* allocation = heap_map_search(map, &deallocation->chunk);
-    if (allocation == NULL)
+int heap_map_remove(HeapMap* map, DeallocationDesc* deallocation, AllocationDesc* removed) {
+    size_t slot = index_find_slot(map, deallocation->chunk.address);
+    if (map->index[slot] == EMPTY_SLOT)
         return -1;
-    for (; allocation < map->head - 1; allocation += 1) {
-        memcpy(allocation, allocation + 1, sizeof(AllocationDesc));
+    AllocationDesc* allocation = index_entry(map, slot);
+    if (removed != NULL)
+        memcpy(removed, allocation, map->entry_size);
+    AllocationDesc* last = (AllocationDesc*)((void*)map->head - map->entry_size);
+    if (allocation != last) {
+        // Keep the entries dense by moving the last entry into the freed position.
+        size_t last_slot = index_find_slot(map, last->chunk.address);
+        memcpy(allocation, last, map->entry_size);
+        map->index[last_slot] = map->index[slot];
     }
-    // theoretically we don't need this memset, so for performance we could delete
-    // it. We only need the head update.
-    memset(allocation, 0x0, sizeof(AllocationDesc));
-    map->head = allocation;
+    index_delete_slot(map, slot);
+    map->head = last;
     return 0;
 }
 
 void heap_map_clear(HeapMap* map) {
     map->head = map->base;
+    memset(map->index, 0x0, map->index_capacity * sizeof(uint32_t));
 }
 
 CapacityDesc heap_map_capacity(HeapMap* map) {
     size_t total_bytes = map->size;
     size_t free_bytes = (map->base - (void*)map->head) + map->size;
-    size_t total_entries = total_bytes / sizeof(HeapMap);
-    size_t free_entries = free_bytes / sizeof(HeapMap);
-    CapacityDesc capacity_desc = {.total_bytes = total_bytes, .free_bytes = free_bytes, .total_entries = total_entries, .free_entries = free_entries};
+    size_t total_entries = total_bytes / map->entry_size;
+    size_t free_entries = free_bytes / map->entry_size;
+    // Entries take the same share of the data mapping at any size.
+    size_t max_bytes = (size_t)((double)map->max_size / heap_map_data_size(map) * map->size);
+    size_t max_entries = max_bytes / map->entry_size;
+    CapacityDesc capacity_desc = {.total_bytes = total_bytes,
+                                  .free_bytes = free_bytes,
+                                  .total_entries = total_entries,
+                                  .free_entries = free_entries,
+                                  .max_bytes = max_entries * map->entry_size,
+                                  .max_entries = max_entries,
+                                  .dropped = map->dropped};
     return capacity_desc;
 }
-
-typedef struct {
-    Chunk* chunk;
-    AllocationDesc* found;
-} SearchData;
-int search(AllocationDesc* allocation, void* data) {
-    SearchData* comparison_data = (SearchData*)data;
-    if (allocation->chunk.address == comparison_data->chunk->address) {
-        comparison_data->found = allocation;
-        return -1;
-    }
-}
-AllocationDesc* heap_map_search(HeapMap* map, Chunk* chunk) {
-    SearchData search_data = {.chunk = chunk, .found = NULL};
-    heap_map_for_each(map, search, &search_data);
-    return search_data.found;
-}
-
-void heap_map_for_each(HeapMap* map, ForEachCallback callback, void* data) {
-    for (AllocationDesc* ptr = map->base; ptr < map->head; ptr += 1) {
-        if (callback(ptr, data) == -1) {
-            return;
-        }
-    }
-}
-
-void heap_map_for_each_in_range(HeapMap* map, Chunk* start_chunk, Chunk* end_chunk, ForEachCallback callback, void* data) {
-    for (AllocationDesc* ptr = map->base; ptr < map->head; ptr += 1) {
-        if (start_chunk->address <= ptr->chunk.address && ptr->chunk.address <= end_chunk->address) {
-            if (callback(ptr, data) == -1) {
-                return;
-            }
-        }
-    }
-}
\ No newline at end of file
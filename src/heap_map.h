@@ -2,6 +2,9 @@
 
 #include <execinfo.h>
 #include <stddef.h>
+#include <sched.h>
+#include <stdint.h>
+#include <sys/types.h>
 
 #include "backtrace.h"
 
@@ -12,17 +15,46 @@ typedef struct {
 
 typedef struct {
     Chunk chunk;
-    bt backtrace;
+    uint64_t sequence;  // position of the allocation among all recorded ones, starting at 1
+    uint64_t timestamp; // CLOCK_MONOTONIC_COARSE in ns when the chunk was allocated
+    pid_t tid;          // thread that allocated the chunk
+    uint32_t stack_id;  // backtrace of the allocation in the stack table, see stack_table.h
 } AllocationDesc;
 
 typedef struct {
     Chunk chunk;
 } DeallocationDesc;
 
-typedef struct {
+// The HeapMap header lives in a mapping of its own. The data lives in a second
+// anonymous mapping laid out as
+//   [AllocationDesc entries...][uint32_t index slots...]
+// which starts small and grows geometrically with mremap up to max_size bytes.
+// Growing may move it, so readers must always go through base, head and index.
+// Entries are kept dense in [base, head), so walkers only need base and head.
+// Every entry is entry_size bytes long and refers to a backtrace of
+// backtrace_depth frames in the stack table, readers have to take both from
+// the map instead of assuming them.
+// With sampling enabled (sample_bytes != 0) the entries are only a sample of
+// all live chunks, which readers have to scale up, see sampler.h.
+// The index is an open-addressing (linear probing) hash table keyed by chunk
+// address. A slot holds the entry position + 1, or 0 if it is empty.
+// Every thread records into its own map. All maps are chained through `next`
+// and each one is guarded by its own spinlock, which is only contended when
+// another thread frees a chunk that was allocated in this map.
+typedef struct HeapMap {
     void* base;
     size_t size;
     AllocationDesc* head;
+    uint32_t* index;
+    size_t index_capacity;
+    struct HeapMap* next;
+    int32_t lock;
+    pid_t owner; // tid of the thread recording into this map, 0 if it is free to be claimed
+    uint32_t backtrace_depth;
+    uint32_t entry_size;
+    uint64_t sample_bytes; // MALLOCTRACE_SAMPLE_BYTES the entries were sampled with, 0 if every allocation is recorded
+    size_t max_size;       // ceiling for the data mapping in bytes
+    uint64_t dropped;      // allocations that could not be recorded because the map could not grow any more
 } HeapMap;
 
 typedef struct {
@@ -30,17 +62,39 @@ typedef struct {
     size_t free_entries;
     size_t total_bytes;
     size_t total_entries;
+    size_t max_bytes;
+    size_t max_entries;
+    uint64_t dropped;
 } CapacityDesc;
 
-HeapMap* heap_map_new(size_t size);
+HeapMap* heap_map_new(size_t size, size_t max_size, uint32_t backtrace_depth);
 int heap_map_destroy(HeapMap* map);
 
 int heap_map_insert(HeapMap* map, AllocationDesc* allocation);
-int heap_map_remove(HeapMap* map, DeallocationDesc* chunk);
+int heap_map_remove(HeapMap* map, DeallocationDesc* deallocation, AllocationDesc* removed);
 void heap_map_clear(HeapMap* map);
 CapacityDesc heap_map_capacity(HeapMap* map);
 
-AllocationDesc* heap_map_search(HeapMap* map, Chunk* chunk);
-typedef int (*ForEachCallback)(AllocationDesc*, void*);
-void heap_map_for_each(HeapMap* map, ForEachCallback callback, void* data);
-void heap_map_for_each_in_range(HeapMap* map, Chunk* start_chunk, Chunk* end_chunk, ForEachCallback callback, void* data);
\ No newline at end of file
+// Entries are entry_size bytes apart, which need not be sizeof(AllocationDesc).
+ALWAYS_INLINE AllocationDesc* heap_map_next_entry(HeapMap* map, AllocationDesc* entry) {
+    return (AllocationDesc*)((void*)entry + map->entry_size);
+}
+
+#define LOCK_SPINS_BEFORE_YIELD 0x40
+
+ALWAYS_INLINE void heap_map_lock(HeapMap* map) {
+    while (__atomic_exchange_n(&map->lock, 1, __ATOMIC_ACQUIRE)) {
+        // Give the lock holder a chance to run if it got preempted.
+        for (int spins = 0; __atomic_load_n(&map->lock, __ATOMIC_RELAXED); ++spins) {
+            if (spins < LOCK_SPINS_BEFORE_YIELD) {
+                CPU_RELAX();
+            } else {
+                sched_yield();
+            }
+        }
+    }
+}
+
+ALWAYS_INLINE void heap_map_unlock(HeapMap* map) {
+    __atomic_store_n(&map->lock, 0, __ATOMIC_RELEASE);
+}
@@ -4,16 +4,36 @@
 
 #include <assert.h>
 #include <dlfcn.h>
+#include <limits.h>
+#include <pthread.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
+#include <sys/syscall.h>
+#include <time.h>
+#include <unistd.h>
 
 #include "backtrace.h"
 #include "common.h"
+#include "event_stream.h"
 #include "heap_map.h"
 #include "logging.h"
+#include "report.h"
+#include "sampler.h"
+#include "stack_table.h"
 
+// Head of the list of all per-thread heap maps.
 HeapMap* MALLOCTRACE_HEAP_MAP;
+static size_t MALLOCTRACE_HEAP_MAP_SIZE;
+static size_t MALLOCTRACE_HEAP_MAP_MAX_SIZE;
+// The backtraces the entries of all heap maps refer to.
+StackTable* MALLOCTRACE_STACK_TABLE;
+static uint32_t MALLOCTRACE_STACK_TABLE_SIZE;
+static uint32_t MALLOCTRACE_BT_DEPTH = DEFAULT_BACKTRACE_FRAMES;
+static pthread_key_t MALLOCTRACE_THREAD_KEY;
+static THREAD_LOCAL HeapMap* THREAD_HEAP_MAP;
+static THREAD_LOCAL pid_t THREAD_ID;
 
 #define ERR_UNINITIALIZED -1
 #define ERR_NONE          0
@@ -22,15 +42,17 @@ HeapMap* MALLOCTRACE_HEAP_MAP;
 int8_t MALLOCTRACE_ERR_CODE = ERR_UNINITIALIZED;
 
 uint8_t MALLOCTRACE_ACTIVE = 0;
-uint8_t MALLOCTRACE_DEPTH = 0;
+THREAD_LOCAL uint8_t MALLOCTRACE_DEPTH = 0;
 
-uint8_t MALLOC_HOOK_ACTIVE = 1;
-uint8_t REALLOC_HOOK_ACTIVE = 1;
-uint8_t CALLOC_HOOK_ACTIVE = 1;
-uint8_t FREE_HOOK_ACTIVE = 1;
+THREAD_LOCAL uint8_t MALLOC_HOOK_ACTIVE = 1;
+THREAD_LOCAL uint8_t REALLOC_HOOK_ACTIVE = 1;
+THREAD_LOCAL uint8_t CALLOC_HOOK_ACTIVE = 1;
+THREAD_LOCAL uint8_t FREE_HOOK_ACTIVE = 1;
 
-#define DEFAULT_MAP_SIZE    0x4000
-#define MAX_RECURSION_DEPTH 0x8
+#define DEFAULT_MAP_SIZE         0x4000
+#define DEFAULT_MAP_MAX_SIZE     0x10000000
+#define DEFAULT_STACK_TABLE_SIZE 0x10000
+#define MAX_RECURSION_DEPTH      0x8
 
 #define ENTER_HANDLER_SECTION(HOOK)       \
     assert(MALLOCTRACE_HEAP_MAP != NULL); \
@@ -41,6 +63,197 @@ uint8_t FREE_HOOK_ACTIVE = 1;
     HOOK##_HOOK_ACTIVE = 1;         \
     MALLOCTRACE_DEPTH--;
 
+//
+// Per-thread heap maps
+//
+static void malloctrace_release_heap_map(void* map) {
+    // Keep the entries of an exited thread around and let the next new thread record into its map.
+    __atomic_store_n(&((HeapMap*)map)->owner, 0, __ATOMIC_RELEASE);
+}
+
+// The tid is looked up once per thread, allocations only read it from TLS.
+ALWAYS_INLINE static pid_t thread_id() {
+    if (THREAD_ID == 0)
+        THREAD_ID = syscall(SYS_gettid);
+    return THREAD_ID;
+}
+
+static HeapMap* malloctrace_claim_heap_map() {
+    pid_t tid = thread_id();
+    for (HeapMap* map = __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_ACQUIRE); map != NULL; map = map->next) {
+        pid_t free_owner = 0;
+        if (__atomic_compare_exchange_n(&map->owner, &free_owner, tid, 0, __ATOMIC_ACQ_REL, __ATOMIC_RELAXED)) {
+            return map;
+        }
+    }
+    HeapMap* map = heap_map_new(MALLOCTRACE_HEAP_MAP_SIZE, MALLOCTRACE_HEAP_MAP_MAX_SIZE, MALLOCTRACE_BT_DEPTH);
+    if (map == NULL)
+        return NULL;
+    map->owner = tid;
+    map->sample_bytes = MALLOCTRACE_SAMPLE_BYTES;
+    map->next = __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_RELAXED);
+    while (!__atomic_compare_exchange_n(&MALLOCTRACE_HEAP_MAP, &map->next, map, 1, __ATOMIC_RELEASE, __ATOMIC_RELAXED))
+        ;
+    return map;
+}
+
+ALWAYS_INLINE static HeapMap* thread_heap_map() {
+    if (THREAD_HEAP_MAP == NULL) {
+        THREAD_HEAP_MAP = malloctrace_claim_heap_map();
+        // pthread_setspecific may allocate, so THREAD_HEAP_MAP has to be set before.
+        if (THREAD_HEAP_MAP != NULL)
+            pthread_setspecific(MALLOCTRACE_THREAD_KEY, THREAD_HEAP_MAP);
+    }
+    return THREAD_HEAP_MAP;
+}
+
+// The maps locked across a fork. Maps are only ever pushed to the front of the
+// list, so these are the maps from this one to the end.
+static HeapMap* FORK_LOCKED_MAPS;
+
+// No thread may be in the middle of changing a map while another one forks,
+// the child would inherit the map locked without a thread to unlock it.
+static void malloctrace_before_fork() {
+    FORK_LOCKED_MAPS = __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_ACQUIRE);
+    for (HeapMap* map = FORK_LOCKED_MAPS; map != NULL; map = map->next) {
+        heap_map_lock(map);
+    }
+}
+
+static void malloctrace_after_fork_parent() {
+    for (HeapMap* map = FORK_LOCKED_MAPS; map != NULL; map = map->next) {
+        heap_map_unlock(map);
+    }
+}
+
+// A forked child only has the thread that forked. Its map gets the new tid, the
+// maps of all other threads are free to be claimed by the threads of the child.
+// Maps pushed after the locks were taken may have been locked by their thread
+// as well, so every lock is released, not only the ones taken before the fork.
+static void malloctrace_after_fork_child() {
+    THREAD_ID = 0;
+    for (HeapMap* map = __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_ACQUIRE); map != NULL; map = map->next) {
+        __atomic_store_n(&map->owner, map == THREAD_HEAP_MAP ? thread_id() : 0, __ATOMIC_RELEASE);
+        heap_map_unlock(map);
+    }
+}
+
+static void malloctrace_insert(AllocationDesc* allocation) {
+    HeapMap* map = thread_heap_map();
+    if (map == NULL) {
+        malloctrace_warning("Couldn't create a heap map for this thread!\n");
+        return;
+    }
+    heap_map_lock(map);
+    int ret = heap_map_insert(map, allocation);
+    heap_map_unlock(map);
+    if (ret == -1) {
+        malloctrace_warning("Couldn't insert into heap map: it is full and can't grow any further!\n");
+        return;
+    }
+    sampler_note_recorded(allocation->chunk.address);
+}
+
+// Numbers the recorded allocations, so entries can be ordered by age across all heap maps.
+static uint64_t MALLOCTRACE_ALLOCATION_SEQUENCE = 0;
+
+// Stamps a new allocation with its age and thread. The coarse clock is read
+// from the vDSO without a syscall, its resolution of a few milliseconds is
+// plenty for telling long-lived chunks from churn.
+ALWAYS_INLINE static void malloctrace_stamp(AllocationDesc* allocation) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC_COARSE, &ts);
+    allocation->sequence = __atomic_add_fetch(&MALLOCTRACE_ALLOCATION_SEQUENCE, 1, __ATOMIC_RELAXED);
+    allocation->timestamp = (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+    allocation->tid = thread_id();
+}
+
+ALWAYS_INLINE static void malloctrace_record_stack(AllocationDesc* allocation) {
+    void* frames[MAX_BACKTRACE_FRAMES];
+    get_backtrace(frames, MALLOCTRACE_BT_DEPTH);
+    allocation->stack_id = stack_table_intern(MALLOCTRACE_STACK_TABLE, frames);
+}
+
+static int malloctrace_remove_from(HeapMap* map, DeallocationDesc* deallocation, AllocationDesc* removed) {
+    heap_map_lock(map);
+    int ret = heap_map_remove(map, deallocation, removed);
+    heap_map_unlock(map);
+    return ret;
+}
+
+// Removes the chunk from whichever heap map recorded it. The own map is tried
+// first; only frees of chunks allocated by other threads have to look further.
+static int malloctrace_remove_from_any(DeallocationDesc* deallocation, AllocationDesc* removed) {
+    HeapMap* own_map = THREAD_HEAP_MAP;
+    if (own_map != NULL && malloctrace_remove_from(own_map, deallocation, removed) == 0)
+        return 0;
+    for (HeapMap* map = __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_ACQUIRE); map != NULL; map = map->next) {
+        if (map != own_map && malloctrace_remove_from(map, deallocation, removed) == 0)
+            return 0;
+    }
+    return -1;
+}
+
+static int malloctrace_remove(DeallocationDesc* deallocation, AllocationDesc* removed) {
+    void* address = deallocation->chunk.address;
+    if (!sampler_may_be_recorded(address) || malloctrace_remove_from_any(deallocation, removed) == -1)
+        return -1;
+    sampler_note_removed(address);
+    return 0;
+}
+
+//
+// Event stream
+//
+static void malloctrace_open_event_stream() {
+    char* name = getenv("MALLOCTRACE_STREAM");
+    if (name == NULL)
+        return;
+    uint64_t capacity = DEFAULT_EVENT_STREAM_CAPACITY;
+    char* stream_size;
+    if ((stream_size = getenv("MALLOCTRACE_STREAM_SIZE")) != NULL) {
+        capacity = strtoull(stream_size, NULL, 10);
+    }
+    if (event_stream_open(name, capacity) == -1) {
+        malloctrace_error("Couldn't create the event stream, allocations won't be streamed!\n");
+        return;
+    }
+    // Children would otherwise append their allocations to the stream of their parent.
+    pthread_atfork(NULL, NULL, event_stream_close);
+}
+
+ALWAYS_INLINE static uint32_t stack_id(AllocationDesc* allocation) {
+    return allocation == NULL ? 0 : allocation->stack_id;
+}
+
+//
+// Exit-time report
+//
+static char MALLOCTRACE_REPORT_PATH[PATH_MAX];
+
+static void malloctrace_read_report_path() {
+    char* path = getenv("MALLOCTRACE_REPORT");
+    if (path == NULL || *path == '\0')
+        return;
+    if (strlen(path) >= sizeof(MALLOCTRACE_REPORT_PATH)) {
+        malloctrace_error("MALLOCTRACE_REPORT is too long, no report will be written!\n");
+        return;
+    }
+    // The environment may be changed by the program until it exits.
+    strcpy(MALLOCTRACE_REPORT_PATH, path);
+}
+
+// Runs after the destructors and atexit handlers of the program, as the
+// preloaded library is the first one initialized and the last one finalized.
+__attribute__((destructor)) void malloctrace_write_report() {
+    if (MALLOCTRACE_REPORT_PATH[0] == '\0' || MALLOCTRACE_ERR_CODE != ERR_NONE)
+        return;
+    // Stop recording, so the report may allocate and the heap maps hold still.
+    MALLOCTRACE_ACTIVE = 0;
+    if (report_write(MALLOCTRACE_REPORT_PATH, __atomic_load_n(&MALLOCTRACE_HEAP_MAP, __ATOMIC_ACQUIRE), MALLOCTRACE_STACK_TABLE) == -1)
+        malloctrace_error("Couldn't write the report to %s!\n", MALLOCTRACE_REPORT_PATH);
+}
+
 //
 // Initialization
 //
@@ -52,14 +265,65 @@ static void malloctrace_init() {
     if ((map_size = getenv("MALLOCTRACE_MAP_SIZE")) != NULL) {
         heap_map_size = strtoul(map_size, NULL, 10);
     }
-    MALLOCTRACE_HEAP_MAP = heap_map_new(heap_map_size);
-    if (MALLOCTRACE_HEAP_MAP == NULL) {
+    MALLOCTRACE_HEAP_MAP_SIZE = heap_map_size;
+    size_t heap_map_max_size = DEFAULT_MAP_MAX_SIZE;
+    char* map_max_size;
+    if ((map_max_size = getenv("MALLOCTRACE_MAP_MAX_SIZE")) != NULL) {
+        heap_map_max_size = strtoul(map_max_size, NULL, 10);
+    }
+    MALLOCTRACE_HEAP_MAP_MAX_SIZE = heap_map_max_size;
+    char* bt_depth;
+    if ((bt_depth = getenv("MALLOCTRACE_BT_DEPTH")) != NULL) {
+        unsigned long depth = strtoul(bt_depth, NULL, 10);
+        MALLOCTRACE_BT_DEPTH = depth > MAX_BACKTRACE_FRAMES ? MAX_BACKTRACE_FRAMES : depth;
+    }
+    MALLOCTRACE_STACK_TABLE_SIZE = DEFAULT_STACK_TABLE_SIZE;
+    char* stack_table_size;
+    if ((stack_table_size = getenv("MALLOCTRACE_STACK_TABLE_SIZE")) != NULL) {
+        MALLOCTRACE_STACK_TABLE_SIZE = strtoul(stack_table_size, NULL, 10);
+    }
+    char* sample_bytes;
+    if ((sample_bytes = getenv("MALLOCTRACE_SAMPLE_BYTES")) != NULL) {
+        MALLOCTRACE_SAMPLE_BYTES = strtoull(sample_bytes, NULL, 10);
+    }
+    char* unwinder;
+    if ((unwinder = getenv("MALLOCTRACE_UNWINDER")) != NULL) {
+        if (strcmp(unwinder, "fp") == 0) {
+            MALLOCTRACE_UNWINDER = UNWINDER_FP;
+        } else if (strcmp(unwinder, "glibc") == 0) {
+            MALLOCTRACE_UNWINDER = UNWINDER_GLIBC;
+        }
+    }
+    if (MALLOCTRACE_STACK_TABLE == NULL)
+        MALLOCTRACE_STACK_TABLE = stack_table_new(MALLOCTRACE_STACK_TABLE_SIZE, MALLOCTRACE_BT_DEPTH);
+    if (MALLOCTRACE_STACK_TABLE == NULL) {
+        malloctrace_error("Couldn't create the stack table, MALLOCTRACE_STACK_TABLE_SIZE has to be at least 2!\n");
+        MALLOCTRACE_ERR_CODE = ERR_MAP_ALLOC;
+        MALLOCTRACE_ACTIVE = 0;
+        return;
+    }
+    if (pthread_key_create(&MALLOCTRACE_THREAD_KEY, malloctrace_release_heap_map) != 0) {
+        MALLOCTRACE_ERR_CODE = ERR_MAP_ALLOC;
+        MALLOCTRACE_ACTIVE = 0;
+        return;
+    }
+    if (thread_heap_map() == NULL) {
+        pthread_key_delete(MALLOCTRACE_THREAD_KEY);
         MALLOCTRACE_ERR_CODE = ERR_MAP_ALLOC;
         MALLOCTRACE_ACTIVE = 0;
         return;
     }
     MALLOCTRACE_ERR_CODE = ERR_NONE;
+    // backtrace(3) loads libgcc_s on its first call, which allocates. Done
+    // here before recording starts, otherwise those allocations could get
+    // sampled and recurse into the half-loaded unwinder.
+    void* frame;
+    backtrace(&frame, 1);
     MALLOCTRACE_ACTIVE = 1;
+    malloctrace_read_report_path();
+    // Only once everything else is set up, pthread_atfork may allocate.
+    pthread_atfork(malloctrace_before_fork, malloctrace_after_fork_parent, malloctrace_after_fork_child);
+    malloctrace_open_event_stream();
 }
 
 //
@@ -93,8 +357,10 @@ void free(void* ptr) {
         malloctrace_patch_functions();
     if (MALLOCTRACE_ERR_CODE != ERR_NONE)
         malloctrace_init();
-    _original_free(ptr);
+    // Forget the chunk before it is released, otherwise another thread could
+    // get the same address handed out before we removed it.
     handle_free(ptr);
+    _original_free(ptr);
 }
 
 void* calloc(size_t nmemb, size_t size) {
@@ -112,26 +378,33 @@ void* realloc(void* ptr, size_t size) {
         malloctrace_patch_functions();
     if (MALLOCTRACE_ERR_CODE != ERR_NONE)
         malloctrace_init();
+    // Like free, the old chunk has to be taken out before realloc may release it.
+    AllocationDesc allocation;
+    int tracked = handle_realloc_prepare(ptr, &allocation);
     void* new_ptr = _original_realloc(ptr, size);
-    handle_realloc(new_ptr, ptr, size);
+    handle_realloc(new_ptr, ptr, size, tracked ? &allocation : NULL);
     return new_ptr;
 }
 
 //
 // Handlers
 //
-// TODO: Add pthread mutex support for thread safety
 ALWAYS_INLINE static void handle_malloc(void* ptr, size_t size) {
     if (!MALLOCTRACE_ACTIVE || !MALLOC_HOOK_ACTIVE || MALLOCTRACE_DEPTH > MAX_RECURSION_DEPTH) {
         return;
     }
     if (ptr == NULL || size == 0x0)
         return;
-    ENTER_HANDLER_SECTION(MALLOC);
-    AllocationDesc allocation = {.chunk = {.address = ptr, .size = size}, .backtrace = get_backtrace()};
-    if (heap_map_insert(MALLOCTRACE_HEAP_MAP, &allocation) == -1) {
-        malloctrace_warning("Couldn't insert into heap map: OutOfMemory!\n");
+    if (!sampler_should_record(size)) {
+        event_stream_append(EVENT_MALLOC, ptr, size, NULL, 0);
+        return;
     }
+    ENTER_HANDLER_SECTION(MALLOC);
+    AllocationDesc allocation = {.chunk = {.address = ptr, .size = size}};
+    malloctrace_record_stack(&allocation);
+    malloctrace_stamp(&allocation);
+    malloctrace_insert(&allocation);
+    event_stream_append(EVENT_MALLOC, ptr, size, NULL, allocation.stack_id);
     LEAVE_HANDLER_SECTION(MALLOC);
 }
 
@@ -143,7 +416,8 @@ ALWAYS_INLINE static void handle_free(void* ptr) {
         return;
     ENTER_HANDLER_SECTION(FREE);
     DeallocationDesc deallocation = {.chunk = {.address = ptr}};
-    heap_map_remove(MALLOCTRACE_HEAP_MAP, &deallocation);
+    malloctrace_remove(&deallocation, NULL);
+    event_stream_append(EVENT_FREE, ptr, 0, NULL, 0);
     LEAVE_HANDLER_SECTION(FREE);
 }
 
@@ -153,15 +427,35 @@ ALWAYS_INLINE static void handle_calloc(void* ptr, size_t nmemb, size_t size) {
     }
     if (ptr == NULL || nmemb * size == 0x0)
         return;
-    ENTER_HANDLER_SECTION(CALLOC);
-    AllocationDesc allocation = {.chunk = {.address = ptr, .size = nmemb * size}, .backtrace = get_backtrace()};
-    if (heap_map_insert(MALLOCTRACE_HEAP_MAP, &allocation) == -1) {
-        malloctrace_warning("Couldn't insert into heap map: OutOfMemory!\n");
+    if (!sampler_should_record(nmemb * size)) {
+        event_stream_append(EVENT_CALLOC, ptr, nmemb * size, NULL, 0);
+        return;
     }
+    ENTER_HANDLER_SECTION(CALLOC);
+    AllocationDesc allocation = {.chunk = {.address = ptr, .size = nmemb * size}};
+    malloctrace_record_stack(&allocation);
+    malloctrace_stamp(&allocation);
+    malloctrace_insert(&allocation);
+    event_stream_append(EVENT_CALLOC, ptr, nmemb * size, NULL, allocation.stack_id);
     LEAVE_HANDLER_SECTION(CALLOC);
 }
 
-ALWAYS_INLINE static void handle_realloc(void* new_ptr, void* ptr, size_t size) {
+ALWAYS_INLINE static int handle_realloc_prepare(void* ptr, AllocationDesc* allocation) {
+    if (!MALLOCTRACE_ACTIVE || !REALLOC_HOOK_ACTIVE || MALLOCTRACE_DEPTH > MAX_RECURSION_DEPTH) {
+        return 0;
+    }
+    if (ptr == NULL)
+        return 0;
+    ENTER_HANDLER_SECTION(REALLOC);
+    DeallocationDesc deallocation = {.chunk = {.address = ptr}};
+    int tracked = malloctrace_remove(&deallocation, allocation) == 0;
+    // Streamed before the old chunk may be released, see event_stream.h
+    event_stream_append(EVENT_FREE, ptr, 0, NULL, 0);
+    LEAVE_HANDLER_SECTION(REALLOC);
+    return tracked;
+}
+
+ALWAYS_INLINE static void handle_realloc(void* new_ptr, void* ptr, size_t size, AllocationDesc* old_allocation) {
     if (!MALLOCTRACE_ACTIVE || !REALLOC_HOOK_ACTIVE || MALLOCTRACE_DEPTH > MAX_RECURSION_DEPTH) {
         return;
     }
@@ -169,22 +463,35 @@ ALWAYS_INLINE static void handle_realloc(void* new_ptr, void* ptr, size_t size)
         handle_malloc(new_ptr, size);
         return;
     }
-    if (size == 0x0) {
-        handle_free(ptr);
+    if (new_ptr == NULL) {
+        // Either realloc(ptr, 0) freed the chunk, or realloc failed and the old chunk is still alive.
+        if (size != 0x0) {
+            ENTER_HANDLER_SECTION(REALLOC);
+            if (old_allocation != NULL)
+                malloctrace_insert(old_allocation);
+            // The free of the old chunk was already streamed, so bring it back.
+            event_stream_append(EVENT_REALLOC, ptr, old_allocation != NULL ? old_allocation->chunk.size : 0, ptr, stack_id(old_allocation));
+            LEAVE_HANDLER_SECTION(REALLOC);
+        }
         return;
     }
     ENTER_HANDLER_SECTION(REALLOC);
     if (new_ptr == ptr) {
-        // only size was changed
-        Chunk chunk = {.address = ptr};
-        AllocationDesc* allocation = heap_map_search(MALLOCTRACE_HEAP_MAP, &chunk);
-        if (allocation != NULL) {
-            allocation->chunk.size = size;
+        // only size was changed, the chunk keeps its age
+        if (old_allocation != NULL) {
+            old_allocation->chunk.size = size;
+            malloctrace_insert(old_allocation);
         }
+        event_stream_append(EVENT_REALLOC, new_ptr, size, ptr, stack_id(old_allocation));
+    } else if (sampler_should_record(size)) {
+        // A moved chunk is a new allocation as far as sampling is concerned.
+        AllocationDesc allocation = {.chunk = {.address = new_ptr, .size = size}};
+        malloctrace_record_stack(&allocation);
+        malloctrace_stamp(&allocation);
+        malloctrace_insert(&allocation);
+        event_stream_append(EVENT_REALLOC, new_ptr, size, ptr, allocation.stack_id);
     } else {
-        handle_free(ptr);
-        AllocationDesc allocation = {.chunk = {.address = new_ptr, .size = size}, .backtrace = get_backtrace()};
-        heap_map_insert(MALLOCTRACE_HEAP_MAP, &allocation);
+        event_stream_append(EVENT_REALLOC, new_ptr, size, ptr, 0);
     }
     LEAVE_HANDLER_SECTION(REALLOC);
 }
\ No newline at end of file
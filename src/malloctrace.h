@@ -2,8 +2,11 @@
 
 #include <stddef.h>
 
+#include "heap_map.h"
+
 static void malloctrace_init();
 static void handle_malloc(void* ptr, size_t size);
 static void handle_free(void* ptr);
 static void handle_calloc(void* ptr, size_t nmemb, size_t size);
-static void handle_realloc(void* new_ptr, void* ptr, size_t size);
\ No newline at end of file
+static int handle_realloc_prepare(void* ptr, AllocationDesc* allocation);
+static void handle_realloc(void* new_ptr, void* ptr, size_t size, AllocationDesc* old_allocation);
\ No newline at end of file
@@ -0,0 +1,203 @@
+#define _GNU_SOURCE
+
+#include "report.h"
+
+#include <limits.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "logging.h"
+#include "sampler.h"
+
+#define DUMP_ALIGNMENT 8
+
+_Static_assert(sizeof(DumpHeader) == 128, "DumpHeader layout is read by gdb/malloctrace/dumpfile.py");
+_Static_assert(sizeof(DumpSite) == 24, "DumpSite layout is read by gdb/malloctrace/dumpfile.py");
+_Static_assert(sizeof(DumpModule) == 32, "DumpModule layout is read by gdb/malloctrace/dumpfile.py");
+
+typedef struct {
+    uint8_t* data;
+    size_t size;
+    size_t capacity;
+} Buffer;
+
+static int buffer_append(Buffer* buffer, const void* data, size_t size) {
+    if (buffer->size + size > buffer->capacity) {
+        size_t capacity = buffer->capacity ? buffer->capacity : 0x1000;
+        while (capacity < buffer->size + size)
+            capacity *= 2;
+        uint8_t* grown = realloc(buffer->data, capacity);
+        if (grown == NULL)
+            return -1;
+        buffer->data = grown;
+        buffer->capacity = capacity;
+    }
+    memcpy(buffer->data + buffer->size, data, size);
+    buffer->size += size;
+    return 0;
+}
+
+static uint64_t align(uint64_t offset) {
+    return (offset + DUMP_ALIGNMENT - 1) & ~(uint64_t)(DUMP_ALIGNMENT - 1);
+}
+
+typedef struct {
+    double count;
+    double bytes;
+} SiteTotals;
+
+// Adds the live chunks of every heap map to the totals of their stack ids, each map under its lock.
+static void report_fold_chunks(HeapMap* maps, SiteTotals* totals, uint32_t stack_count, uint64_t* sample_bytes) {
+    for (HeapMap* map = maps; map != NULL; map = map->next) {
+        *sample_bytes = map->sample_bytes;
+        heap_map_lock(map);
+        for (AllocationDesc* allocation = map->base; allocation < map->head; allocation = heap_map_next_entry(map, allocation)) {
+            uint32_t stack_id = allocation->stack_id < stack_count ? allocation->stack_id : 0;
+            double weight = sampler_weight(allocation->chunk.size, map->sample_bytes);
+            totals[stack_id].count += weight;
+            totals[stack_id].bytes += weight * allocation->chunk.size;
+        }
+        heap_map_unlock(map);
+    }
+}
+
+// One DumpSite per stack id that still has live chunks.
+static int report_collect_sites(HeapMap* maps, uint32_t stack_count, Buffer* sites, uint64_t* sample_bytes) {
+    // The empty backtrace always has id 0, so there is at least one stack id.
+    SiteTotals* totals = calloc(stack_count, sizeof(SiteTotals));
+    if (totals == NULL)
+        return -1;
+    report_fold_chunks(maps, totals, stack_count, sample_bytes);
+    int ret = 0;
+    for (uint32_t stack_id = 0; ret == 0 && stack_id < (stack_count); ++stack_id) {
+        if (totals[stack_id].count == 0)
+            continue;
+        DumpSite site = {
+            .stack_id = stack_id,
+            .count = (uint64_t)(totals[stack_id].count + 0.5),
+            .bytes = (uint64_t)(totals[stack_id].bytes + 0.5),
+        };
+        ret = buffer_append(sites, &site, sizeof(site));
+    }
+    free(totals);
+    return ret;
+}
+
+// The file-backed mappings of the process, like read_module_map in gdb/malloctrace/common.py.
+static int report_collect_modules(Buffer* modules, Buffer* strings) {
+    FILE* maps = fopen("/proc/self/maps", "r");
+    if (maps == NULL)
+        return -1;
+    char* line = NULL;
+    size_t line_size = 0;
+    uint32_t last_name_offset = 0, last_name_size = 0;
+    int ret = 0;
+    while (ret == 0 && getline(&line, &line_size, maps) != -1) {
+        DumpModule module;
+        int name_start = 0;
+        if (sscanf(line, "%lx-%lx %*s %lx %*s %*s %n", &module.start, &module.end, &module.file_offset, &name_start) != 3)
+            continue;
+        char* name = line + name_start;
+        if (*name != '/')
+            continue;
+        size_t name_size = strcspn(name, "\n");
+        // Mappings of one file follow each other, so they share its name.
+        if (last_name_size != name_size || memcmp(strings->data + last_name_offset, name, name_size) != 0) {
+            last_name_offset = strings->size;
+            last_name_size = name_size;
+            ret = buffer_append(strings, name, name_size);
+        }
+        module.name_offset = last_name_offset;
+        module.name_size = last_name_size;
+        if (ret == 0)
+            ret = buffer_append(modules, &module, sizeof(module));
+    }
+    free(line);
+    fclose(maps);
+    return ret;
+}
+
+static void report_expand_path(const char* path, char* expanded, size_t size) {
+    const char* pid_placeholder = strstr(path, "%p");
+    if (pid_placeholder == NULL) {
+        snprintf(expanded, size, "%s", path);
+        return;
+    }
+    snprintf(expanded, size, "%.*s%d%s", (int)(pid_placeholder - path), path, getpid(), pid_placeholder + 2);
+}
+
+static int report_write_sections(FILE* file, DumpHeader* header, Buffer* stacks, Buffer* sites, Buffer* modules, Buffer* strings) {
+    static const uint8_t padding[DUMP_ALIGNMENT];
+    struct {
+        uint64_t offset;
+        const void* data;
+        size_t size;
+    } sections[] = {
+        {0, header, sizeof(*header)},
+        {header->stacks_offset, stacks->data, stacks->size},
+        {header->sites_offset, sites->data, sites->size},
+        {header->modules_offset, modules->data, modules->size},
+        {header->strings_offset, strings->data, strings->size},
+    };
+    uint64_t position = 0;
+    for (size_t i = 0; i < sizeof(sections) / sizeof(sections[0]); ++i) {
+        if (fwrite(padding, 1, sections[i].offset - position, file) != sections[i].offset - position)
+            return -1;
+        if (sections[i].size != 0x0 && fwrite(sections[i].data, 1, sections[i].size, file) != sections[i].size)
+            return -1;
+        position = sections[i].offset + sections[i].size;
+    }
+    return 0;
+}
+
+int report_write(const char* path, HeapMap* maps, StackTable* stack_table) {
+    Buffer sites = {0}, modules = {0}, strings = {0};
+    uint64_t sample_bytes = 0;
+    int ret = -1;
+    // Recording is off, so the stack table holds still and can be written as it is.
+    uint32_t stack_count = stack_table_count(stack_table);
+    Buffer stacks = {.data = (uint8_t*)stack_table->frames, .size = (size_t)stack_count * stack_table->depth * sizeof(void*)};
+    if (report_collect_sites(maps, stack_count, &sites, &sample_bytes) == -1)
+        goto out;
+    // Without the module map the report could only be symbolized in this very process.
+    if (report_collect_modules(&modules, &strings) == -1)
+        goto out;
+
+    // No entries, the chunks are all folded into the sites.
+    DumpHeader header = {
+        .magic = DUMP_MAGIC,
+        .version = DUMP_VERSION,
+        .frame_count = stack_table->depth,
+        .entry_size = sizeof(AllocationDesc),
+        .entries_offset = align(sizeof(DumpHeader)),
+        .stack_count = stack_count,
+        .site_count = sites.size / sizeof(DumpSite),
+        .module_count = modules.size / sizeof(DumpModule),
+        .strings_size = strings.size,
+        .sample_bytes = sample_bytes,
+    };
+    header.stacks_offset = header.entries_offset;
+    header.sites_offset = align(header.stacks_offset + stacks.size);
+    // No symbols, there are none in between the sites and the modules.
+    header.symbols_offset = align(header.sites_offset + sites.size);
+    header.modules_offset = header.symbols_offset;
+    header.strings_offset = align(header.modules_offset + modules.size);
+
+    char expanded_path[PATH_MAX];
+    report_expand_path(path, expanded_path, sizeof(expanded_path));
+    FILE* file = fopen(expanded_path, "wb");
+    if (file == NULL)
+        goto out;
+    ret = report_write_sections(file, &header, &stacks, &sites, &modules, &strings);
+    if (fclose(file) != 0)
+        ret = -1;
+    if (ret == 0)
+        malloctrace_debug("Wrote %lu allocation sites to %s\n", header.site_count, expanded_path);
+out:
+    free(sites.data);
+    free(modules.data);
+    free(strings.data);
+    return ret;
+}
@@ -0,0 +1,62 @@
+#pragma once
+#include <stdint.h>
+
+#include "heap_map.h"
+#include "stack_table.h"
+
+// Optional exit-time leak report (MALLOCTRACE_REPORT=<path>).
+//
+// When the process exits, the chunks that are still live are written to <path>
+// in the dump format of gdb/malloctrace/dumpfile.py, so they can be analyzed
+// with 'python -m malloctrace.offline' without a debugger ever attaching. The
+// chunks are folded into one DumpSite per allocation site (stack id), so the
+// report grows with the number of leaking sites rather than with the heap, and
+// it holds no entries of its own. The report carries the stack table and the
+// module map of the process but no symbols, those are resolved offline from
+// the modules. A "%p" in <path> is replaced by the pid, so every process of a
+// test suite gets a report of its own.
+
+#define DUMP_MAGIC   "MTRDUMP"
+#define DUMP_VERSION 7
+
+// Like DUMP_HEADER in gdb/malloctrace/dumpfile.py, which reads it little-endian.
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t frame_count;
+    uint32_t entry_size;
+    uint32_t reserved;
+    uint64_t entry_count;
+    uint64_t entries_offset;
+    uint64_t stack_count; // frame_count frames each, the entries refer to them by stack id
+    uint64_t stacks_offset;
+    uint64_t site_count;
+    uint64_t sites_offset;
+    uint64_t symbol_count;
+    uint64_t symbols_offset;
+    uint64_t module_count;
+    uint64_t modules_offset;
+    uint64_t strings_size;
+    uint64_t strings_offset;
+    uint64_t sample_bytes; // 0 if every allocation was recorded
+} DumpHeader;
+
+// Like SITE_RECORD in gdb/malloctrace/dumpfile.py
+typedef struct {
+    uint32_t stack_id;
+    uint32_t reserved;
+    uint64_t count; // estimates scaled up by the sample weights if sample_bytes != 0
+    uint64_t bytes;
+} DumpSite;
+
+// Like MODULE_RECORD in gdb/malloctrace/dumpfile.py
+typedef struct {
+    uint64_t start;
+    uint64_t end;
+    uint64_t file_offset;
+    uint32_t name_offset; // into the string table
+    uint32_t name_size;
+} DumpModule;
+
+// Has to run with recording turned off, it allocates.
+int report_write(const char* path, HeapMap* maps, StackTable* stacks);
@@ -0,0 +1,54 @@
+#include "sampler.h"
+
+#include <math.h>
+#include <stdint.h>
+#include <time.h>
+
+uint64_t MALLOCTRACE_SAMPLE_BYTES = 0;
+THREAD_LOCAL int64_t BYTES_UNTIL_SAMPLE = 0;
+uint32_t SAMPLED_FILTER[1 << SAMPLED_FILTER_BITS];
+
+static THREAD_LOCAL uint64_t SAMPLER_STATE = 0;
+
+// splitmix64, it only has to be cheap and good enough for picking intervals.
+static uint64_t sampler_next_random() {
+    uint64_t z = (SAMPLER_STATE += 0x9e3779b97f4a7c15);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111eb;
+    return z ^ (z >> 31);
+}
+
+static int64_t sampler_next_interval() {
+    // Uniform in (0, 1], so the logarithm stays finite.
+    double uniform = ((sampler_next_random() >> 11) + 1) * 0x1.0p-53;
+    double interval = -log(uniform) * MALLOCTRACE_SAMPLE_BYTES;
+    if (interval >= (double)(INT64_MAX / 2))
+        return INT64_MAX / 2;
+    return interval < 1.0 ? 1 : (int64_t)interval;
+}
+
+// Slow path of sampler_should_record, taken once the current interval is used up.
+int sampler_pick(size_t size) {
+    if (SAMPLER_STATE == 0) {
+        // A new thread starts with a fresh interval instead of recording its first allocation.
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        SAMPLER_STATE = (uint64_t)ts.tv_nsec ^ ((uint64_t)ts.tv_sec << 32) ^ (uintptr_t)&SAMPLER_STATE;
+        BYTES_UNTIL_SAMPLE = sampler_next_interval();
+        if (size < (size_t)BYTES_UNTIL_SAMPLE) {
+            BYTES_UNTIL_SAMPLE -= size;
+            return 0;
+        }
+    }
+    // The sampling points form a Poisson process over all allocated bytes, so
+    // the next interval starts right after this allocation.
+    BYTES_UNTIL_SAMPLE = sampler_next_interval();
+    return 1;
+}
+
+// The number of chunks a recorded chunk stands for, like sample_weight in gdb/malloctrace/snapshot.py
+double sampler_weight(size_t size, uint64_t sample_bytes) {
+    if (sample_bytes == 0 || size == 0)
+        return 1.0;
+    return -1.0 / expm1(-(double)size / sample_bytes);
+}
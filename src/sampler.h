@@ -0,0 +1,55 @@
+#pragma once
+#include <stddef.h>
+#include <stdint.h>
+
+#include "common.h"
+
+// Mean number of bytes between two recorded allocations, chosen at startup
+// (MALLOCTRACE_SAMPLE_BYTES). 0 records every allocation.
+extern uint64_t MALLOCTRACE_SAMPLE_BYTES;
+extern THREAD_LOCAL int64_t BYTES_UNTIL_SAMPLE;
+
+int sampler_pick(size_t size);
+double sampler_weight(size_t size, uint64_t sample_bytes);
+
+// Like tcmalloc, the sampler picks one allocation every exponentially
+// distributed number of bytes, so an allocation of size s gets recorded with a
+// probability of 1 - exp(-s / MALLOCTRACE_SAMPLE_BYTES). Readers weight every
+// recorded chunk with the inverse of that probability to get unbiased totals.
+ALWAYS_INLINE int sampler_should_record(size_t size) {
+    if (MALLOCTRACE_SAMPLE_BYTES == 0)
+        return 1;
+    if (size < (size_t)BYTES_UNTIL_SAMPLE) {
+        BYTES_UNTIL_SAMPLE -= size;
+        return 0;
+    }
+    return sampler_pick(size);
+}
+
+// Counting filter over the addresses of the recorded chunks, only kept while
+// sampling. Most frees are of chunks that were never sampled, the filter
+// rejects them without locking and probing the heap map of every thread. A
+// slot counts the recorded chunks whose address hashes to it, so it may only
+// give false positives, which fall back to probing the maps.
+#define SAMPLED_FILTER_BITS 16
+extern uint32_t SAMPLED_FILTER[1 << SAMPLED_FILTER_BITS];
+
+ALWAYS_INLINE uint32_t* sampled_filter_slot(void* address) {
+    // Chunks are at least 16 byte aligned.
+    uint64_t hash = ((uintptr_t)address >> 4) * 0x9e3779b97f4a7c15ull;
+    return &SAMPLED_FILTER[hash >> (64 - SAMPLED_FILTER_BITS)];
+}
+
+ALWAYS_INLINE void sampler_note_recorded(void* address) {
+    if (MALLOCTRACE_SAMPLE_BYTES != 0)
+        __atomic_add_fetch(sampled_filter_slot(address), 1, __ATOMIC_RELAXED);
+}
+
+ALWAYS_INLINE void sampler_note_removed(void* address) {
+    if (MALLOCTRACE_SAMPLE_BYTES != 0)
+        __atomic_sub_fetch(sampled_filter_slot(address), 1, __ATOMIC_RELAXED);
+}
+
+ALWAYS_INLINE int sampler_may_be_recorded(void* address) {
+    return MALLOCTRACE_SAMPLE_BYTES == 0 || __atomic_load_n(sampled_filter_slot(address), __ATOMIC_RELAXED) != 0;
+}
@@ -0,0 +1,80 @@
+#define _GNU_SOURCE
+
+#include "stack_table.h"
+
+#include <string.h>
+#include <sys/mman.h>
+
+#define EMPTY_SLOT 0x0
+
+// The whole mapping is reserved at once, only the pages that get written cost memory.
+static size_t stack_table_mapping_size(uint32_t capacity, uint32_t slot_capacity, uint32_t depth) {
+    return sizeof(StackTable) + (size_t)slot_capacity * sizeof(uint32_t) + (size_t)capacity * depth * sizeof(void*);
+}
+
+StackTable* stack_table_new(uint32_t capacity, uint32_t depth) {
+    if (capacity < 2 || capacity > UINT32_MAX / 4)
+        return NULL;
+    uint32_t slot_capacity = 1;
+    while (slot_capacity < 2 * capacity)
+        slot_capacity *= 2;
+    StackTable* table = mmap(NULL, stack_table_mapping_size(capacity, slot_capacity, depth), PROT_READ | PROT_WRITE,
+                             MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    if (table == MAP_FAILED)
+        return NULL;
+    table->depth = depth;
+    table->capacity = capacity;
+    table->slot_capacity = slot_capacity;
+    table->slots = (uint32_t*)(table + 1);
+    table->frames = (void**)(table->slots + slot_capacity);
+    // Id 0 is the empty backtrace, its frames are already zeroed.
+    table->count = 1;
+    return table;
+}
+
+// Mixes whole frames instead of bytes, a backtrace is hashed on every recorded allocation.
+ALWAYS_INLINE static uint64_t stack_hash(void** frames, uint32_t depth) {
+    uint64_t hash = 0xcbf29ce484222325ull;
+    for (uint32_t i = 0; i < depth; ++i) {
+        hash ^= (uintptr_t)frames[i];
+        hash *= 0x100000001b3ull;
+        hash ^= hash >> 29;
+    }
+    return hash ^ (hash >> 32);
+}
+
+// Takes the next free id and copies the backtrace to it, 0 if the table is full.
+static uint32_t stack_table_claim(StackTable* table, void** frames) {
+    // Checked first, so the count never runs far past the capacity.
+    if (__atomic_load_n(&table->count, __ATOMIC_RELAXED) >= table->capacity)
+        return 0;
+    uint32_t stack_id = __atomic_fetch_add(&table->count, 1, __ATOMIC_RELAXED);
+    if (stack_id >= table->capacity)
+        return 0;
+    memcpy(stack_table_frames(table, stack_id), frames, table->depth * sizeof(void*));
+    return stack_id;
+}
+
+uint32_t stack_table_intern(StackTable* table, void** frames) {
+    if (table->depth == 0 || frames[0] == NULL)
+        return 0;
+    size_t frames_size = table->depth * sizeof(void*);
+    uint32_t mask = table->slot_capacity - 1;
+    uint32_t slot = stack_hash(frames, table->depth) & mask;
+    uint32_t claimed = 0;
+    for (uint32_t probes = 0; probes < table->slot_capacity; ++probes, slot = (slot + 1) & mask) {
+        uint32_t stack_id = __atomic_load_n(&table->slots[slot], __ATOMIC_ACQUIRE);
+        if (stack_id == EMPTY_SLOT) {
+            if (claimed == 0 && (claimed = stack_table_claim(table, frames)) == 0)
+                break;
+            // Publishing the id also publishes its frames.
+            if (__atomic_compare_exchange_n(&table->slots[slot], &stack_id, claimed, 0, __ATOMIC_RELEASE, __ATOMIC_ACQUIRE))
+                return claimed;
+            // Another thread took the slot first, so compare against its stack instead.
+        }
+        if (memcmp(stack_table_frames(table, stack_id), frames, frames_size) == 0)
+            return stack_id;
+    }
+    __atomic_add_fetch(&table->dropped, 1, __ATOMIC_RELAXED);
+    return 0;
+}
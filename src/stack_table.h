@@ -0,0 +1,43 @@
+#pragma once
+#include <stddef.h>
+#include <stdint.h>
+
+#include "common.h"
+
+// Interned backtraces. Most allocations come from a few hundred call sites,
+// so every backtrace is stored once here and the heap map entries only refer
+// to it by its 32-bit stack id.
+//
+// The table is a single anonymous mapping laid out as
+//   [StackTable][uint32_t slots...][void* frames...]
+// The slots form an open-addressing (linear probing) hash table over the
+// backtraces, a slot holds a stack id or 0 if it is empty. Stack id n owns
+// frames[n * depth, (n + 1) * depth). Id 0 is the empty backtrace, it also
+// stands in for every backtrace that came after the table filled up.
+// Stacks are never removed and the mapping is reserved at its full size up
+// front, so it never moves and threads intern without taking a lock: a new
+// backtrace claims the next id, writes its frames and only then publishes
+// the id in its slot. If another thread published the same backtrace first,
+// the claimed id stays unused. Readers take the first min(count, capacity)
+// stacks.
+typedef struct {
+    uint32_t depth;         // frames per stack
+    uint32_t capacity;      // maximum number of stacks
+    uint32_t count;         // ids claimed so far, may overshoot capacity by a few
+    uint32_t slot_capacity; // a power of two of at least twice the capacity
+    uint64_t dropped;       // backtraces that got id 0 because the table was full
+    uint32_t* slots;
+    void** frames;
+} StackTable;
+
+StackTable* stack_table_new(uint32_t capacity, uint32_t depth);
+uint32_t stack_table_intern(StackTable* table, void** frames);
+
+ALWAYS_INLINE void** stack_table_frames(StackTable* table, uint32_t stack_id) {
+    return table->frames + (size_t)stack_id * table->depth;
+}
+
+ALWAYS_INLINE uint32_t stack_table_count(StackTable* table) {
+    uint32_t count = __atomic_load_n(&table->count, __ATOMIC_ACQUIRE);
+    return count < table->capacity ? count : table->capacity;
+}
@@ -0,0 +1,83 @@
+#!/bin/sh
+# Post-mortem test for malloctrace.
+#
+# Crashes test/main.c with libmalloctrace.so preloaded and all of its chunks
+# still live, writes a core file of it, and then checks that the gdb commands
+# decode every one of those chunks from the core file alone, that 'malloctrace
+# top' folds them into their allocation site, and that the commands that would
+# change the inferior refuse to run.
+#
+# Needs gdb and a build with -DMALLOCTRACE_BUILD_TESTS=ON.
+#
+# Usage: test/core_test.sh <build-dir>
+set -eu
+
+BUILD_DIR=$(cd "${1:?Usage: $0 <build-dir>}" && pwd)
+REPO_DIR=$(cd "$(dirname "$0")/.." && pwd)
+WORK_DIR=$(mktemp -d)
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+CHUNK_COUNT=32
+CHUNK_SIZE=1337
+
+# The program aborts right after its mallocs, gdb stops it there and writes the core.
+gdb -nx -batch \
+    -ex "set environment LD_PRELOAD=$BUILD_DIR/libmalloctrace.so" \
+    -ex "set environment MALLOCTRACE_SAMPLE_BYTES=0" \
+    -ex "run > $WORK_DIR/stdout" \
+    -ex "generate-core-file $WORK_DIR/core" \
+    --args "$BUILD_DIR/malloctrace_main" "$CHUNK_COUNT" "$CHUNK_SIZE" abort > "$WORK_DIR/run.log" 2>&1
+test -s "$WORK_DIR/core" || { cat "$WORK_DIR/run.log"; echo "FAILED: no core file"; exit 1; }
+
+gdb -nx -batch \
+    -ex "source $REPO_DIR/gdb/gdbinit.py" \
+    -ex "malloctrace status" \
+    -ex "malloctrace capacity" \
+    -ex "malloctrace show all" \
+    -ex "malloctrace top" \
+    -ex "malloctrace dump $WORK_DIR/heap.mtrdump" \
+    -ex "malloctrace clear" \
+    "$BUILD_DIR/malloctrace_main" "$WORK_DIR/core" 2>&1 | sed 's/\x1b\[[0-9;]*m//g' > "$WORK_DIR/analysis.log"
+
+cd "$REPO_DIR/gdb"
+python3 - "$WORK_DIR" "$CHUNK_COUNT" "$CHUNK_SIZE" <<'EOF'
+import re
+import sys
+from malloctrace.dumpfile import DumpFile
+from malloctrace.symbols import UNKNOWN_SYMBOL
+
+work_dir, chunk_count, chunk_size = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+with open(f"{work_dir}/stdout") as stdout:
+    expected = {int(address, 16) for address in re.findall(r"malloced (0x[0-9a-f]+)", stdout.read())}
+with open(f"{work_dir}/analysis.log") as analysis_log:
+    analysis = analysis_log.read()
+
+failures = list()
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+
+check(len(expected) == chunk_count, f"expected {chunk_count} chunks in the program output, got {len(expected)}")
+shown = {int(address, 16): int(size, 16) for address, size in re.findall(r"Chunk @ (0x[0-9a-f]+) - size: (0x[0-9a-f]+)", analysis)}
+check(all(shown.get(address) == chunk_size for address in expected), "'malloctrace show all' misses chunks of the core file")
+# The chunks come from one call site, so 'malloctrace top' has to fold all of them into one allocation site.
+top = {(int(size, 16), int(count)) for size, count in re.findall(r"#\d+ (0x[0-9a-f]+) bytes in (\d+) chunks", analysis)}
+check((chunk_count * chunk_size, chunk_count) in top, f"'malloctrace top' has no allocation site with the {chunk_count} chunks of the core file")
+check("total capacity:" in analysis, "'malloctrace capacity' failed on the core file")
+check("Active: True" in analysis, "'malloctrace status' failed on the core file")
+check("read-only" in analysis, "'malloctrace clear' did not refuse to write to the core file")
+
+with DumpFile(f"{work_dir}/heap.mtrdump") as dump:
+    decoded = {entry.address: entry for entry in dump.snapshot}
+    check(all(address in decoded and decoded[address].size == chunk_size for address in expected), "the dump of the core file misses chunks")
+    # Every chunk was allocated from main, so its backtrace has to resolve to it.
+    check(all(any((dump.symbolize(pc) or (UNKNOWN_SYMBOL,))[0].split("+")[0] == "main" for pc in decoded[address].frames) for address in expected if address in decoded),
+        "the backtraces of the chunks do not lead to main")
+
+if failures:
+    print(analysis)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1)
+print(f"OK: {len(expected)} chunks decoded from the core file")
+EOF
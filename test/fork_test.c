@@ -0,0 +1,72 @@
+// Fork test for libmalloctrace.so.
+//
+// Worker threads keep allocating and freeing chunks while the main thread
+// forks. Every child frees the chunks of the workers, which probes the heap
+// maps of their threads. A map that was locked at the time of the fork must
+// not stay locked in the child, so every child has to exit on its own.
+//
+// Usage: LD_PRELOAD=libmalloctrace.so ./fork_test [forks] [threads]
+#define _GNU_SOURCE
+
+#include <pthread.h>
+#include <signal.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#define SHARED_CHUNKS  0x100
+#define MAX_THREADS    0x20
+#define CHILD_TIMEOUT  2
+
+static void* SHARED[SHARED_CHUNKS];
+static int STOP;
+
+static void* work(void* data) {
+    unsigned int seed = (unsigned int)(uintptr_t)data;
+    while (!__atomic_load_n(&STOP, __ATOMIC_RELAXED)) {
+        void* chunk = malloc(1 + rand_r(&seed) % 0x100);
+        free(__atomic_exchange_n(&SHARED[rand_r(&seed) % SHARED_CHUNKS], chunk, __ATOMIC_ACQ_REL));
+    }
+    return NULL;
+}
+
+int main(int argc, char** argv) {
+    int forks = argc > 1 ? atoi(argv[1]) : 300;
+    int thread_count = argc > 2 ? atoi(argv[2]) : 4;
+    if (thread_count > MAX_THREADS)
+        thread_count = MAX_THREADS;
+    pthread_t threads[MAX_THREADS];
+    for (int i = 0; i < thread_count; ++i)
+        pthread_create(&threads[i], NULL, work, (void*)(uintptr_t)(i + 1));
+
+    int hung = 0;
+    for (int i = 0; i < forks; ++i) {
+        pid_t pid = fork();
+        if (pid == 0) {
+            // A child that spins on an inherited lock gets killed instead of hanging the test.
+            alarm(CHILD_TIMEOUT);
+            for (int slot = 0; slot < SHARED_CHUNKS; ++slot)
+                free(SHARED[slot]);
+            _exit(0);
+        }
+        int status;
+        if (pid == -1 || waitpid(pid, &status, 0) == -1) {
+            perror("fork");
+            return 1;
+        }
+        if (WIFSIGNALED(status) && WTERMSIG(status) == SIGALRM)
+            ++hung;
+    }
+
+    __atomic_store_n(&STOP, 1, __ATOMIC_RELAXED);
+    for (int i = 0; i < thread_count; ++i)
+        pthread_join(threads[i], NULL);
+    if (hung != 0) {
+        printf("FAILED: %d of %d children hung\n", hung, forks);
+        return 1;
+    }
+    printf("OK: %d children\n", forks);
+    return 0;
+}
@@ -0,0 +1,172 @@
+// Benchmark for the overhead of preloading libmalloctrace.so.
+//
+// Runs malloc/free, calloc/free and realloc workloads across chunk sizes,
+// live-set sizes and thread counts, once without and once with the library
+// preloaded, and prints all results as one JSON document to stdout, so they
+// can be compared between releases.
+//
+// One op is one allocation call together with the free of the chunk it
+// replaces (malloc, calloc), or one realloc call.
+//
+// Usage: LD_PRELOAD=libmalloctrace.so ./hook_bench [ops-per-thread] [max-threads] > results.json
+#define _GNU_SOURCE
+
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+#define CHILD_ENV "MALLOCTRACE_HOOK_BENCH_CHILD"
+
+static const char* OPS[] = {"malloc", "calloc", "realloc"};
+static const size_t SIZES[] = {0x10, 0x100, 0x1000};
+static const size_t LIVE_SET_SIZES[] = {0x1, 0x400, 0x10000};
+
+#define COUNT(array) (sizeof(array) / sizeof((array)[0]))
+
+typedef struct {
+    const char* op;
+    size_t size;
+    size_t live;
+    size_t ops;
+    pthread_barrier_t* barrier;
+} Workload;
+
+static double now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void* run_workload(void* data) {
+    Workload* workload = (Workload*)data;
+    void** chunks = malloc(workload->live * sizeof(void*));
+    for (size_t i = 0; i < workload->live; ++i)
+        chunks[i] = malloc(workload->size);
+    unsigned int seed = 1;
+    pthread_barrier_wait(workload->barrier);
+
+    if (strcmp(workload->op, "malloc") == 0) {
+        for (size_t i = 0; i < workload->ops; ++i) {
+            size_t slot = rand_r(&seed) % workload->live;
+            free(chunks[slot]);
+            chunks[slot] = malloc(workload->size);
+        }
+    } else if (strcmp(workload->op, "calloc") == 0) {
+        for (size_t i = 0; i < workload->ops; ++i) {
+            size_t slot = rand_r(&seed) % workload->live;
+            free(chunks[slot]);
+            chunks[slot] = calloc(1, workload->size);
+        }
+    } else {
+        // Alternate between two sizes, so the chunks actually have to change.
+        for (size_t i = 0; i < workload->ops; ++i) {
+            size_t slot = rand_r(&seed) % workload->live;
+            chunks[slot] = realloc(chunks[slot], i % 2 ? workload->size : 2 * workload->size);
+        }
+    }
+
+    pthread_barrier_wait(workload->barrier);
+    for (size_t i = 0; i < workload->live; ++i)
+        free(chunks[i]);
+    free(chunks);
+    return NULL;
+}
+
+// Runs one configuration on `thread_count` threads and returns the wall time of the timed part.
+static double run_configuration(const char* op, size_t size, size_t live, size_t ops, size_t thread_count) {
+    pthread_barrier_t barrier;
+    // The main thread takes the time between the two barriers the workers pass.
+    pthread_barrier_init(&barrier, NULL, thread_count + 1);
+    pthread_t* threads = malloc(thread_count * sizeof(pthread_t));
+    Workload workload = {.op = op, .size = size, .live = live, .ops = ops, .barrier = &barrier};
+    for (size_t t = 0; t < thread_count; ++t)
+        pthread_create(&threads[t], NULL, run_workload, &workload);
+    pthread_barrier_wait(&barrier);
+    double start = now();
+    pthread_barrier_wait(&barrier);
+    double elapsed = now() - start;
+    for (size_t t = 0; t < thread_count; ++t)
+        pthread_join(threads[t], NULL);
+    free(threads);
+    pthread_barrier_destroy(&barrier);
+    return elapsed;
+}
+
+// Child: runs every configuration and prints one JSON object per line.
+static int run_child(size_t ops, size_t max_threads) {
+    int preloaded = getenv("LD_PRELOAD") != NULL;
+    for (size_t o = 0; o < COUNT(OPS); ++o) {
+        for (size_t s = 0; s < COUNT(SIZES); ++s) {
+            for (size_t l = 0; l < COUNT(LIVE_SET_SIZES); ++l) {
+                for (size_t thread_count = 1; thread_count <= max_threads; thread_count *= 2) {
+                    double elapsed = run_configuration(OPS[o], SIZES[s], LIVE_SET_SIZES[l], ops, thread_count);
+                    printf("{\"preload\": %s, \"op\": \"%s\", \"size\": %zu, \"live\": %zu, \"threads\": %zu, \"ops_per_thread\": %zu, "
+                           "\"ns_per_op\": %.2f, \"ops_per_s\": %.0f}\n",
+                           preloaded ? "true" : "false", OPS[o], SIZES[s], LIVE_SET_SIZES[l], thread_count, ops, elapsed * 1e9 / ops,
+                           thread_count * ops / elapsed);
+                }
+            }
+        }
+    }
+    return 0;
+}
+
+// Runs a child with or without the preload and copies its result lines into the JSON array.
+static int run_preload(char** argv, const char* preload, int* first) {
+    int fds[2];
+    if (pipe(fds) != 0)
+        return 1;
+    pid_t pid = fork();
+    if (pid == 0) {
+        close(fds[0]);
+        dup2(fds[1], STDOUT_FILENO);
+        setenv(CHILD_ENV, "1", 1);
+        if (preload == NULL)
+            unsetenv("LD_PRELOAD");
+        else
+            setenv("LD_PRELOAD", preload, 1);
+        execv("/proc/self/exe", argv);
+        perror("execv");
+        _exit(1);
+    }
+    close(fds[1]);
+    FILE* results = fdopen(fds[0], "r");
+    char line[0x200];
+    while (results != NULL && fgets(line, sizeof(line), results) != NULL) {
+        line[strcspn(line, "\n")] = '\0';
+        printf("%s\n    %s", *first ? "" : ",", line);
+        *first = 0;
+    }
+    if (results != NULL)
+        fclose(results);
+    int status;
+    if (pid < 0 || waitpid(pid, &status, 0) < 0)
+        return 1;
+    return !WIFEXITED(status) || WEXITSTATUS(status) != 0;
+}
+
+int main(int argc, char** argv) {
+    size_t ops = argc > 1 ? strtoul(argv[1], NULL, 10) : 100000;
+    size_t max_threads = argc > 2 ? strtoul(argv[2], NULL, 10) : sysconf(_SC_NPROCESSORS_ONLN);
+    if (getenv(CHILD_ENV) != NULL)
+        return run_child(ops, max_threads);
+
+    char* preload = getenv("LD_PRELOAD");
+    if (preload == NULL) {
+        fprintf(stderr, "Usage: LD_PRELOAD=libmalloctrace.so %s [ops-per-thread] [max-threads] > results.json\n", argv[0]);
+        return 1;
+    }
+    const char* unwinder = getenv("MALLOCTRACE_UNWINDER");
+    const char* sample_bytes = getenv("MALLOCTRACE_SAMPLE_BYTES");
+    int first = 1;
+    printf("{\n  \"benchmark\": \"hook_overhead\",\n  \"library\": \"%s\",\n  \"unwinder\": \"%s\",\n  \"sample_bytes\": %s,\n  \"results\": [",
+           preload, unwinder ? unwinder : "glibc", sample_bytes ? sample_bytes : "0");
+    int failures = run_preload(argv, NULL, &first);
+    failures += run_preload(argv, preload, &first);
+    printf("\n  ]\n}\n");
+    return failures != 0;
+}
@@ -3,10 +3,11 @@
 #include <malloc.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 int main(int argc, char** argv) {
-  if (argc != 3) {
-    printf("Usage: %s <malloc-count> <chunk-size>\n", argv[0]);
+  if (argc != 3 && !(argc == 4 && (strcmp(argv[3], "abort") == 0 || strcmp(argv[3], "leak") == 0))) {
+    printf("Usage: %s <malloc-count> <chunk-size> [abort|leak]\n", argv[0]);
     exit(0);
   }
 
@@ -25,6 +26,14 @@ int main(int argc, char** argv) {
     printf("malloced %p\n", array[i]);
     assert(array[i] != NULL);
   }
+  // Crash with all chunks still live, so a core dump of it has them in the heap map.
+  if (argc == 4 && strcmp(argv[3], "abort") == 0) {
+    fflush(stdout);
+    abort();
+  }
+  // Exit with all chunks still live, for the exit-time report.
+  if (argc == 4)
+    return 0;
   for (int i = 0; i < malloc_count; ++i) {
     printf("freeing %p\n", array[i]);
     free(array[i]);
@@ -0,0 +1,67 @@
+#!/bin/sh
+# Exit-time report test for malloctrace.
+#
+# Runs test/main.c with libmalloctrace.so preloaded and MALLOCTRACE_REPORT set,
+# lets it exit with all of its chunks still live, and checks that the report
+# folds them into their allocation site, together with the stack table and the
+# module map they are symbolized with offline. No debugger is involved.
+#
+# Needs a build with -DMALLOCTRACE_BUILD_TESTS=ON.
+#
+# Usage: test/report_test.sh <build-dir>
+set -eu
+
+BUILD_DIR=$(cd "${1:?Usage: $0 <build-dir>}" && pwd)
+REPO_DIR=$(cd "$(dirname "$0")/.." && pwd)
+WORK_DIR=$(mktemp -d)
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+CHUNK_COUNT=32
+CHUNK_SIZE=1337
+
+LD_PRELOAD="$BUILD_DIR/libmalloctrace.so" MALLOCTRACE_REPORT="$WORK_DIR/leaks-%p.mtrdump" MALLOCTRACE_SAMPLE_BYTES=0 \
+    "$BUILD_DIR/malloctrace_main" "$CHUNK_COUNT" "$CHUNK_SIZE" leak > "$WORK_DIR/stdout"
+
+cd "$REPO_DIR/gdb"
+python3 - "$WORK_DIR" "$CHUNK_COUNT" "$CHUNK_SIZE" "$BUILD_DIR/malloctrace_main" <<'PYEOF'
+import glob
+import re
+import sys
+from malloctrace.dumpfile import DumpFile
+from malloctrace.symbolizer import symbolize_batch
+from malloctrace.symbols import UNKNOWN_SYMBOL, Symbolization
+
+work_dir, chunk_count, chunk_size, program = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4]
+with open(f"{work_dir}/stdout") as stdout:
+    expected = {int(address, 16) for address in re.findall(r"malloced (0x[0-9a-f]+)", stdout.read())}
+reports = glob.glob(f"{work_dir}/leaks-*.mtrdump")
+
+UNKNOWN = Symbolization(UNKNOWN_SYMBOL, None, 0)
+failures = list()
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+
+check(len(expected) == chunk_count, f"expected {chunk_count} chunks in the program output, got {len(expected)}")
+check(len(reports) == 1 and re.fullmatch(r"leaks-\d+\.mtrdump", reports[0].rsplit("/", 1)[-1]) is not None, f"expected one report named after the pid, got {reports}")
+if reports:
+    with DumpFile(reports[0]) as report:
+        check(len(report.snapshot) == 0 and report.is_report, "the report holds chunks instead of allocation sites")
+        # The chunks come from one call site, so they are folded into a single site with an interned backtrace.
+        leaked = [site for site in report.sites if site[1:] == (chunk_count * chunk_size, chunk_count)]
+        check(len(leaked) == 1 and leaked[0][0] != 0, f"expected one allocation site holding {chunk_count} chunks, got {report.sites}")
+        check(len({site[0] for site in report.sites}) == len(report.sites), "the report has more than one site per stack id")
+        modules = report.modules
+        check(any(module.name == program for module in modules), "the report has no module map of the program")
+        frames = [frame for site in leaked for frame in report.snapshot.stack(site[0]) if frame]
+        check(all(any(module.start <= frame < module.end for module in modules) for frame in frames), "the module map does not cover the backtraces")
+        # Every chunk was allocated from main, which the offline symbolizer has to find in the program.
+        symbols = symbolize_batch(set(frames), modules)
+        check(any(symbols.get(frame, UNKNOWN).symbol.split("+")[0] == "main" for frame in frames), "the backtrace of the chunks does not lead to main")
+
+if failures:
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1)
+print(f"OK: {len(expected)} leaked chunks in one allocation site of the report")
+PYEOF
@@ -0,0 +1,171 @@
+// Throughput benchmark for the sampling mode of libmalloctrace.so.
+//
+// Runs the same malloc/free workload without the library, with every
+// allocation recorded, and with several MALLOCTRACE_SAMPLE_BYTES rates, on 1
+// and on more threads at once, and prints the time per malloc + free pair of
+// a thread and the overhead over no tracing with as many threads.
+//
+// Usage: LD_PRELOAD=libmalloctrace.so ./sample_bench [pairs] [sample-bytes...]
+#define _GNU_SOURCE
+
+#include <dlfcn.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "../src/heap_map.h"
+
+#define LIVE_CHUNKS    0x400
+#define MAX_CHUNK_SIZE 0x1000
+#define BENCH_MAP_SIZE "67108864"
+
+static const char* DEFAULT_RATES[] = {"off", "0", "4096", "65536", "524288", "2097152"};
+// Every thread probes the heap maps of all others on a miss, so the overhead depends on their number.
+static const char* THREAD_COUNTS[] = {"1", "4", "16"};
+
+typedef struct {
+    double ns_per_pair;
+    size_t recorded;
+} Result;
+
+static double now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static size_t count_recorded() {
+    HeapMap** heap_map_list = dlsym(RTLD_DEFAULT, "MALLOCTRACE_HEAP_MAP");
+    if (heap_map_list == NULL)
+        return 0;
+    size_t count = 0;
+    for (HeapMap* map = *heap_map_list; map != NULL; map = map->next)
+        count += ((void*)map->head - map->base) / map->entry_size;
+    return count;
+}
+
+typedef struct {
+    pthread_t thread;
+    unsigned int seed;
+    size_t pairs;
+    void* chunks[LIVE_CHUNKS];
+} Worker;
+
+static pthread_barrier_t START_BARRIER, DONE_BARRIER;
+
+static void* work(void* data) {
+    Worker* worker = data;
+    pthread_barrier_wait(&START_BARRIER);
+    for (size_t i = 0; i < worker->pairs; ++i) {
+        size_t slot = rand_r(&worker->seed) % LIVE_CHUNKS;
+        free(worker->chunks[slot]);
+        worker->chunks[slot] = malloc(1 + rand_r(&worker->seed) % MAX_CHUNK_SIZE);
+    }
+    pthread_barrier_wait(&DONE_BARRIER);
+    // Kept live until the main thread counted the recorded chunks.
+    pthread_barrier_wait(&START_BARRIER);
+    for (size_t i = 0; i < LIVE_CHUNKS; ++i)
+        free(worker->chunks[i]);
+    return NULL;
+}
+
+static Result run_workload(size_t pairs, size_t thread_count) {
+    Worker* workers = calloc(thread_count, sizeof(Worker));
+    pthread_barrier_init(&START_BARRIER, NULL, thread_count + 1);
+    pthread_barrier_init(&DONE_BARRIER, NULL, thread_count + 1);
+    for (size_t i = 0; i < thread_count; ++i) {
+        workers[i] = (Worker){.seed = i + 1, .pairs = pairs};
+        pthread_create(&workers[i].thread, NULL, work, &workers[i]);
+    }
+    pthread_barrier_wait(&START_BARRIER);
+    double start = now();
+    pthread_barrier_wait(&DONE_BARRIER);
+    double elapsed = now() - start;
+    // Measured while the chunks are still live, so it shows how many got sampled.
+    Result result = {.ns_per_pair = elapsed * 1e9 / pairs, .recorded = count_recorded()};
+    pthread_barrier_wait(&START_BARRIER);
+    for (size_t i = 0; i < thread_count; ++i)
+        pthread_join(workers[i].thread, NULL);
+    free(workers);
+    return result;
+}
+
+static int run_rate(char** argv, const char* rate, const char* preload, Result* result) {
+    int fds[2];
+    if (pipe(fds) != 0)
+        return 1;
+    pid_t pid = fork();
+    if (pid == 0) {
+        close(fds[0]);
+        dup2(fds[1], STDOUT_FILENO);
+        if (strcmp(rate, "off") == 0) {
+            unsetenv("LD_PRELOAD");
+        } else {
+            setenv("LD_PRELOAD", preload, 1);
+            setenv("MALLOCTRACE_SAMPLE_BYTES", rate, 1);
+        }
+        setenv("MALLOCTRACE_MAP_SIZE", BENCH_MAP_SIZE, 1);
+        execv("/proc/self/exe", argv);
+        perror("execv");
+        _exit(1);
+    }
+    close(fds[1]);
+    ssize_t n = read(fds[0], result, sizeof(Result));
+    close(fds[0]);
+    int status;
+    if (pid < 0 || waitpid(pid, &status, 0) < 0 || n != sizeof(Result))
+        return 1;
+    return !WIFEXITED(status) || WEXITSTATUS(status) != 0;
+}
+
+int main(int argc, char** argv) {
+    size_t pairs = argc > 1 ? strtoul(argv[1], NULL, 10) : 1000000;
+
+    if (getenv("MALLOCTRACE_MAP_SIZE") != NULL) {
+        // Child: run the workload once and hand the result back through stdout.
+        Result result = run_workload(pairs, strtoul(argv[2], NULL, 10));
+        return write(STDOUT_FILENO, &result, sizeof(result)) != sizeof(result);
+    }
+
+    char* preload = getenv("LD_PRELOAD");
+    if (preload == NULL) {
+        printf("Usage: LD_PRELOAD=libmalloctrace.so %s [pairs] [sample-bytes...]\n", argv[0]);
+        return 1;
+    }
+    // The children only need the pair and the thread count.
+    char* child_argv[] = {argv[0], argc > 1 ? argv[1] : "1000000", NULL, NULL};
+    const char** rates = DEFAULT_RATES;
+    size_t rate_count = sizeof(DEFAULT_RATES) / sizeof(DEFAULT_RATES[0]);
+    if (argc > 2) {
+        rates = (const char**)argv + 1;
+        rates[0] = "off";
+        rate_count = argc - 1;
+    }
+
+    int failures = 0;
+    for (size_t t = 0; t < sizeof(THREAD_COUNTS) / sizeof(THREAD_COUNTS[0]); ++t) {
+        child_argv[2] = (char*)THREAD_COUNTS[t];
+        size_t thread_count = strtoul(THREAD_COUNTS[t], NULL, 10);
+        double baseline = 0.0;
+        for (size_t i = 0; i < rate_count; ++i) {
+            Result result;
+            if (run_rate(child_argv, rates[i], preload, &result) != 0) {
+                printf("threads: %2zu  sample bytes: %8s  FAILED\n", thread_count, rates[i]);
+                failures++;
+                continue;
+            }
+            if (i == 0)
+                baseline = result.ns_per_pair;
+            const char* label = strcmp(rates[i], "off") == 0 ? "off" : strcmp(rates[i], "0") == 0 ? "all" : rates[i];
+            printf("threads: %2zu  sample bytes: %8s  ns per malloc+free: %8.1f  overhead: %7.1f%%  recorded: %6zu / %zu\n", thread_count, label,
+                   result.ns_per_pair, baseline > 0.0 ? (result.ns_per_pair / baseline - 1.0) * 100.0 : 0.0, result.recorded,
+                   thread_count * LIVE_CHUNKS);
+        }
+    }
+    return failures != 0;
+}
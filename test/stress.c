@@ -0,0 +1,181 @@
+// Multi-threaded stress test for libmalloctrace.so.
+//
+// Every thread randomly allocates and frees chunks, and hands some of them over
+// to other threads through a shared exchange array, so a good part of all frees
+// are cross-thread frees. Afterwards all remaining chunks have to be recorded in
+// exactly one of the per-thread heap maps, and none of them after they got freed.
+//
+// Usage: LD_PRELOAD=libmalloctrace.so ./stress [iterations-per-thread] [max-threads]
+#define _GNU_SOURCE
+
+#include <dlfcn.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "../src/heap_map.h"
+
+#define LOCAL_CHUNKS    0x100
+#define SHARED_CHUNKS   0x400
+#define HANDOVER_PERIOD 0x4
+#define MAX_CHUNK_SIZE  0x200
+// Start with tiny maps, so they have to grow (and move) while the threads record into them.
+#define TEST_MAP_SIZE "4096"
+
+typedef struct {
+    unsigned int seed;
+    size_t iterations;
+    void* chunks[LOCAL_CHUNKS];
+} Worker;
+
+static void* SHARED[SHARED_CHUNKS];
+static HeapMap** HEAP_MAP_LIST;
+
+static void* work(void* data) {
+    Worker* worker = (Worker*)data;
+    for (size_t i = 0; i < worker->iterations; ++i) {
+        size_t size = 1 + rand_r(&worker->seed) % MAX_CHUNK_SIZE;
+        if (i % HANDOVER_PERIOD == 0) {
+            void* chunk = malloc(size);
+            void* other = __atomic_exchange_n(&SHARED[rand_r(&worker->seed) % SHARED_CHUNKS], chunk, __ATOMIC_ACQ_REL);
+            free(other);
+            continue;
+        }
+        size_t slot = rand_r(&worker->seed) % LOCAL_CHUNKS;
+        switch (rand_r(&worker->seed) % 3) {
+            case 0:
+                worker->chunks[slot] = realloc(worker->chunks[slot], size);
+                break;
+            case 1:
+                free(worker->chunks[slot]);
+                worker->chunks[slot] = calloc(1, size);
+                break;
+            default:
+                free(worker->chunks[slot]);
+                worker->chunks[slot] = malloc(size);
+                break;
+        }
+    }
+    return NULL;
+}
+
+static int compare_addresses(const void* a, const void* b) {
+    uintptr_t x = *(uintptr_t*)a, y = *(uintptr_t*)b;
+    return (x > y) - (x < y);
+}
+
+// Copies the addresses of all recorded chunks into an mmap'd array, so that
+// collecting them does not itself allocate and change the heap maps.
+static size_t collect_recorded(uintptr_t** recorded) {
+    size_t count = 0;
+    for (HeapMap* map = *HEAP_MAP_LIST; map != NULL; map = map->next)
+        count += ((void*)map->head - map->base) / map->entry_size;
+    *recorded = mmap(NULL, (count + 1) * sizeof(uintptr_t), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    size_t index = 0;
+    for (HeapMap* map = *HEAP_MAP_LIST; map != NULL; map = map->next) {
+        for (void* entry = map->base; entry < (void*)map->head; entry += map->entry_size)
+            (*recorded)[index++] = (uintptr_t)((AllocationDesc*)entry)->chunk.address;
+    }
+    qsort(*recorded, count, sizeof(uintptr_t), compare_addresses);
+    return count;
+}
+
+static size_t occurrences(uintptr_t* recorded, size_t count, void* chunk) {
+    uintptr_t key = (uintptr_t)chunk;
+    uintptr_t* found = bsearch(&key, recorded, count, sizeof(uintptr_t), compare_addresses);
+    if (found == NULL)
+        return 0;
+    uintptr_t* first = found;
+    while (first > recorded && first[-1] == key)
+        --first;
+    size_t n = 0;
+    while (first + n < recorded + count && first[n] == key)
+        ++n;
+    return n;
+}
+
+static int check_recorded(Worker* workers, size_t thread_count, int expect_recorded) {
+    uintptr_t* recorded;
+    size_t count = collect_recorded(&recorded);
+    size_t expected = expect_recorded ? 1 : 0;
+    int failures = 0;
+    for (size_t t = 0; t < thread_count; ++t) {
+        for (size_t i = 0; i < LOCAL_CHUNKS; ++i) {
+            if (workers[t].chunks[i] != NULL && occurrences(recorded, count, workers[t].chunks[i]) != expected)
+                failures++;
+        }
+    }
+    for (size_t i = 0; i < SHARED_CHUNKS; ++i) {
+        if (SHARED[i] != NULL && occurrences(recorded, count, SHARED[i]) != expected)
+            failures++;
+    }
+    munmap(recorded, (count + 1) * sizeof(uintptr_t));
+    return failures;
+}
+
+static double now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static int run(size_t thread_count, size_t iterations) {
+    Worker* workers = calloc(thread_count, sizeof(Worker));
+    pthread_t* threads = calloc(thread_count, sizeof(pthread_t));
+    memset(SHARED, 0x0, sizeof(SHARED));
+
+    double start = now();
+    for (size_t t = 0; t < thread_count; ++t) {
+        workers[t].seed = t + 1;
+        workers[t].iterations = iterations;
+        pthread_create(&threads[t], NULL, work, &workers[t]);
+    }
+    for (size_t t = 0; t < thread_count; ++t)
+        pthread_join(threads[t], NULL);
+    double elapsed = now() - start;
+
+    int missing = check_recorded(workers, thread_count, 1);
+    for (size_t t = 0; t < thread_count; ++t) {
+        for (size_t i = 0; i < LOCAL_CHUNKS; ++i)
+            free(workers[t].chunks[i]);
+    }
+    for (size_t i = 0; i < SHARED_CHUNKS; ++i)
+        free(SHARED[i]);
+    int stale = check_recorded(workers, thread_count, 0);
+
+    double ops = (double)thread_count * iterations;
+    printf("threads: %2zu  ops/s: %12.0f  ns/op: %8.1f  missing: %d  stale: %d\n", thread_count, ops / elapsed, elapsed * 1e9 / ops, missing, stale);
+    free(threads);
+    free(workers);
+    return missing + stale;
+}
+
+int main(int argc, char** argv) {
+    if (getenv("MALLOCTRACE_MAP_SIZE") == NULL) {
+        // The map size is read when the library gets loaded, so restart ourselves with it.
+        setenv("MALLOCTRACE_MAP_SIZE", TEST_MAP_SIZE, 1);
+        // Every chunk has to be recorded for the checks to work.
+        setenv("MALLOCTRACE_SAMPLE_BYTES", "0", 1);
+        execv("/proc/self/exe", argv);
+        perror("execv");
+        return 1;
+    }
+    HEAP_MAP_LIST = dlsym(RTLD_DEFAULT, "MALLOCTRACE_HEAP_MAP");
+    if (HEAP_MAP_LIST == NULL || *HEAP_MAP_LIST == NULL) {
+        printf("libmalloctrace.so is not loaded. Usage: LD_PRELOAD=libmalloctrace.so %s [iterations-per-thread] [max-threads]\n", argv[0]);
+        return 1;
+    }
+    size_t iterations = argc > 1 ? strtoul(argv[1], NULL, 10) : 200000;
+    size_t max_threads = argc > 2 ? strtoul(argv[2], NULL, 10) : 2 * sysconf(_SC_NPROCESSORS_ONLN);
+
+    int failures = 0;
+    for (size_t thread_count = 1; thread_count <= max_threads; thread_count *= 2)
+        failures += run(thread_count, iterations);
+    printf(failures == 0 ? "OK\n" : "FAILED\n");
+    return failures != 0;
+}
@@ -0,0 +1,91 @@
+// Microbenchmark for the unwinding engines of libmalloctrace.so.
+//
+// Measures the time per tracked malloc + free pair, once without the library
+// and once per MALLOCTRACE_UNWINDER engine. The allocations are made from a
+// configurable call depth, since that is what the unwinders have to walk.
+// Build with -fno-omit-frame-pointer, otherwise the fp engine stops early.
+//
+// Usage: LD_PRELOAD=libmalloctrace.so ./unwind_bench [pairs] [call-depth] [bt-depth]
+#define _GNU_SOURCE
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+#define LIVE_CHUNKS 0x100
+#define CHUNK_SIZE  0x40
+
+static const char* ENGINES[] = {"off", "glibc", "fp"};
+
+static double now() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static __attribute__((noinline)) double allocate_at_depth(size_t depth, size_t pairs) {
+    if (depth > 1) {
+        double elapsed = allocate_at_depth(depth - 1, pairs);
+        // Keeps this from being turned into a tail call, so every level has its own frame.
+        __asm__ volatile("" ::: "memory");
+        return elapsed;
+    }
+    void* chunks[LIVE_CHUNKS] = {0};
+    double start = now();
+    for (size_t i = 0; i < pairs; ++i) {
+        size_t slot = i % LIVE_CHUNKS;
+        free(chunks[slot]);
+        chunks[slot] = malloc(CHUNK_SIZE);
+    }
+    double elapsed = now() - start;
+    for (size_t i = 0; i < LIVE_CHUNKS; ++i)
+        free(chunks[i]);
+    return elapsed;
+}
+
+static int run_engine(char** argv, const char* engine, const char* preload) {
+    pid_t pid = fork();
+    if (pid == 0) {
+        if (strcmp(engine, "off") == 0)
+            unsetenv("LD_PRELOAD");
+        else
+            setenv("LD_PRELOAD", preload, 1);
+        setenv("MALLOCTRACE_UNWINDER", engine, 1);
+        execv("/proc/self/exe", argv);
+        perror("execv");
+        _exit(1);
+    }
+    int status;
+    if (pid < 0 || waitpid(pid, &status, 0) < 0)
+        return 1;
+    return !WIFEXITED(status) || WEXITSTATUS(status) != 0;
+}
+
+int main(int argc, char** argv) {
+    size_t pairs = argc > 1 ? strtoul(argv[1], NULL, 10) : 1000000;
+    size_t call_depth = argc > 2 ? strtoul(argv[2], NULL, 10) : 16;
+    if (argc > 3)
+        setenv("MALLOCTRACE_BT_DEPTH", argv[3], 1);
+
+    char* engine = getenv("MALLOCTRACE_UNWINDER");
+    if (engine == NULL) {
+        char* preload = getenv("LD_PRELOAD");
+        if (preload == NULL) {
+            printf("Usage: LD_PRELOAD=libmalloctrace.so %s [pairs] [call-depth] [bt-depth]\n", argv[0]);
+            return 1;
+        }
+        int failures = 0;
+        for (size_t i = 0; i < sizeof(ENGINES) / sizeof(ENGINES[0]); ++i)
+            failures += run_engine(argv, ENGINES[i], preload);
+        return failures != 0;
+    }
+
+    double elapsed = allocate_at_depth(call_depth, pairs);
+    const char* bt_depth = getenv("MALLOCTRACE_BT_DEPTH");
+    printf("unwinder: %-5s  call depth: %3zu  bt depth: %7s  ns per malloc+free: %8.1f\n", engine, call_depth, bt_depth ? bt_depth : "default", elapsed * 1e9 / pairs);
+    return 0;
+}